@@ -0,0 +1,130 @@
+import ml_collections
+import torch
+from path import Path
+
+
+def get_config():
+    """Tiny CPU configuration for smoke testing main.py / distill.py end-to-end."""
+
+    config = ml_collections.ConfigDict()
+    config.log_dir = Path("logs") 
+    # Exp info
+    config.dataset_path = Path("dataset") 
+    config.train_json = config.dataset_path / 'train_canva.json'
+    config.train_clip_json = config.dataset_path / 'train_clip.json' # or a feature store dir (models/path2img.py)
+    config.val_json = config.dataset_path / 'val_canva.json' 
+    config.val_clip_json = config.dataset_path / 'val_clip.json' 
+    config.feature_codec = 'fp32' # in-memory clip feature format: 'fp32', 'fp16', 'int8' or 'pca<dim>' (e.g. 'pca128')
+    config.cache_dir = config.dataset_path / 'cache' # preprocessed dataset cache (None to disable)
+    config.stream = False # stream the training export (.json via ijson or .jsonl) instead of loading it
+    config.shared_dataset = True # multi-GPU: local rank 0 builds the dataset into /dev/shm, other ranks map it
+    config.stream_shuffle_buffer = 10_000 # slides
+    config.stream_num_slides = None # slides in the training export, counted with an extra pass if None
+
+    config.resume_from_checkpoint = None # checkpoint directory, or 'latest' for the newest one in ckpt_dir
+    config.init_checkpoint = None # checkpoint dir (model.safetensors + config.json) to start training from
+
+    config.dataset = "canva"
+    config.max_num_comp = 20
+
+    # Training info
+    config.seed = 42
+    config.scaling_size = 1
+    config.z_scaling_size = 1
+    config.mean_0 = False # True면 -1부터 1로 normalization
+    config.is_cond = False
+    
+    # data specific
+    config.categories_num = 7
+    
+    # model mode
+    config.rz_ox = True
+    config.loss_weight = [1, 0, 0]
+    config.model_kwargs = ml_collections.ConfigDict({'num_layers': 1, 'num_heads': 2})
+    
+    # model specific
+    config.latent_dim = 512
+    config.num_layers = 1
+    config.num_heads = 2
+    config.dropout_r = 0.0
+    config.activation = "gelu"
+    config.cond_emb_size = 224
+    config.cls_emb_size = 64
+    # diffusion specific
+    config.num_cont_timesteps = 16
+    #config.num_discrete_steps = 10
+    config.beta_schedule = "squaredcos_cap_v2"
+    config.diffusion_mode = "epsilon"
+
+    # Training info
+    config.log_interval = 1
+    config.save_interval = 50_000
+    
+    # # 옵티마이저 설정을 위한 ConfigDict 인스턴스 생성
+    # optimizer = ml_collections.ConfigDict()
+
+    # # 설정 추가
+    # optimizer.learning_rate = 0.001
+    # optimizer.type = "Adam"
+    # optimizer.beta1 = 0.9
+    # optimizer.beta2 = 0.999
+    config.optimizer = ml_collections.ConfigDict()
+    config.optimizer.num_gpus = torch.cuda.device_count()
+
+    config.optimizer.mixed_precision = 'no'
+    config.optimizer.gradient_accumulation_steps = 1
+    config.optimizer.betas = (0.95, 0.999)
+    config.optimizer.epsilon = 1e-8
+    config.optimizer.weight_decay = 1e-6
+
+    config.optimizer.lr_scheduler = 'cosine'
+    config.optimizer.num_warmup_steps = 10
+    config.optimizer.lr = 0.0001
+
+    config.optimizer.num_epochs = 2
+    config.optimizer.batch_size = 4
+    config.optimizer.split_batches = False
+    config.optimizer.num_workers = 0
+    config.optimizer.device_resident = False # keep the whole training set on the GPU, batches by on-device index gather
+    config.optimizer.prefetch = False # pin batches and copy them to the GPU on a side stream during the previous step
+    config.optimizer.timestep_sampler = 'uniform' # 'uniform' or 'loss_aware' (importance sampling by per-bucket loss)
+    config.optimizer.timestep_buckets = 50 # loss history buckets over the training timesteps
+    config.optimizer.timestep_history_decay = 0.99 # EMA decay of the per-bucket squared loss
+    config.optimizer.timestep_uniform_prob = 0.01 # share of uniform sampling mixed in
+    config.optimizer.timestep_warmup = 64 # layouts per bucket before leaving uniform sampling
+    config.optimizer.timestep_stratified = True # one draw per equal slice of the CDF across the batch
+    config.optimizer.target_val_iou = None # log epochs_to_target_iou when val_iou first reaches it
+    config.optimizer.train_metric_every = 10 # training IoU every k steps (0: never)
+    config.optimizer.train_metric_fraction = 1.0 # of the layouts of those batches
+    config.optimizer.train_metric_stream = False # queue the training IoU on a side CUDA stream
+    config.optimizer.eval_every = 30 # epochs between full-trajectory sampling IoU evaluations (iou_val_1000)
+    config.optimizer.eval_service = False # run them in a background process instead of inline
+    config.optimizer.eval_device = 'cpu' # device of the background evaluation, e.g. 'cuda:7'
+    config.optimizer.eval_sampler = 'ddpm' # 'ddpm' (all training timesteps) or 'ddim' with eval_steps steps
+    config.optimizer.eval_steps = 1000
+    config.optimizer.eval_batches = 4 # fixed validation batches of the background evaluation
+    config.optimizer.checkpoint_every_steps = 0 # optimizer steps between mid-epoch checkpoints (0: off)
+    config.optimizer.async_checkpoint = True # snapshot to host memory and write in a background thread
+    config.optimizer.keep_last_checkpoints = 20 # retention: newest N checkpoints
+    config.optimizer.keep_every_checkpoints = 0 # retention: also every K-th epoch boundary (0: off)
+    config.optimizer.keep_best_checkpoint = False # retention: also the one with the best val_iou
+    config.optimizer.profile = False # torch.profiler traces of a window of training steps in <log dir>/profiler
+    config.optimizer.profile_wait = 50 # steps skipped before the window
+    config.optimizer.profile_warmup = 5
+    config.optimizer.profile_active = 10 # recorded steps
+    config.optimizer.profile_repeat = 1
+    config.optimizer.memory_telemetry = True # device / host memory and per-phase device peaks every epoch
+    config.optimizer.oom_snapshot = False # record allocator history, dump it to <log dir> on CUDA OOM
+
+    config.optimizer.lmb = 5
+
+    # progressive distillation (distill.py)
+    config.distill = ml_collections.ConfigDict()
+    config.distill.teacher_checkpoint = None  # e.g. logs/<workdir>/checkpoints/checkpoint-1999
+    config.distill.min_steps = 4
+    config.distill.steps_per_stage = 2
+    config.distill.lr = 0.00005
+    config.distill.eval_batches = 1
+
+    config.device = 'cpu'
+    return config
\ No newline at end of file
@@ -14,6 +14,7 @@ def get_config():
 
     config.dataset = "rico"
     config.max_num_comp = 10
+    config.shared_dataset = True # multi-GPU: local rank 0 builds the dataset into /dev/shm, other ranks map it
 
     # Training info
     config.seed = 42
@@ -53,6 +54,13 @@ def get_config():
     config.optimizer.batch_size = 64
     config.optimizer.split_batches = False
     config.optimizer.num_workers = 4
+    config.optimizer.prefetch = False # pin batches and copy them to the GPU on a side stream during the previous step
+    config.optimizer.timestep_sampler = 'uniform' # 'uniform' or 'loss_aware' (importance sampling by per-bucket loss)
+    config.optimizer.timestep_buckets = 50 # loss history buckets over the training timesteps
+    config.optimizer.timestep_history_decay = 0.99 # EMA decay of the per-bucket squared loss
+    config.optimizer.timestep_uniform_prob = 0.01 # share of uniform sampling mixed in
+    config.optimizer.timestep_warmup = 64 # layouts per bucket before leaving uniform sampling
+    config.optimizer.timestep_stratified = True # one draw per equal slice of the CDF across the batch
 
     config.optimizer.lmb = 5
 
@@ -1,18 +1,34 @@
-import random
 import json
 import numpy as np
+import torch
 from pathlib import Path
 from torch.utils.data import Dataset
 from functools import partial
 
+from data_loaders.feature_codec import FeatureCodec
+from data_loaders.feature_store import FeatureStore
+from data_loaders.layout_cache import cache_key, save_columns, load_columns
+from data_loaders.packed_strings import pack_strings, unpack_strings
+from logger_set import LOG
+
+# element type -> cat, padded elements get PAD_TYPE
+PAD_TYPE = 5
+TYPE_IDS = {'freeform': 1, 'group': 1, 'picture': 2, 'table': 2, 'media': 2, 'auto_shape': 3, 'text_box': 4, '0': PAD_TYPE}
+CACHE_VERSION = 4
+
 class CanvaLayout(Dataset):
-    def __init__(self, json_path, clip_json_path, max_num_com: int = 20, scaling_size=5, z_scaling_size=0.01, mean_0 = True):
+    def __init__(self, json_path, clip_json_path, max_num_com: int = 20, scaling_size=5, z_scaling_size=0.01, mean_0 = True,
+                 feature_codec: FeatureCodec = None, cache_dir=None, seed=0):
         #self.presentation_size = presentation_size
         self.max_num_element = max_num_com
         self.scaling_size = scaling_size 
         self.z_scaling_size = z_scaling_size
         self.mean_0 = mean_0
-        self.data = self.process(json_path,clip_json_path)
+        # element order within the slides, see shuffle_elements
+        self.seed = seed
+        # storage format of the clip features, decoded on device by the trainer (feature_codec.decode)
+        self.feature_codec = feature_codec if feature_codec is not None else FeatureCodec()
+        self.data = self.load(json_path, clip_json_path, cache_dir)
     
     def normalize_geometry(self, slide, content, num_elements):
         # Normalize left, top, width, height
@@ -50,58 +66,161 @@ class CanvaLayout(Dataset):
         z = content['z_index'] / z_scale # max num comp로 하든말든
         return [x, y, w, h, r, z]
 
+    def load(self, json_path, clip_json_path, cache_dir=None):
+        """
+        Padded dataset, see build. With `cache_dir` the final columns (shuffled, encoded, padded) are written once to
+        <cache_dir>/canva-<key> and memory-mapped as they are on later runs; the key covers the source files, the
+        preprocessing parameters, the seed and the feature codec (with its fitted state, e.g. the PCA of the
+        training set for the validation split). A codec fitted by the cached build is restored from the cache.
+        """
+        if cache_dir is None:
+            return self.build(json_path, clip_json_path)
+        key = cache_key([json_path, clip_json_path], version=CACHE_VERSION, max_num_com=self.max_num_element,
+                        scaling_size=self.scaling_size, z_scaling_size=self.z_scaling_size, mean_0=self.mean_0,
+                        seed=self.seed, codec=self.feature_codec.name, codec_state=self.feature_codec.digest())
+        cache_path = Path(cache_dir) / f'canva-{key}'
+        columns = load_columns(cache_path)
+        if columns is None:
+            LOG.info(f"Building dataset cache {cache_path}")
+            data = self.build(json_path, clip_json_path)
+            columns = {k: v for k, v in data.items() if k != 'features'}
+            columns.update({f'features.{k}': v for k, v in data['features'].items()})
+            columns.update({f'codec.{k}': v for k, v in self.feature_codec.state().items()})
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            save_columns(cache_path, columns, {"json_path": str(json_path), "clip_json_path": str(clip_json_path)})
+            columns = load_columns(cache_path)
+        data = {k: v for k, v in columns.items() if '.' not in k}
+        data['features'] = {k.split('.', 1)[1]: v for k, v in columns.items() if k.startswith('features.')}
+        if not self.feature_codec.fitted:
+            self.feature_codec.set_state({k.split('.', 1)[1]: np.array(v) for k, v in columns.items()
+                                          if k.startswith('codec.')})
+        return data
+
+    def build(self, json_path, clip_json_path):
+        """process, shuffle_elements, encode_features and pad_slides: the columns the samples are sliced from."""
+        self.data = self.process(json_path, clip_json_path)
+        self.shuffle_elements()
+        self.encode_features()
+        self.pad_slides()
+        return self.data
+
     def process(self, json_path, clip_json_path):
+        """
+        Parse the layout json into flat columns over all elements of all kept slides:
+            geometry [E, 6] float32, type [E] int8, ids [E] int32 interned element id,
+            id_table [B] uint8 / id_table_offsets [I + 1] int64 the distinct id strings (pack_strings),
+            feature_rows [E] int64 row of the element in features [F, 512] (-1 without features),
+            offsets [S + 1] int64, elements of slide i are offsets[i]:offsets[i + 1].
+        """
         with open(json_path, 'r') as f:
             data = json.load(f)
         
-        with open(clip_json_path, 'r') as f:
-            clip_data = json.load(f)
+        # clip features come from a FeatureStore directory (models/path2img.py) or the legacy clip json
+        if FeatureStore.exists(clip_json_path):
+            store = FeatureStore(clip_json_path)
+            features = store.features[:len(store)]
+            get_row = lambda key: store.index.get(key, -1)
+        else:
+            with open(clip_json_path, 'r') as f:
+                clip_data = json.load(f)
+            rows, features = {}, []
+
+            def get_row(key):
+                if key not in rows:
+                    ppt_name, image_file_name = key.split('/', 1)
+                    feature = clip_data.get(ppt_name, {}).get(image_file_name, [])
+                    rows[key] = len(features) if len(feature) else -1
+                    if len(feature):
+                        features.append(np.asarray(feature, dtype=np.float32).reshape(-1))
+                return rows[key]
 
-        processed_data = {"geometry": [], "image_features": [], "ids": [], "type": []} 
+        geometry, types, ids, feature_rows, offsets = [], [], [], [], [0]
+        id_index = {}
         for presentation in data['presentations']:
+            ppt_name = presentation['ppt_name']
             for slide in presentation['slides']:
-                
-                slide_geometry = []
-                slide_image_features = []
-                slide_ids = []  # 슬라이드별 id 저장을 위한 리스트
-                slide_type = []
                 num_elements = len(slide['contents'])  # Number of elements in the current slide
                 if num_elements > self.max_num_element:
                     continue
-                
-                # 임시 리스트에 요소들을 튜플로 저장
-                elements = []
                 for content in slide['contents']:
-                    geometry = self.normalize_geometry(slide, content, num_elements)
-                    image_file_name = content.get('image_file_name', '')
-                    ppt_name = presentation['ppt_name']
-                    image_features = clip_data.get(ppt_name, {}).get(image_file_name, [])
-                    content_id = f"{ppt_name}/{image_file_name}"
-                    content_type = content.get('type', '')
-                    
-                    # 각 요소를 튜플로 묶어서 추가
-                    elements.append((geometry, image_features, content_id, content_type))
-                
-                # elements 리스트를 무작위로 섞음
-                random.shuffle(elements)
-                
-                # 섞인 요소들을 다시 각각의 리스트에 추가
-                for geometry, image_features, content_id, content_type in elements:
-                    slide_geometry.append(geometry)
-                    slide_image_features.append(image_features)
-                    slide_ids.append(content_id)
-                    slide_type.append(content_type)
-                    
-                processed_data["geometry"].append(slide_geometry)
-                processed_data["image_features"].append(slide_image_features)
-                processed_data["ids"].append(slide_ids)  # 슬라이드별 id 정보 추가
-                processed_data["type"].append(slide_type)
-        return processed_data
+                    content_id = f"{ppt_name}/{content.get('image_file_name', '')}"
+                    geometry.append(self.normalize_geometry(slide, content, num_elements))
+                    types.append(TYPE_IDS[content.get('type', '')])
+                    ids.append(id_index.setdefault(content_id, len(id_index)))
+                    feature_rows.append(get_row(content_id))
+                offsets.append(len(geometry))
 
+        if not isinstance(features, np.ndarray):
+            features = np.stack(features) if features else np.zeros((0, 512), dtype=np.float32)
+        return {"geometry": np.asarray(geometry, dtype=np.float32).reshape(-1, 6),
+                "type": np.asarray(types, dtype=np.int8),
+                "ids": np.asarray(ids, dtype=np.int32),
+                **dict(zip(("id_table", "id_table_offsets"), pack_strings(id_index))),
+                "feature_rows": np.asarray(feature_rows, dtype=np.int64),
+                "offsets": np.asarray(offsets, dtype=np.int64),
+                "features": features}
+
+    def shuffle_elements(self):
+        # random element order within every slide, drawn from `seed` (part of the cache key)
+        offsets = self.data['offsets']
+        slide = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        order = np.lexsort((np.random.default_rng(self.seed).random(len(slide)), slide))
+        for k in ('geometry', 'type', 'ids', 'feature_rows'):
+            self.data[k] = self.data[k][order]
 
     def get_data(self):
         return self.data
 
+    def encode_features(self):
+        # only the feature rows used by this split are kept, encoded once (the codec is fitted on them if needed).
+        # row 0 is a zero vector, used by padded elements and elements without clip features
+        features, feature_rows = self.data['features'], self.data['feature_rows']
+        used, feature_rows = np.unique(feature_rows, return_inverse=True)
+        features = np.concatenate([np.zeros((1, features.shape[1]), dtype=np.float32),
+                                   np.asarray(features[used[used >= 0]], dtype=np.float32)])
+        if len(used) and used[0] >= 0:
+            feature_rows = feature_rows + 1
+        if not self.feature_codec.fitted:
+            self.feature_codec.fit(features[1:])
+        self.data['features'] = self.feature_codec.encode(features)
+        self.data['feature_rows'] = feature_rows
+
+    def pad_slides(self):
+        """Scatter the element columns into fixed [num_slides, max_num_com, ...] arrays, so samples are plain slices."""
+        offsets = self.data['offsets']
+        num_slides, max_num_element = len(offsets) - 1, self.max_num_element
+        slide = np.repeat(np.arange(num_slides), np.diff(offsets))
+        position = np.arange(len(slide)) - offsets[slide]
+
+        geometry = np.zeros((num_slides, max_num_element, 6), dtype=np.float32)
+        geometry[slide, position] = self.data.pop('geometry')
+        cat = np.full((num_slides, max_num_element), PAD_TYPE, dtype=np.int64)
+        cat[slide, position] = self.data.pop('type')
+        feature_rows = np.zeros((num_slides, max_num_element), dtype=np.int64)
+        feature_rows[slide, position] = self.data.pop('feature_rows')
+        ids = np.full((num_slides, max_num_element), -1, dtype=np.int32)
+        ids[slide, position] = self.data.pop('ids')
+        padding_mask = np.zeros((num_slides, max_num_element, 6), dtype=np.int32)
+        padding_mask[slide, position] = 1
+        self.data.update(geometry=geometry, cat=cat, feature_rows=feature_rows, ids=ids, padding_mask=padding_mask)
+
+    def lookup_ids(self, ids):
+        """
+        Element id strings ("ppt_name/image_file_name") of the int32 ids of a sample ([max_num_com]) or a batch
+        ([B, max_num_com], a list per layout); padded elements (-1) are skipped.
+        """
+        ids = np.asarray(ids.cpu() if torch.is_tensor(ids) else ids)
+        if ids.ndim > 1:
+            return [self.lookup_ids(row) for row in ids]
+        table, table_offsets = self.data['id_table'], self.data['id_table_offsets']
+        return [unpack_strings(table, table_offsets, i, i + 1)[0] for i in ids[ids >= 0]]
+
+    def element_features(self):
+        """Decoded clip features of all elements, [num_elements, 512] float32."""
+        rows = torch.from_numpy(self.data['feature_rows'][self.data['padding_mask'][..., 0] == 1])
+        features = {k: torch.from_numpy(np.asarray(v))[rows] for k, v in self.data['features'].items()}
+        return self.feature_codec._decode(features).numpy()
+
     def mask_instance(self, geometry):
         # 나중에 
         return np.ones(6)  # Placeholder for the masked geometry
@@ -113,49 +232,31 @@ class CanvaLayout(Dataset):
     def pad_instance_type(self, cat):
         num_pad_elements = max(0, self.max_num_element - len(cat))
         # 1차원 배열에 대한 패딩, 배열의 끝에만 패딩을 추가
-        padded_cat = np.pad(cat, pad_width=(0, num_pad_elements), constant_values=0)
+        padded_cat = np.pad(cat, pad_width=(0, num_pad_elements), constant_values=PAD_TYPE)
         return padded_cat
 
     def process_data(self, idx):
-        geometry = self.data['geometry'][idx]
-        cat = self.data['type'][idx]
-        padding_mask = np.ones(np.array(geometry).shape)
-        mask = self.mask_instance(geometry)
-        geometry = self.pad_instance(geometry)
-        cat = self.pad_instance_type(cat).reshape((-1,1))
-        padding_mask = self.pad_instance(padding_mask)
-        image_features = self.data['image_features'][idx]
-        image_features = np.squeeze(image_features, axis=1)
-        image_features = self.pad_instance(image_features)
-        
-        ids = self.data['ids'][idx]  # id 정보 로드
-        
-        
-        cat[cat=='freeform']=1
-        cat[cat=='group']=1
-        cat[cat=='picture']=2
-        cat[cat=='table']=2
-        cat[cat=='media']=2
-        cat[cat=='auto_shape']=3
-        cat[cat=='text_box']=4
-        cat[cat=='0'] = 5
-       
-        cat = cat.reshape((-1,))
-        
+        """Sample `idx`, or a whole collated batch when `idx` is an array of indices (see __getitems__)."""
+        rows = self.data['feature_rows'][idx]
         return {
-            "geometry": np.array(geometry).astype(np.float32),
-            "image_features": np.array(image_features).astype(np.float32),
-            "padding_mask": padding_mask.astype(np.int32),
-            "ids": ids,  # id 정보 반환
-            "cat": cat.astype(int)
+            "geometry": self.data['geometry'][idx],
+            **{k: v[rows] for k, v in self.data['features'].items()},
+            "padding_mask": self.data['padding_mask'][idx],
+            "ids": self.data['ids'][idx],  # id 정보 반환 (int32, lookup_ids)
+            "cat": self.data['cat'][idx]
         }
 
     def __getitem__(self, idx):
         sample = self.process_data(idx)
         return sample
 
+    def __getitems__(self, indices):
+        # one fancy index per field for the whole batch, custom_collate_fn only converts it to tensors
+        return self.process_data(np.asarray(indices))
+
     def __len__(self):
-        return len(self.data['geometry'])
+        return len(self.data['offsets']) - 1
+
 
 
 ##########################type X #####################
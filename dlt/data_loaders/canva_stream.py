@@ -0,0 +1,183 @@
+import json
+import os
+import random
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data_loaders.canva import CanvaLayout, TYPE_IDS
+from data_loaders.feature_codec import FeatureCodec
+from data_loaders.feature_store import FeatureStore
+from logger_set import LOG
+
+
+def iter_presentations(json_path, shard=0, num_shards=1):
+    """
+    Yield the presentations of a Canva export one at a time.
+    `.jsonl` files (one presentation per line) are split into `num_shards` byte ranges, so every shard only reads
+    its own part; `.json` exports are parsed incrementally with ijson and sharded by presentation index.
+    """
+    if str(json_path).endswith('.jsonl'):
+        size = os.path.getsize(json_path)
+        start, end = size * shard // num_shards, size * (shard + 1) // num_shards
+        with open(json_path, 'rb') as f:
+            if start > 0:
+                # the line crossing `start` belongs to the previous shard
+                f.seek(start - 1)
+                f.readline()
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        try:
+            import ijson
+        except ImportError:
+            raise ImportError("streaming a .json export needs ijson (pip install ijson), or convert it to .jsonl")
+        with open(json_path, 'rb') as f:
+            for i, presentation in enumerate(ijson.items(f, 'presentations.item', use_float=True)):
+                if i % num_shards == shard:
+                    yield presentation
+
+
+def presentations_to_jsonl(json_path, jsonl_path):
+    """Rewrite a Canva export as jsonl, one presentation per line."""
+    with open(jsonl_path, 'w') as f:
+        for presentation in iter_presentations(json_path):
+            f.write(json.dumps(presentation) + '\n')
+
+
+class CanvaLayoutStream(IterableDataset):
+    """
+    CanvaLayout read incrementally from the export, memory use does not grow with the corpus.
+    Slides are sharded over processes (RANK / WORLD_SIZE) and DataLoader workers and shuffled through a bounded
+    buffer of `shuffle_buffer` slides. With `num_slides` known every process yields exactly
+    num_slides // WORLD_SIZE slides per epoch (restarting its shard if needed), so DDP ranks stay in step.
+    Samples have the same keys as CanvaLayout except the element ids, there is no id table to intern them into
+    (training does not use them); clip features should come from a FeatureStore, a clip json is loaded in full.
+    """
+    def __init__(self, json_path, clip_json_path, max_num_com: int = 20, scaling_size=5, z_scaling_size=0.01, mean_0 = True,
+                 feature_codec: FeatureCodec = None, shuffle_buffer=10_000, num_slides=None, seed=0):
+        self.json_path = json_path
+        self.clip_json_path = clip_json_path
+        self.max_num_element = max_num_com
+        self.scaling_size = scaling_size
+        self.z_scaling_size = z_scaling_size
+        self.mean_0 = mean_0
+        self.feature_codec = feature_codec if feature_codec is not None else FeatureCodec()
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.rank = int(os.environ.get('RANK', 0))
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        if num_slides is None:
+            LOG.info(f"Counting slides of {json_path} (set num_slides to skip this pass)")
+            num_slides = sum(1 for _ in self.iter_slides(shuffle=False))
+        self.num_slides = num_slides
+
+    normalize_geometry = CanvaLayout.normalize_geometry
+    pad_instance = CanvaLayout.pad_instance
+    pad_instance_type = CanvaLayout.pad_instance_type
+
+    def __len__(self):
+        # slides per process
+        return self.num_slides // self.world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _clip_lookup(self):
+        if FeatureStore.exists(self.clip_json_path):
+            store = FeatureStore(self.clip_json_path)
+            return lambda key: store.get(key)
+        with open(self.clip_json_path, 'r') as f:
+            clip_data = json.load(f)
+
+        def lookup(key):
+            ppt_name, image_file_name = key.split('/', 1)
+            feature = clip_data.get(ppt_name, {}).get(image_file_name)
+            return None if not feature else np.asarray(feature, dtype=np.float32).reshape(-1)
+        return lookup
+
+    def iter_slides(self, shard=0, num_shards=1, shuffle=True, rng=None):
+        """(geometry [n, 6], type [n], ids, features [n, 512]) of every kept slide of the shard."""
+        lookup = self._clip_lookup()
+        for presentation in iter_presentations(self.json_path, shard, num_shards):
+            ppt_name = presentation['ppt_name']
+            for slide in presentation['slides']:
+                num_elements = len(slide['contents'])
+                if num_elements > self.max_num_element:
+                    continue
+                contents = list(slide['contents'])
+                if shuffle:
+                    rng.shuffle(contents)
+                ids = [f"{ppt_name}/{content.get('image_file_name', '')}" for content in contents]
+                features = [lookup(content_id) for content_id in ids]
+                features = np.stack([np.zeros(512, dtype=np.float32) if f is None else np.asarray(f, dtype=np.float32)
+                                     for f in features]) if features else np.zeros((0, 512), dtype=np.float32)
+                geometry = np.asarray([self.normalize_geometry(slide, content, num_elements) for content in contents],
+                                      dtype=np.float32).reshape(-1, 6)
+                types = np.asarray([TYPE_IDS[content.get('type', '')] for content in contents], dtype=np.int64)
+                yield geometry, types, ids, features
+
+    def fit_feature_codec(self, max_elements=100_000):
+        """Fit the feature codec on the first `max_elements` elements of the export."""
+        features, count = [], 0
+        for _, _, _, slide_features in self.iter_slides(shuffle=False):
+            features.append(slide_features)
+            count += len(slide_features)
+            if count >= max_elements:
+                break
+        self.feature_codec.fit(np.concatenate(features))
+        return self.feature_codec
+
+    def make_sample(self, geometry, types, ids, features):
+        image_features = {k: self.pad_instance(v) for k, v in self.feature_codec.encode(features).items()}
+        return {
+            "geometry": self.pad_instance(geometry).astype(np.float32),
+            **image_features,
+            "padding_mask": self.pad_instance(np.ones(geometry.shape)).astype(np.int32),
+            "cat": self.pad_instance_type(types).astype(int),
+        }
+
+    def __iter__(self):
+        assert self.feature_codec.fitted, "fit the feature codec first (fit_feature_codec)"
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        shard, num_shards = self.rank * num_workers + worker_id, self.world_size * num_workers
+        rng = random.Random(self.seed + 1000003 * self.epoch + shard)
+
+        # this worker's share of the per-process quota
+        quota = len(self) // num_workers + (worker_id < len(self) % num_workers)
+
+        def slides():
+            yielded = 0
+            while yielded < quota:
+                empty = True
+                for slide in self.iter_slides(shard, num_shards, rng=rng):
+                    empty = False
+                    yield slide
+                    yielded += 1
+                    if yielded >= quota:
+                        return
+                if empty:
+                    return
+
+        buffer = []
+        for slide in slides():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(slide)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], slide = slide, buffer[i]
+            yield self.make_sample(*slide)
+        rng.shuffle(buffer)
+        for slide in buffer:
+            yield self.make_sample(*slide)
+
+
+if __name__ == '__main__':
+    import sys
+    presentations_to_jsonl(sys.argv[1], sys.argv[2])
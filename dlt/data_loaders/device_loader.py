@@ -0,0 +1,59 @@
+import math
+
+import numpy as np
+import torch
+
+
+class DeviceLayoutLoader:
+    """
+    Keeps a whole pre-padded dataset (CanvaLayout) on `device` and builds batches by an on-device random permutation
+    and index gather, replacing DataLoader + custom_collate_fn + host to device copies.
+    Yields (batch, None) - training does not use the element ids. Every rank holds the full dataset and takes
+    a strided share of the same permutation, so all ranks run the same number of steps. The permutation depends only
+    on (seed, epoch): call set_epoch before every epoch, and set start_batch to resume in the middle of one.
+    """
+    def __init__(self, dataset, batch_size, device, shuffle=True, drop_last=False, seed=0, rank=0, world_size=1):
+        data = dataset.data
+        to_device = lambda v: torch.from_numpy(np.ascontiguousarray(v)).to(device)
+        self.tensors = {k: to_device(data[k]) for k in ('geometry', 'padding_mask', 'cat')}
+        self.feature_rows = to_device(data['feature_rows'])
+        self.features = {k: to_device(v) for k, v in data['features'].items()}
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.start_batch = 0
+        self.num_samples = len(dataset) // world_size
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def nbytes(self):
+        tensors = list(self.tensors.values()) + list(self.features.values()) + [self.feature_rows]
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def __iter__(self):
+        num_total = self.num_samples * self.world_size
+        if self.shuffle:
+            generator = torch.Generator(device=self.device).manual_seed(self.seed + self.epoch)
+            order = torch.randperm(num_total, generator=generator, device=self.device)
+        else:
+            order = torch.arange(num_total, device=self.device)
+        order = order[self.rank::self.world_size]
+        # only applies to the next iteration
+        start_batch, self.start_batch = self.start_batch, 0
+        for i in range(start_batch, len(self)):
+            idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+            batch = {k: v[idx] for k, v in self.tensors.items()}
+            rows = self.feature_rows[idx]
+            batch.update({k: v[rows] for k, v in self.features.items()})
+            yield batch, None
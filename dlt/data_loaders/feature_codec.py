@@ -0,0 +1,144 @@
+import hashlib
+
+import numpy as np
+import torch
+
+
+class FeatureCodec:
+    """
+    Storage format of the per-element CLIP features.
+    `encode` runs once at dataset build time on numpy [N, dim] float32 features and returns the arrays kept in the
+    dataset (key -> [N, ...]); `decode` runs on the collated batch on the training device and returns float32
+    [batch, element, dim] features, zero at padded elements.
+    """
+    name = 'fp32'
+    fitted = True
+
+    def fit(self, features):
+        return self
+
+    def encode(self, features):
+        return {"image_features": features.astype(np.float32)}
+
+    def _decode(self, batch):
+        return batch['image_features'].float()
+
+    def decode(self, batch):
+        return self._decode(batch) * batch['padding_mask'][..., :1]
+
+    def roundtrip(self, batch):
+        """decode(encode(features)) for an already collated float32 batch, to measure the effect of the codec."""
+        features = batch['image_features']
+        shape = features.shape
+        encoded = self.encode(features.reshape(-1, shape[-1]).cpu().numpy())
+        encoded = {k: torch.from_numpy(v).to(features.device).reshape(*shape[:-1], *v.shape[1:])
+                   for k, v in encoded.items()}
+        return self.decode({**encoded, 'padding_mask': batch['padding_mask']})
+
+    def bytes_per_vector(self, dim=512):
+        encoded = self.encode(np.zeros((1, dim), dtype=np.float32))
+        return sum(v.nbytes for v in encoded.values())
+
+    def state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+    def digest(self):
+        """Fingerprint of the fitted state (None before fit), e.g. for cache keys of encoded features."""
+        if not self.fitted:
+            return None
+        sha1 = hashlib.sha1()
+        for name, value in sorted(self.state().items()):
+            sha1.update(name.encode())
+            sha1.update(np.ascontiguousarray(value).tobytes())
+        return sha1.hexdigest()
+
+    def save(self, path):
+        np.savez(path, name=self.name, **self.state())
+
+
+class Float16Codec(FeatureCodec):
+    name = 'fp16'
+
+    def encode(self, features):
+        return {"image_features": features.astype(np.float16)}
+
+
+class Int8Codec(FeatureCodec):
+    """Symmetric per-vector int8 quantization with a float16 scale."""
+    name = 'int8'
+
+    def encode(self, features):
+        scale = np.abs(features).max(axis=-1, keepdims=True) / 127.
+        scale = np.maximum(scale, 1e-12)
+        quantized = np.clip(np.round(features / scale), -127, 127).astype(np.int8)
+        return {"image_features": quantized, "image_scale": scale.astype(np.float16)}
+
+    def _decode(self, batch):
+        return batch['image_features'].float() * batch['image_scale'].float()
+
+
+class PCACodec(FeatureCodec):
+    """Projection onto the top `dim` principal components (float16 coefficients), fitted on the training features."""
+    fit_samples = 100_000
+
+    def __init__(self, dim, mean=None, components=None):
+        self.dim = dim
+        self.name = f'pca{dim}'
+        self.mean = mean
+        self.components = components  # [dim, feature_dim]
+        self._device_cache = {}
+
+    @property
+    def fitted(self):
+        return self.components is not None
+
+    def fit(self, features):
+        if len(features) > self.fit_samples:
+            features = features[np.random.choice(len(features), self.fit_samples, replace=False)]
+        self.mean = features.mean(axis=0).astype(np.float32)
+        _, _, vt = np.linalg.svd(features - self.mean, full_matrices=False)
+        self.components = vt[:self.dim].astype(np.float32)
+        self._device_cache = {}
+        return self
+
+    def encode(self, features):
+        return {"image_features": ((features - self.mean) @ self.components.T).astype(np.float16)}
+
+    def _decode(self, batch):
+        coefficients = batch['image_features']
+        device = coefficients.device
+        if device not in self._device_cache:
+            self._device_cache[device] = (torch.from_numpy(self.mean).to(device),
+                                          torch.from_numpy(self.components).to(device))
+        mean, components = self._device_cache[device]
+        return coefficients.float() @ components + mean
+
+    def state(self):
+        return {"mean": self.mean, "components": self.components}
+
+    def set_state(self, state):
+        self.mean, self.components = state['mean'], state['components']
+        self._device_cache = {}
+
+
+def build_feature_codec(name):
+    """'fp32' (None), 'fp16', 'int8' or 'pca<dim>', e.g. 'pca64'."""
+    if name is None or name == 'fp32':
+        return FeatureCodec()
+    if name == 'fp16':
+        return Float16Codec()
+    if name == 'int8':
+        return Int8Codec()
+    if name.startswith('pca'):
+        return PCACodec(int(name[3:]))
+    raise NotImplementedError(name)
+
+
+def load_feature_codec(path):
+    state = np.load(path)
+    codec = build_feature_codec(str(state['name']))
+    codec.set_state(state)
+    return codec
@@ -0,0 +1,97 @@
+import json
+import os
+
+import numpy as np
+from path import Path
+
+
+class FeatureStore:
+    """
+    Contiguous float16 feature matrix in a memory-mapped file with an id -> row index.
+
+    Layout of `root`:
+        features.f16   raw [capacity, dim] float16 matrix
+        manifest.json  {"dim": ..., "rows": ..., "capacity": ..., "index": {id: row}}
+    Rows only become visible once `commit` has flushed them, so an interrupted writer can resume from the last commit.
+    Stores written before manifest.json existed (separate index.json / meta.json) are read and migrated on commit.
+    """
+    dtype = np.float16
+
+    def __init__(self, root, dim=512, mode='r'):
+        assert mode in ('r', 'a')
+        self.root = Path(root)
+        self.mode = mode
+        if (self.root / 'manifest.json').exists():
+            with open(self.root / 'manifest.json', 'r') as f:
+                meta = json.load(f)
+            self.index = meta['index']
+            self.dim, self.rows, self.capacity = meta['dim'], meta['rows'], meta['capacity']
+        elif self.exists(self.root):
+            with open(self.root / 'meta.json', 'r') as f:
+                meta = json.load(f)
+            with open(self.root / 'index.json', 'r') as f:
+                self.index = json.load(f)
+            self.dim, self.rows, self.capacity = meta['dim'], meta['rows'], meta['capacity']
+        else:
+            assert mode == 'a', f"no feature store at {self.root}"
+            self.root.makedirs_p()
+            self.index, self.dim, self.rows, self.capacity = {}, dim, 0, 0
+            open(self.root / 'features.f16', 'wb').close()
+            self.commit()
+        self._map()
+
+    @staticmethod
+    def exists(root):
+        return (Path(root) / 'manifest.json').exists() or (Path(root) / 'meta.json').exists()
+
+    def _map(self):
+        if self.capacity == 0:
+            self.features = np.zeros((0, self.dim), dtype=self.dtype)
+        else:
+            self.features = np.memmap(self.root / 'features.f16', dtype=self.dtype,
+                                      mode='r' if self.mode == 'r' else 'r+', shape=(self.capacity, self.dim))
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key, default=None):
+        row = self.index.get(key)
+        return default if row is None else self.features[row]
+
+    def reserve(self, capacity):
+        """Grow the backing file to hold at least `capacity` rows."""
+        assert self.mode == 'a'
+        if capacity <= self.capacity:
+            return
+        if isinstance(self.features, np.memmap):
+            self.features.flush()
+        del self.features
+        with open(self.root / 'features.f16', 'r+b') as f:
+            f.truncate(capacity * self.dim * np.dtype(self.dtype).itemsize)
+        self.capacity = capacity
+        self._map()
+
+    def add(self, keys, features):
+        """Append `features` ([len(keys), dim]) for `keys`; visible to readers after the next `commit`."""
+        assert self.mode == 'a'
+        needed = self.rows + len(keys)
+        if needed > self.capacity:
+            self.reserve(max(needed, 2 * self.capacity))
+        self.features[self.rows:self.rows + len(keys)] = np.asarray(features, dtype=self.dtype)
+        for i, key in enumerate(keys):
+            self.index[key] = self.rows + i
+        self.rows += len(keys)
+
+    def commit(self):
+        if isinstance(getattr(self, 'features', None), np.memmap):
+            self.features.flush()
+        # index and meta are one file replaced atomically, a crash leaves the previous commit intact
+        tmp = self.root / 'manifest.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"dim": self.dim, "rows": self.rows, "capacity": self.capacity, "index": self.index}, f)
+        os.replace(tmp, self.root / 'manifest.json')
+        for name in ('index.json', 'meta.json'):
+            (self.root / name).remove_p()
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from path import Path
+
+
+def file_digest(path, chunk_size=1 << 24):
+    """sha1 of a file, or of the index/meta files of a directory (e.g. a FeatureStore)."""
+    path = Path(path)
+    sha1 = hashlib.sha1()
+    files = sorted(f for f in path.files() if f.ext == '.json') if path.isdir() else [path]
+    for file in files:
+        sha1.update(file.name.encode())
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_key(sources, **params):
+    """Key of a preprocessed dataset: content hash of its source files plus the preprocessing parameters."""
+    content = {"sources": [file_digest(source) for source in sources], "params": params}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def save_columns(root, columns, meta=None):
+    """
+    Write `columns` (name -> numpy array) as one .npy file each, so they can be memory-mapped back by load_columns.
+    The directory is written next to `root` and renamed into place, readers never see a partial cache.
+    """
+    root = Path(root)
+    tmp = Path(root + f'.tmp{os.getpid()}')
+    tmp.rmtree_p()
+    tmp.makedirs_p()
+    for name, column in columns.items():
+        np.save(tmp / f'{name}.npy', np.ascontiguousarray(column))
+    with open(tmp / 'meta.json', 'w') as f:
+        json.dump(meta or {}, f)
+    try:
+        os.rename(tmp, root)
+    except OSError:
+        # another process finished the same cache first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_columns(root):
+    """Columns written by save_columns, memory-mapped read only, or None if there is no cache at `root`."""
+    root = Path(root)
+    if not (root / 'meta.json').exists():
+        return None
+    return {file.stem: np.load(file, mmap_mode='r') for file in root.files('*.npy')}
@@ -0,0 +1,82 @@
+import json
+
+import numpy as np
+from path import Path
+
+from data_loaders.layout_cache import cache_key, save_columns, load_columns
+from logger_set import LOG
+
+
+def convert_coco(json_path, component_class, max_num_comp):
+    """
+    COCO layout annotations -> flat columns, vectorized over all annotations:
+        box [E, 4] float32 normalized (xc, yc, w, h) scaled to [-2, 2], cat [E] int8 (class + 1, 0 is empty),
+        offsets [N + 1] int64, file_names [N] str.
+    Layouts are ordered by image id and keep the annotation order of the file; components outside the image or
+    with empty size are dropped (is_valid_comp) and only layouts with 2..max_num_comp components are kept.
+    """
+    with open(json_path, 'r') as f:
+        json_data = json.load(f)
+
+    images = sorted(json_data['images'], key=lambda image: image['id'])
+    image_index = {image['id']: i for i, image in enumerate(images)}
+    size = np.array([[image['width'], image['height']] for image in images], dtype=np.float64).reshape(-1, 2)
+    category = {t['id']: component_class[t['name']] for t in json_data['categories']}
+
+    annotations = json_data['annotations']
+    ann_image = np.array([image_index[t['image_id']] for t in annotations], dtype=np.int64)
+    ann_box = np.array([t['bbox'] for t in annotations], dtype=np.float64).reshape(-1, 4)
+    ann_cat = np.array([category[t['category_id']] for t in annotations], dtype=np.int8)
+    del json_data, annotations
+
+    W, H = size[ann_image, 0], size[ann_image, 1]
+    x1, y1, width, height = ann_box.T
+    x2, y2 = x1 + width, y1 + height
+    valid = (x1 >= 0) & (y1 >= 0) & (x2 <= W) & (y2 <= H) & (x2 > x1) & (y2 > y1)
+
+    counts = np.bincount(ann_image[valid], minlength=len(images))
+    keep_image = (counts > 1) & (counts <= max_num_comp)
+    keep = valid & keep_image[ann_image]
+    order = np.argsort(ann_image[keep], kind='stable')
+    ann_image, ann_box, ann_cat = ann_image[keep][order], ann_box[keep][order], ann_cat[keep][order]
+    W, H = W[keep][order], H[keep][order]
+
+    x1, y1, width, height = ann_box.T
+    box = np.stack([(x1 + width / 2.) / W, (y1 + height / 2.) / H, width / W, height / H], axis=1)
+    box = ((box * 2) - 1) * 2
+    kept_images = np.flatnonzero(keep_image)
+    return {
+        "box": box.astype(np.float32),
+        # shift class by 1 because 0 is for empty
+        "cat": (ann_cat + 1).astype(np.int8),
+        "offsets": np.concatenate([[0], np.cumsum(counts[kept_images])]).astype(np.int64),
+        "file_names": np.array([images[i]['file_name'] for i in kept_images], dtype=str),
+    }
+
+
+class LayoutStore:
+    """
+    Memory-mapped layouts of a COCO annotation file (see convert_coco), shared by PublaynetLayout and
+    MagazineLayout. The store is converted once into <json dir>/layout_store/<json stem>-<key> and then only
+    mapped, so startup is fast and DataLoader workers share the pages instead of copying per-layout objects.
+    """
+    def __init__(self, json_path, component_class, max_num_comp):
+        json_path = Path(json_path)
+        key = cache_key([json_path], component_class=component_class, max_num_comp=max_num_comp)
+        root = json_path.parent / 'layout_store' / f'{json_path.stem}-{key}'
+        columns = load_columns(root)
+        if columns is None:
+            LOG.info(f"Converting {json_path} to {root}")
+            root.parent.makedirs_p()
+            save_columns(root, convert_coco(json_path, component_class, max_num_comp), {"json_path": str(json_path)})
+            columns = load_columns(root)
+        self.box, self.cat = columns['box'], columns['cat']
+        self.offsets, self.file_names = columns['offsets'], columns['file_names']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, idx):
+        """(box [n, 4] float32, cat [n] int64, file name) of layout `idx`."""
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return np.array(self.box[start:end]), self.cat[start:end].astype(np.int64), str(self.file_names[idx])
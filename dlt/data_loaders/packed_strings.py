@@ -0,0 +1,21 @@
+import numpy as np
+
+
+def pack_strings(strings):
+    """
+    Strings -> (buffer [B] uint8 utf-8 bytes, offsets [N + 1] int64), string i is buffer[offsets[i]:offsets[i + 1]].
+    Two flat arrays instead of N Python objects: nothing is refcounted on access, so forked DataLoader workers keep
+    sharing the pages, and they can be cached / memory-mapped like any other column.
+    """
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), offsets
+
+
+def unpack_strings(buffer, offsets, start, end):
+    """Strings start..end - 1 of a packed buffer."""
+    bounds = offsets[start:end + 1] - offsets[start]
+    text = np.asarray(buffer[offsets[start]:offsets[end]]).tobytes()
+    return [text[a:b].decode() for a, b in zip(bounds[:-1], bounds[1:])]
+
@@ -0,0 +1,83 @@
+import torch
+
+
+class BatchPrefetcher:
+    """
+    Yield the batches of a host DataLoader on `device`, copying batch k + 1 while step k runs.
+    Tensors (also nested in dicts / lists / tuples, e.g. custom_collate_fn's (batch, ids)) are pinned if the loader
+    did not pin them already and copied with non_blocking on a side CUDA stream; the compute stream waits for that
+    copy only when the batch is handed out. On a non CUDA device the copies are plain synchronous ones.
+    With `defer_wait` the compute stream waits for the copy at wait() instead, so the caller can time that wait
+    (the h2d phase of TrainLoopCAL); wait() has to be called before the batch is used.
+    """
+    def __init__(self, loader, device, defer_wait=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.defer_wait = defer_wait
+        self.copy_done = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # set_epoch, batch_size, dataset, ... of the wrapped loader
+        if name in ('loader', 'copy_done'):
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def to_device(self, value):
+        if isinstance(value, torch.Tensor):
+            if value.device.type == 'cpu' and self.device.type == 'cuda' and not value.is_pinned():
+                value = value.pin_memory()
+            return value.to(self.device, non_blocking=True)
+        if isinstance(value, dict):
+            return {k: self.to_device(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.to_device(v) for v in value)
+        return value
+
+    @staticmethod
+    def record_stream(value, stream):
+        # the tensors were allocated on the side stream, keep the allocator from reusing them before `stream` is done
+        if isinstance(value, torch.Tensor):
+            value.record_stream(stream)
+        elif isinstance(value, dict):
+            for v in value.values():
+                BatchPrefetcher.record_stream(v, stream)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                BatchPrefetcher.record_stream(v, stream)
+
+    def wait(self):
+        """Make the current stream wait for the copy of the last batch handed out (no-op off CUDA or once waited)."""
+        if self.copy_done is not None:
+            torch.cuda.current_stream(self.device).wait_event(self.copy_done)
+            self.copy_done = None
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(copy_stream):
+                batch = self.to_device(batch)
+            return batch, copy_stream.record_event()
+
+        next_batch = preload()
+        while next_batch is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            batch, self.copy_done = next_batch
+            if not self.defer_wait:
+                self.wait()
+            self.record_stream(batch, compute_stream)
+            next_batch = preload()
+            yield batch
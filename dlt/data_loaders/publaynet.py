@@ -1,12 +1,11 @@
 import random
-import json
 import numpy as np
 from path import Path
 from torch.utils.data import Dataset
-from functools import partial
 
-from data_loaders.data_utils import norm_bbox, is_valid_comp, mask_loc, mask_size, mask_cat, mask_whole_box, \
+from data_loaders.data_utils import mask_loc, mask_size, mask_cat, mask_whole_box, \
     mask_random_box_and_cat, mask_all
+from data_loaders.layout_store import LayoutStore
 from utils import getDistinctColors
 
 
@@ -41,79 +40,21 @@ class PublaynetLayout(Dataset):
     def __init__(self, json_path: Path, max_num_com: int = 9, cond_type=None):
         # + 2 because 0 goes to pad and 1 goes to cat mask
         self.categories_num = len(self.component_class.keys()) + 2
-        self.data = {"bbox": [],
-                     "file_idx": [],
-                     "file2bboxidx": {},
-                     "annotations": []}
         self.max_num_comp = max_num_com
         self.process(json_path)
-        print("#############################################################")
-        for key, value in self.data.items():
-            print(type(key))
-            print(type(value), len(value))
-        print("#############################################################")
         self.cond_type = cond_type
         self.orig_ord = None
 
     def process(self, json_path: Path):
-        json_data = json.load(open(json_path, 'r'))
-        img2ann = {}
-        ind2cat = {}
-
-        for t in json_data['annotations']:
-            if not t['image_id'] in img2ann.keys():
-                img2ann[t['image_id']] = []
-            img2ann[t['image_id']].append(t)
-
-        for t in json_data['categories']:
-            ind2cat[t['id']] = t['name']
-
-        img_ids = [t['id'] for t in json_data['images']]
-        sort_img_ind = [i[0] for i in sorted(enumerate(img_ids), key=lambda x: x[1])]
-        for id in sort_img_ind:
-            ann_img = json_data['images'][id]
-            W = float(ann_img['width'])
-            H = float(ann_img['height'])
-
-            elements = img2ann[img_ids[id]]
-            elements = list(filter(partial(is_valid_comp, W=W, H=H), elements))
-
-            N = len(elements)
-            if N <= 1 or N > self.max_num_comp:
-                continue
-
-            boxes = []
-            categories = []
-            for element in elements:
-                # normalize bboxes
-                b = norm_bbox(H, W, element)
-                boxes.append(b)
-                category = ind2cat[element["category_id"]]
-                categories.append(self.component_class[category])
-
-            ann_box = np.array(boxes)
-            ann_cat = np.array(categories)
-            # we want to get order invariant model
-            ind = [ttt for ttt in range(ann_box.shape[0])]
-            random.shuffle(ind)
-            ann_cat = ann_cat[ind]
-            # shift class by 1 because 0 is for empty
-            ann_cat += 1
-            ann_box = ann_box[ind]
-            # scale
-            ann_box = ((ann_box * 2) - 1) * 2
-            self.data["bbox"].append(ann_box)
-            self.data["annotations"].append(ann_cat)
-            self.data["file_idx"].append(ann_img['file_name'])
+        # flat memory-mapped boxes / categories, converted from the COCO json on first use
+        self.store = LayoutStore(json_path, self.component_class, self.max_num_comp)
 
     def get_data_by_ix(self, idx):
-        box = self.data['bbox'][idx]
+        box, cat, name = self.store.get(idx)
         ind = list(range(box.shape[0]))
         random.shuffle(ind)
         box = box[ind]
-        cat = self.data['annotations'][idx][ind]
-
-        name = self.data['file_idx'][idx]
+        cat = cat[ind]
         return box, cat, ind, name
 
     def process_data(self, idx):
@@ -175,7 +116,7 @@ class PublaynetLayout(Dataset):
         return sample
 
     def __len__(self):
-        return len(self.data['bbox'])
+        return len(self.store)
 
     def process_data_cond(self, idx, cond_type):
         box, cat, ind, name = self.get_data_by_ix(idx)
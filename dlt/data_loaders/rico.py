@@ -4,6 +4,8 @@ import torch
 import pickle
 import random
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from path import Path
 from torch.utils.data import Dataset
 from tqdm import tqdm
@@ -11,6 +13,140 @@ from tqdm import tqdm
 from data_loaders.publaynet import PublaynetLayout
 from data_loaders.data_utils import mask_whole_box, mask_loc, mask_size, mask_cat, mask_random_box_and_cat, mask_all
 from utils import getDistinctColors
+from logger_set import LOG
+
+RICO_CACHE_VERSION = 1
+
+
+def parse_rico_file(path, component_class):
+    """
+    Boxes of one semantic annotation file: (num_labeled, box [n, 4] float32 normalized xc, yc, w, h, cat [n] int8).
+    num_labeled counts the elements of a known class (before dropping negative sized boxes), -1 marks a file whose
+    canvas is not usable.
+    """
+    with open(path, "r") as f:
+        json_file = json.load(f)
+    canvas = json_file["bounds"]
+    W, H = float(canvas[2] - canvas[0]), float(canvas[3] - canvas[1])
+    if canvas[0] != 0 or canvas[1] != 0 or W <= 1000:
+        return -1, np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.int8)
+
+    # pre-order traversal of the view hierarchy
+    elements = []
+    stack = list(reversed(json_file.get("children", [])))
+    while stack:
+        element = stack.pop()
+        elements.append(element)
+        stack.extend(reversed(element.get("children", [])))
+    elements = [e for e in elements if e.get("componentLabel") in component_class]
+
+    box = np.array([e['bounds'] for e in elements], dtype=np.float64).reshape(-1, 4)
+    cat = np.array([component_class[e['componentLabel']] for e in elements], dtype=np.int8)
+    left, top, right, bottom = box.T
+    keep = (right - left >= 0) & (bottom - top >= 0)
+    box = np.stack([(left + right) / 2., (top + bottom) / 2., right - left, bottom - top], axis=1)[keep]
+    box = ((box / np.array([W, H, W, H]) * 2) - 1) * 2
+    # shift class by 1 because 0 is for empty
+    return len(elements), box.astype(np.float32), cat[keep] + 1
+
+
+def _save_npz(path, **arrays):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def _save_json(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def preprocess_rico(data_path, component_class, max_num_comp, num_workers=None):
+    """
+    Incrementally parse <data_path>/semantic_annotations into <data_path>/processed:
+        manifest.json   {file: [mtime_ns, size]} of the parsed files
+        elements.npz    parse_rico_file output of every file, flattened with offsets
+        <split>.npz     train / val / test (85 / 5 / 10 % of the usable files in name order) for max_num_comp
+    Only new or modified files are parsed, in a process pool. Not safe to run from several processes at once, see
+    prepare_rico.
+    """
+    data_dir = data_path / "semantic_annotations"
+    processed_dir = data_path / 'processed'
+    processed_dir.makedirs_p()
+    manifest_path = processed_dir / 'manifest.json'
+    manifest = {}
+    if manifest_path.exists() and (processed_dir / 'elements.npz').exists():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    if manifest.get('version') != RICO_CACHE_VERSION or manifest.get('component_class') != component_class:
+        manifest = {'files': {}}
+
+    files = {}
+    for entry in os.scandir(data_dir):
+        if entry.name.endswith('.json'):
+            stat = entry.stat()
+            files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    names = sorted(files)
+    changed = [name for name in names if manifest['files'].get(name) != files[name]]
+
+    if changed or len(names) != len(manifest['files']):
+        parsed = {}
+        if manifest['files']:
+            with np.load(processed_dir / 'elements.npz', allow_pickle=False) as elements:
+                offsets = elements['offsets']
+                for i, name in enumerate(elements['names'].tolist()):
+                    if name in files and manifest['files'][name] == files[name]:
+                        parsed[name] = (int(elements['num_labeled'][i]), elements['box'][offsets[i]:offsets[i + 1]],
+                                        elements['cat'][offsets[i]:offsets[i + 1]])
+        LOG.info(f"Parsing {len(changed)} of {len(names)} Rico annotation files.")
+        parse = partial(parse_rico_file, component_class=component_class)
+        with ProcessPoolExecutor(num_workers) as pool:
+            results = pool.map(parse, [data_dir / name for name in changed], chunksize=64)
+            for name, result in zip(changed, tqdm(results, total=len(changed))):
+                parsed[name] = result
+
+        boxes = [parsed[name][1] for name in names]
+        _save_npz(processed_dir / 'elements.npz',
+                  names=np.array(names, dtype=str),
+                  num_labeled=np.array([parsed[name][0] for name in names], dtype=np.int32),
+                  offsets=np.cumsum([0] + [len(box) for box in boxes]).astype(np.int64),
+                  box=np.concatenate(boxes).reshape(-1, 4),
+                  cat=np.concatenate([parsed[name][2] for name in names]).astype(np.int8))
+        manifest = {'version': RICO_CACHE_VERSION, 'component_class': component_class, 'files': files}
+        _save_json(manifest_path, manifest)
+    elif manifest.get('max_num_comp') == max_num_comp:
+        return
+
+    with np.load(processed_dir / 'elements.npz', allow_pickle=False) as elements:
+        names, offsets = elements['names'], elements['offsets']
+        box, cat = elements['box'], elements['cat']
+        keep = np.flatnonzero((elements['num_labeled'] >= 2) & (elements['num_labeled'] <= max_num_comp))
+    N = len(keep)
+    s = [int(N * 0.85), int(N * 0.90)]
+    for split, files_idx in (('train', keep[:s[0]]), ('val', keep[s[0]:s[1]]), ('test', keep[s[1]:])):
+        counts = offsets[files_idx + 1] - offsets[files_idx]
+        element_idx = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in files_idx]) \
+            if len(files_idx) else np.zeros(0, dtype=np.int64)
+        _save_npz(processed_dir / f'{split}.npz',
+                  file_idx=names[files_idx],
+                  offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                  bbox=box[element_idx],
+                  annotations=cat[element_idx].astype(np.int64))
+    manifest['max_num_comp'] = max_num_comp
+    _save_json(manifest_path, manifest)
+
+
+def prepare_rico(data_path, max_num_comp, accelerator):
+    """
+    Bring <data_path>/processed up to date on the local main process only, before the other local ranks go on; their
+    RicoLayout then finds it current and just reads it. Call before building RicoLayout in multi-process runs.
+    """
+    with accelerator.local_main_process_first():
+        if accelerator.is_local_main_process and (data_path / "semantic_annotations").exists():
+            preprocess_rico(data_path, RicoLayout.component_class, max_num_comp)
 
 
 class RicoLayout(Dataset):
@@ -50,88 +186,36 @@ class RicoLayout(Dataset):
         self.split = split
         self.categories_num = len(self.component_class.keys()) + 2
         self.data_path = data_path
-        self.data = {
-            'bbox': [],
-            'file_idx': [],
-            'annotations': [],
-        }
+        self.data = {}
         self.max_num_comp = max_num_comp
         self.process()
         self.cond_type = cond_type
 
-    def get_all_element(self, p_dic, elements):
-        if "children" in p_dic:
-            for i in range(len(p_dic["children"])):
-                cur_child = p_dic["children"][i]
-                elements.append(cur_child)
-                elements = self.get_all_element(cur_child, elements)
-        return elements
-
     def __len__(self):
-        return len(self.data['bbox'])
+        return len(self.data['offsets']) - 1
 
     def process(self):
-        if (self.data_path / f'{self.split}.pth').exists():
-            self.data = torch.load(self.data_path / f'{self.split}.pth')
+        """
+        Load the split from <data_path>/processed/<split>.npz, (re)building it first if any annotation file was
+        added, changed or removed (see preprocess_rico).
+        Layouts stay flat (bbox / annotations sliced by offsets), so the split is a handful of arrays that can be
+        shared between processes (see data_loaders.shared_memory).
+        """
+        processed_dir = self.data_path / 'processed'
+        if (self.data_path / "semantic_annotations").exists():
+            preprocess_rico(self.data_path, self.component_class, self.max_num_comp)
+        elif not (processed_dir / f'{self.split}.npz').exists() and (self.data_path / f'{self.split}.pth').exists():
+            # splits written by older versions
+            legacy = torch.load(self.data_path / f'{self.split}.pth')
+            self.data = {
+                'bbox': np.concatenate(legacy['bbox']).astype(np.float32).reshape(-1, 4),
+                'file_idx': np.asarray(legacy['file_idx']),
+                'annotations': np.concatenate(legacy['annotations']).astype(np.int64),
+                'offsets': np.cumsum([0] + [len(box) for box in legacy['bbox']]).astype(np.int64),
+            }
             return
-        else:
-            data_dir = self.data_path / "semantic_annotations"
-            bbox_idx = 0
-            files = data_dir.files('*.json')
-            for file in tqdm(files):
-                with open(os.path.join(data_dir, file), "r") as f:
-                    json_file = json.load(f)
-
-                canvas = json_file["bounds"]
-
-                W, H = float(canvas[2] - canvas[0]), float(canvas[3] - canvas[1])
-                if canvas[0] != 0 or canvas[1] != 0 or W <= 1000:
-                    continue
-                elements = self.get_all_element(json_file, [])
-                elements = list(filter(lambda e: e["componentLabel"] in self.component_class, elements))
-
-                if len(elements) < 2 or len(elements) > self.max_num_comp:
-                    continue
-
-                ann_box = []
-                ann_cat = []
-                for ele in elements:
-                    left, top, right, bottom = ele['bounds']
-                    xc = (left + right) / 2.
-                    yc = (top + bottom) / 2.
-                    w = right - left
-                    h = bottom - top
-
-                    if w < 0 or h < 0:
-                        continue
-                    ann_box.append([xc, yc, w, h])
-                    # componentLabel
-                    ann_cat.append(
-                        self.component_class[ele['componentLabel']])
-                ann_box = np.array(ann_box)
-                ann_cat = np.array(ann_cat)
-
-                # we want to get order invariant model
-                ind = [ttt for ttt in range(ann_box.shape[0])]
-                random.shuffle(ind)
-                ann_cat = ann_cat[ind]
-                # shift class by 1 because 0 is for empty
-                ann_cat += 1
-                ann_box = ann_box[ind]
-
-                ann_box = ann_box / np.array([W, H, W, H])
-                ann_box = ((ann_box * 2) - 1) * 2
-                self.data["bbox"].append(ann_box)
-                self.data["file_idx"].append(file)
-                self.data['annotations'].append(ann_cat)
-                bbox_idx += 1
-            # create train, val, test split indexes
-            N = len(self.data['bbox'])
-            s = [int(N * 0.85), int(N * 0.90)]
-            torch.save({k: v[:s[0]] for k, v in self.data.items()}, self.data_path / "train.pth")
-            torch.save({k: v[s[0]:s[1]] for k, v in self.data.items()}, self.data_path / "val.pth")
-            torch.save({k: v[s[1]:] for k, v in self.data.items()}, self.data_path / "test.pth")
-            self.data = torch.load(self.data_path / f'{self.split}.pth')
+        with np.load(processed_dir / f'{self.split}.npz', allow_pickle=False) as split:
+            self.data = {name: split[name] for name in ('bbox', 'file_idx', 'annotations', 'offsets')}
 
     def process_data_cond(self, idx, cond_type):
         box, cat, ind, name = self.get_data_by_ix(idx)
@@ -155,13 +239,14 @@ class RicoLayout(Dataset):
         }
 
     def get_data_by_ix(self, idx):
-        box = self.data['bbox'][idx]
+        start, end = self.data['offsets'][idx], self.data['offsets'][idx + 1]
+        box = self.data['bbox'][start:end]
         ind = list(range(box.shape[0]))
         random.shuffle(ind)
         box = box[ind]
-        cat = self.data['annotations'][idx][ind]
+        cat = self.data['annotations'][start:end][ind]
 
-        name = self.data['file_idx'][idx]
+        name = self.data['file_idx'][idx].item()
         return box, cat, ind, name
 
     def process_data(self, idx):
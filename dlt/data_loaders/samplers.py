@@ -0,0 +1,26 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class EpochSampler(Sampler):
+    """
+    Random order that is a pure function of (seed, epoch), so a resumed run draws the same permutation and can seek
+    into it (accelerator.skip_first_batches) instead of replaying the epoch. Call set_epoch before every epoch.
+    """
+    def __init__(self, data_source, seed=0, shuffle=True):
+        self.data_source = data_source
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(range(len(self.data_source)))
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator).tolist())
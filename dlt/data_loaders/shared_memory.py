@@ -0,0 +1,77 @@
+import atexit
+import os
+import pickle
+
+import numpy as np
+from path import Path
+
+
+class _SharedArray:
+    """Placeholder for an array stored next to the pickled object skeleton."""
+    def __init__(self, name):
+        self.name = name
+
+
+def _strip_arrays(value, arrays, prefix):
+    if isinstance(value, np.ndarray):
+        arrays[prefix] = value
+        return _SharedArray(prefix)
+    if isinstance(value, dict):
+        return type(value)((k, _strip_arrays(v, arrays, f'{prefix}.{k}')) for k, v in value.items())
+    return value
+
+
+def _restore_arrays(value, root):
+    if isinstance(value, _SharedArray):
+        return np.load(root / f'{value.name}.npy', mmap_mode='r')
+    if isinstance(value, dict):
+        return type(value)((k, _restore_arrays(v, root)) for k, v in value.items())
+    return value
+
+
+def export_shared(obj, root):
+    """
+    Write `obj` to `root` (e.g. on /dev/shm): numpy arrays in its attributes (also inside dicts) as .npy files,
+    everything else pickled, so attach_shared can rebuild it with memory-mapped arrays.
+    """
+    root = Path(root)
+    tmp = Path(root + f'.tmp{os.getpid()}')
+    tmp.rmtree_p()
+    tmp.makedirs_p()
+    arrays = {}
+    state = {k: _strip_arrays(v, arrays, k) for k, v in obj.__dict__.items()}
+    for name, array in arrays.items():
+        np.save(tmp / f'{name}.npy', np.ascontiguousarray(array))
+    with open(tmp / 'object.pkl', 'wb') as f:
+        pickle.dump((type(obj), state), f)
+    root.rmtree_p()
+    os.rename(tmp, root)
+
+
+def attach_shared(root):
+    """Object written by export_shared, its arrays memory-mapped read only."""
+    root = Path(root)
+    with open(root / 'object.pkl', 'rb') as f:
+        cls, state = pickle.load(f)
+    obj = cls.__new__(cls)
+    obj.__dict__.update({k: _restore_arrays(v, root) for k, v in state.items()})
+    return obj
+
+
+def node_shared(build, name, accelerator, shm_dir='/dev/shm'):
+    """
+    Build a dataset once per node and share it between the local ranks.
+    The local main process calls `build()` and exports the result to shared memory; every local rank (including
+    the main one, which drops its private copy) then maps the same pages read only. Without multiple processes
+    this is just `build()`.
+    """
+    if accelerator.num_processes == 1:
+        return build()
+    root = Path(shm_dir) / f"cal-{name}-{os.environ.get('MASTER_PORT', '0')}"
+    with accelerator.local_main_process_first():
+        if accelerator.is_local_main_process:
+            export_shared(build(), root)
+            # mappings stay valid after unlinking, the files only have to live until every rank attached
+            atexit.register(root.rmtree_p)
+        obj = attach_shared(root)
+    return obj
@@ -19,10 +19,14 @@ class TemperatureSampler(Sampler):
         """
         self.temperature = temperature
 
-    def __call__(self, logits: torch.Tensor):
+    def __call__(self, logits: torch.Tensor, generator=None):
         """
-        Sample from logits
+        Sample from logits, with `generator` (a list of one torch.Generator per batch row) from each row's own one
         """
+        if generator is not None:
+            probs = logits / self.temperature
+            return torch.stack([torch.multinomial(p.reshape(-1, p.shape[-1]).cpu(), 1, generator=g).view(p.shape[:-1])
+                                for p, g in zip(probs, generator)]).to(logits.device)
 
         # Create a categorical distribution with temperature adjusted logits
         # logits / self.temperature를 통해 로짓을 온도로 조정합니다. 온도가 1보다 높으면 확률 분포가 더 평평해져(entropy가 높아져) 샘플링이 더 다양해집니다.
@@ -100,7 +104,7 @@ class JointDiffusionScheduler(DDPMScheduler):
         for f_name, f_cat_num in self.discrete_features_names:
             t_to_discrete_stage = [self.cont2disc[f_name][t.item()] for t in timestep]
             cls, _ = self.denoise_cat(cat_output[f_name], t_to_discrete_stage,
-                                      f_cat_num, self.transition_matrices[f_name])
+                                      f_cat_num, self.transition_matrices[f_name], generator)
             step_cat_res[f_name] = cls
         return bbox, step_cat_res
 
@@ -117,7 +121,7 @@ class JointDiffusionScheduler(DDPMScheduler):
             curr_mat = curr_mat @ transition_mat
         return transition_mat_list
 
-    def denoise_cat(self, pred, t, cat_num, transition_mat_list):
+    def denoise_cat(self, pred, t, cat_num, transition_mat_list, generator=None):
         pred_prob = F.softmax(pred, dim=2)
         prob, cls = torch.max(pred_prob, dim=2)
 
@@ -126,7 +130,7 @@ class JointDiffusionScheduler(DDPMScheduler):
                              transition_mat_list[t[0]].to(self.device).float())
             m = m.reshape(pred_prob.shape)
             m[:, :, 0] = 0
-            res = self.sampler(m)
+            res = self.sampler(m, generator)
         else:
             res = (cat_num - 1) * torch.ones_like(cls).to(torch.long)
             top = torch.topk(prob, prob.shape[1], dim=1)
@@ -189,5 +193,40 @@ class GeometryDiffusionScheduler(DDPMScheduler):
                        return_dict: bool = True, ):
         bbox = super().step(cont_output, timestep.detach().item(), sample, generator, return_dict)
         return bbox
+
+    def spaced_timesteps(self, num_steps):
+        """Ascending, evenly spaced subset of `num_steps` training timesteps ending at the last one (for DDIM)."""
+        timesteps = np.linspace(self.num_cont_steps - 1, 0, num_steps, endpoint=False)[::-1]
+        return sorted(set(int(round(t)) for t in timesteps))
+
+    def _alpha_sigma(self, timesteps, ndim):
+        # timestep -1 stands for the clean sample (alpha=1, sigma=0)
+        alphas_cumprod = torch.cat([torch.ones(1), self.alphas_cumprod]).to(timesteps.device)
+        alpha_bar = alphas_cumprod[timesteps + 1].view(-1, *([1] * (ndim - 1)))
+        return alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+
+    def predict_original(self, model_output, timesteps, sample):
+        """x_0 estimate from the model output at `timesteps`, for either prediction type."""
+        if self.config.prediction_type == "epsilon":
+            alpha, sigma = self._alpha_sigma(timesteps, sample.dim())
+            return (sample - sigma * model_output) / alpha
+        return model_output
+
+    def ddim_step(self, model_output, timesteps, prev_timesteps, sample):
+        """
+        Deterministic DDIM update x_t -> x_prev for per-sample timesteps.
+        :param prev_timesteps: target timesteps, -1 jumps straight to x_0.
+        :return: tuple of (prev_sample, pred_original_sample)
+        """
+        alpha, sigma = self._alpha_sigma(timesteps, sample.dim())
+        alpha_prev, sigma_prev = self._alpha_sigma(prev_timesteps, sample.dim())
+        if self.config.prediction_type == "epsilon":
+            epsilon = model_output
+            pred_original = (sample - sigma * epsilon) / alpha
+        else:
+            pred_original = model_output
+            epsilon = (sample - alpha * pred_original) / sigma
+        prev_sample = alpha_prev * pred_original + sigma_prev * epsilon
+        return prev_sample, pred_original
     
     
\ No newline at end of file
@@ -0,0 +1,69 @@
+import os
+from logger_set import LOG
+from absl import flags, app
+from diffusion import GeometryDiffusionScheduler
+from accelerate import Accelerator
+import wandb
+from ml_collections import config_flags
+from models.CAL import build_model
+from trainers.distill_trainer import TrainLoopDistill
+from utils import set_seed
+from data_loaders.canva import CanvaLayout
+
+
+FLAGS = flags.FLAGS
+
+config_flags.DEFINE_config_file("config", "Training configuration.",
+                                lock_config=False)
+flags.DEFINE_string("workdir", default='test', help="Work unit directory.")
+flags.mark_flags_as_required(["config"])
+
+
+def main(*args, **kwargs):
+    config = init_job()
+    LOG.info("Loading data.")
+    assert config.dataset == 'canva'
+    train_data = CanvaLayout(config.train_json, config.train_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+    val_data = CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+
+    accelerator = Accelerator(
+        split_batches=config.optimizer.split_batches,
+        mixed_precision=config.optimizer.mixed_precision,
+        project_dir=config.log_dir,
+    )
+    LOG.info(accelerator.state)
+
+    LOG.info("Loading teacher and diffusion process...")
+    if config.distill.teacher_checkpoint is None:
+        LOG.warning("No teacher checkpoint given, distilling a randomly initialised model.")
+    teacher = build_model(config.rz_ox, config.distill.teacher_checkpoint,
+                          **config.get('model_kwargs', {}))
+
+    noise_scheduler = GeometryDiffusionScheduler(seq_max_length=config.max_num_comp,
+                                                 device=accelerator.device,
+                                                 num_train_timesteps=config.num_cont_timesteps,
+                                                 beta_schedule=config.beta_schedule,
+                                                 prediction_type=config.diffusion_mode,
+                                                 clip_sample=False, )
+    LOG.info("Starting distillation...")
+    TrainLoopDistill(accelerator=accelerator, teacher=teacher, diffusion=noise_scheduler,
+                     train_data=train_data, val_data=val_data, opt_conf=config.optimizer,
+                     distill_conf=config.distill, device=accelerator.device,
+                     scaling_size=config.scaling_size, z_scaling_size=config.z_scaling_size,
+                     mean_0=config.mean_0).train()
+
+
+def init_job():
+    config = FLAGS.config
+    config.log_dir = config.log_dir / FLAGS.workdir
+    config.optimizer.ckpt_dir = config.log_dir / 'checkpoints'
+    os.makedirs(config.optimizer.ckpt_dir, exist_ok=True)
+    set_seed(config.seed)
+    wandb.init(project='TEST' if FLAGS.workdir == 'test' else 'CAL_distill', name=FLAGS.workdir,
+               mode='disabled' if FLAGS.workdir == 'test' else 'online',
+               config={k: v for k, v in config.items() if k not in ('optimizer', 'distill')})
+    return config
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -114,6 +114,19 @@ def get_mean_iou(true_boxes, pred_boxes):
     mean_iou = torch.mean(ious).item()
     return mean_iou
 
+def masked_iou_sum(real_geometry, pred_geometry, scaling_size, mask, mean_0):
+    """
+    (sum of the IoUs of the valid elements, number of valid elements) as device tensors. Same boxes as
+    transform + get_iou, but padded elements are masked out instead of selected, which would sync with the host.
+    """
+    scale = real_geometry.new_tensor([1920.0, 1080.0, 1920.0, 1080.0]) / scaling_size
+    real_box, pred_box = real_geometry[..., :4], pred_geometry[..., :4]
+    if mean_0 == True:
+        real_box, pred_box = (real_box + scaling_size) / 2, (pred_box + scaling_size) / 2
+    ious = get_iou((real_box * scale).reshape(-1, 4), (pred_box * scale).reshape(-1, 4))
+    valid = (mask[..., :4].sum(dim=-1) != 0).reshape(-1).to(ious.dtype)
+    return (ious * valid).sum(), valid.sum()
+
 
 ###################### Obtaining iou of the two rotated bounding boxes  ####################
 
@@ -0,0 +1,31 @@
+import torch
+from accelerate.utils import gather_object
+from torch.utils.data import Subset
+
+
+def shard_dataset(dataset, accelerator):
+    """
+    (Subset of `dataset` for this process, its dataset indices): every num_processes-th layout starting at the
+    process index, so the shards differ by one layout at most. Iterate it in order (shuffle=False).
+    """
+    indices = list(range(accelerator.process_index, len(dataset), accelerator.num_processes))
+    return Subset(dataset, indices), indices
+
+
+def sample_generators(indices, seed):
+    """
+    One CPU generator per dataset index, seeded with seed + index. All the noise of a layout comes from its own
+    generator, so a sample does not depend on the batch it lands in, the number of processes or the device.
+    """
+    return [torch.Generator().manual_seed(seed + int(i)) for i in indices]
+
+
+def gather_in_order(accelerator, records):
+    """
+    `records` [(dataset index, payload)] of every process -> payloads in dataset order on the main process, None on
+    the others. Payloads are pickled (gather_object), keep them on the host.
+    """
+    gathered = gather_object(records)
+    if not accelerator.is_main_process:
+        return None
+    return [payload for _, payload in sorted(gathered, key=lambda record: record[0])]
@@ -0,0 +1,94 @@
+import json
+import os
+
+import torch
+from absl import flags, app
+from ml_collections import config_flags
+from torch.utils.data import DataLoader
+
+from data_loaders.canva import CanvaLayout
+from data_loaders.feature_codec import build_feature_codec
+from diffusion import GeometryDiffusionScheduler
+from evaluation.iou import transform, get_mean_iou
+from logger_set import LOG
+from models.CAL import build_model
+from models.pruning import fixed_eval_batches, denoising_iou
+from trainers.cal_trainer import sample_from_model_ddim
+from utils import set_seed, custom_collate_fn
+
+FLAGS = flags.FLAGS
+config_flags.DEFINE_config_file("config", "Training configuration.",
+                                lock_config=False)
+flags.DEFINE_string("workdir", default='test', help="Work unit directory.")
+flags.DEFINE_string("checkpoint", default=None, help="Checkpoint directory of the model to evaluate.")
+flags.DEFINE_list("codecs", default=['fp32', 'fp16', 'int8', 'pca256', 'pca128', 'pca64'], help="Feature codecs to compare.")
+flags.DEFINE_integer("eval_batches", default=16, help="Validation batches used for the comparison.")
+flags.DEFINE_integer("sample_steps", default=0, help="Also report the IoU of DDIM sampling with this many steps.")
+flags.mark_flags_as_required(["config", "checkpoint"])
+
+
+@torch.no_grad()
+def sampling_iou(model, batches, diffusion, geometry_scale, timesteps, scaling_size, mean_0, seed):
+    torch.manual_seed(seed)
+    ious = []
+    for batch in batches:
+        pred_geometry = sample_from_model_ddim(batch, model, batch['geometry'].device, diffusion, geometry_scale,
+                                               timesteps) * batch['padding_mask']
+        true_box, pred_box = transform(batch['geometry'], pred_geometry, scaling_size, batch['padding_mask'], mean_0)
+        ious.append(get_mean_iou(true_box, pred_box))
+    return sum(ious) / len(ious)
+
+
+def main(*args, **kwargs):
+    """Memory footprint vs. IoU of the clip feature codecs, all evaluated on the same fixed validation batches."""
+    config = init_job()
+    device = config.device
+    LOG.info("Loading data.")
+    # codecs are fitted on the full precision training features
+    train_data = CanvaLayout(config.train_json, config.train_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+    train_features = train_data.element_features()
+    del train_data
+    val_data = CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+    val_loader = DataLoader(val_data, batch_size=config.optimizer.batch_size,
+                            shuffle=False, collate_fn=custom_collate_fn, num_workers=config.optimizer.num_workers)
+
+    model = build_model(config.rz_ox, FLAGS.checkpoint, **config.get('model_kwargs', {})).to(device)
+    noise_scheduler = GeometryDiffusionScheduler(seq_max_length=config.max_num_comp,
+                                                 device=device,
+                                                 num_train_timesteps=config.num_cont_timesteps,
+                                                 beta_schedule=config.beta_schedule,
+                                                 prediction_type=config.diffusion_mode,
+                                                 clip_sample=False, )
+    geometry_scale = torch.tensor([config.scaling_size, config.scaling_size, config.scaling_size, config.scaling_size, 1, config.z_scaling_size])
+    batches = fixed_eval_batches(val_loader, FLAGS.eval_batches, device, noise_scheduler, geometry_scale, config.seed)
+
+    report = {}
+    for name in FLAGS.codecs:
+        codec = build_feature_codec(name).fit(train_features)
+        codec_batches = [{**batch, 'image_features': codec.roundtrip(batch)} for batch in batches]
+        error = sum(((b['image_features'] - c['image_features']) ** 2).sum().item()
+                    for b, c in zip(batches, codec_batches)) / sum(b['padding_mask'][..., 0].sum().item() for b in batches)
+        report[name] = {"bytes_per_vector": codec.bytes_per_vector(),
+                        "feature_mse": error,
+                        "iou": denoising_iou(model, codec_batches, noise_scheduler, config.scaling_size, config.mean_0)}
+        if FLAGS.sample_steps > 0:
+            timesteps = noise_scheduler.spaced_timesteps(FLAGS.sample_steps)
+            report[name]["sampling_iou"] = sampling_iou(model, codec_batches, noise_scheduler, geometry_scale, timesteps,
+                                                        config.scaling_size, config.mean_0, config.seed)
+        LOG.info(f"{name}: {report[name]}")
+
+    with open(config.log_dir / 'feature_codec_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    LOG.info(f"Saved report to {config.log_dir / 'feature_codec_report.json'}")
+
+
+def init_job():
+    config = FLAGS.config
+    config.log_dir = config.log_dir / FLAGS.workdir
+    os.makedirs(config.log_dir, exist_ok=True)
+    set_seed(config.seed)
+    return config
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -14,10 +14,13 @@ from ml_collections import config_flags
 from models.dlt import DLT
 from utils import set_seed, draw_layout_opacity
 from data_loaders.publaynet import PublaynetLayout
-from data_loaders.rico import RicoLayout
+from data_loaders.rico import RicoLayout, prepare_rico
 
 import safetensors.torch as safetensors
 from safetensors.torch import load_model, save_model
+from accelerate import Accelerator
+from diffusers.utils.torch_utils import randn_tensor
+from evaluation.sharding import shard_dataset, sample_generators, gather_in_order
 
 
 FLAGS = flags.FLAGS
@@ -27,16 +30,19 @@ flags.DEFINE_string("workdir", default='test2', help="Work unit directory.")
 flags.DEFINE_string("epoch", default='399', help="Epoch to load from checkpoint.")
 flags.DEFINE_string("cond_type", default='all', help="Condition type to sample from.")
 flags.DEFINE_bool("save", default=False, help="Save samples.")
+flags.DEFINE_integer("seed", default=None, help="Noise of layout i is seeded with seed + i (default: config.seed).")
+flags.DEFINE_bool("cpu", default=False, help="Run on the CPU, e.g. several gloo processes under accelerate launch --cpu.")
 flags.mark_flags_as_required(["config"])
 
 
-def sample_from_model(sample, model, device, categories_num, diffusion):
+def sample_from_model(sample, model, device, categories_num, diffusion, generator=None):
+    """`generator`: optional list of one torch.Generator per layout, drawing all of its noise."""
     shape = sample['box_cond'].shape
     model.eval()
 
     # generate initial noise
     noisy_batch = {
-        'box': torch.randn(*shape, dtype=torch.float32, device=device),
+        'box': randn_tensor(shape, generator=generator, device=torch.device(device), dtype=torch.float32),
         'cat': (categories_num - 1) * torch.ones((shape[0], shape[1]), dtype=torch.long, device=device),
     }
 
@@ -52,7 +58,8 @@ def sample_from_model(sample, model, device, categories_num, diffusion):
             # sample
             bbox_pred, cat_pred = diffusion.step_jointly(bbox_pred, desc_pred,
                                                          timestep=torch.tensor([i], device=device),
-                                                         sample=noisy_batch['box'])
+                                                         sample=noisy_batch['box'],
+                                                         generator=generator)
             # update noise with x_t + update denoised categories.
             noisy_batch['box'] = bbox_pred.prev_sample
             noisy_batch['cat'] = cat_pred['cat']
@@ -62,10 +69,15 @@ def sample_from_model(sample, model, device, categories_num, diffusion):
 def main(*args, **kwargs):
     config = init_job()
     config.optimizer.batch_size = 64
+    # the validation set is sharded over the processes, results are gathered on the main one
+    accelerator = Accelerator(cpu=FLAGS.cpu)
+    config.device = str(accelerator.device)
+    seed = config.seed if FLAGS.seed is None else FLAGS.seed
     LOG.info("Loading data.")
     if config.dataset == 'publaynet':
         val_data = PublaynetLayout(config.val_json, 9, config.cond_type)
     elif config.dataset == 'rico':
+        prepare_rico(config.dataset_path, 9, accelerator)
         val_data = RicoLayout(config.dataset_path, 'test', 9, config.cond_type)
     elif config.dataset == 'magazine':
         val_data = MagazineLayout(config.val_json, 16, config.cond_type)
@@ -106,7 +118,8 @@ def main(*args, **kwargs):
                                               prediction_type='sample',
                                               clip_sample=False, )
 
-    val_loader = DataLoader(val_data, batch_size=config.optimizer.batch_size,
+    val_shard, shard_indices = shard_dataset(val_data, accelerator)
+    val_loader = DataLoader(val_shard, batch_size=config.optimizer.batch_size,
                             shuffle=False, num_workers=config.optimizer.num_workers)
     model.eval()
 
@@ -115,44 +128,53 @@ def main(*args, **kwargs):
         'predicted_val': []
     }
 
-    i = 0
+    # (dataset index, (dataset layout, predicted layout)) of this shard
+    records = []
+    offset = 0
 
-    for batch in tqdm(val_loader):
+    for batch in tqdm(val_loader, disable=not accelerator.is_local_main_process):
+        batch_indices = shard_indices[offset:offset + batch['box_cond'].shape[0]]
+        offset += len(batch_indices)
         batch = {k: v.to(config.device) for k, v in batch.items()}
         with torch.no_grad():
             bbox_pred, cat_pred = sample_from_model(batch, model, config.device,
-                                                    config.categories_num, noise_scheduler)
+                                                    config.categories_num, noise_scheduler,
+                                                    generator=sample_generators(batch_indices, seed))
         # save samples
         box = batch['mask_box'] * bbox_pred + (1 - batch['mask_box']) * batch['box_cond']
         cat = batch['mask_cat'] * cat_pred + (1 - batch['mask_cat']) * batch['cat']
         box = box.cpu().numpy()
         cat = cat.cpu().numpy()
 
-        all_results['dataset_val'].append(
-            np.concatenate([batch['box_cond'].cpu().numpy(),
-                            np.expand_dims(batch['cat'].cpu().numpy(), -1)], axis=-1))
-        all_results['predicted_val'].append(
-            np.concatenate([box, np.expand_dims(cat, -1)], axis=-1))
+        dataset_val = np.concatenate([batch['box_cond'].cpu().numpy(),
+                                      np.expand_dims(batch['cat'].cpu().numpy(), -1)], axis=-1)
+        predicted_val = np.concatenate([box, np.expand_dims(cat, -1)], axis=-1)
+        records.extend((index, (dataset_val[b], predicted_val[b])) for b, index in enumerate(batch_indices))
         if config.save:
-            for b in range(box.shape[0]):
+            # named by dataset index, the processes write disjoint files
+            for b, index in enumerate(batch_indices):
                 tmp_box = box[b]
                 tmp_cat = cat[b]
                 tmp_box = tmp_box[~(tmp_box == 0.).all(1)]
                 tmp_cat = tmp_cat[~(tmp_cat == 0)]
                 tmp_box = (tmp_box / 2 + 1) / 2
                 canvas = draw_layout_opacity(tmp_box, tmp_cat, None, val_data.idx2color_map, height=512)
-                Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{str(i)}_{str(b)}.jpg')
+                Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{index}.jpg')
                 tmp_box = batch['box_cond'][b].cpu().numpy()
                 tmp_cat = batch['cat'][b].cpu().numpy()
                 tmp_box = tmp_box[~(tmp_box == 0.).all(1)]
                 tmp_cat = tmp_cat[~(tmp_cat == 0)]
                 tmp_box = (tmp_box / 2 + 1) / 2
                 canvas = draw_layout_opacity(tmp_box, tmp_cat, None, val_data.idx2color_map, height=512)
-                Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{str(i)}_{str(b)}_gt.jpg')
-        i += 1
-    # pickle results
-    with open(config.optimizer.samples_dir / f'results_{config.cond_type}.pkl', 'wb') as f:
-        pickle.dump(all_results, f)
+                Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{index}_gt.jpg')
+    # layouts in dataset order, the same for any number of processes
+    results = gather_in_order(accelerator, records)
+    if accelerator.is_main_process:
+        all_results['dataset_val'].append(np.stack([dataset_val for dataset_val, _ in results]))
+        all_results['predicted_val'].append(np.stack([predicted_val for _, predicted_val in results]))
+        # pickle results
+        with open(config.optimizer.samples_dir / f'results_{config.cond_type}.pkl', 'wb') as f:
+            pickle.dump(all_results, f)
 
 
 def init_job():
@@ -15,35 +15,43 @@ from absl import flags, app
 from diffusion import JointDiffusionScheduler, GeometryDiffusionScheduler
 from ml_collections import config_flags
 from models.dlt import DLT
-from utils import set_seed, draw_layout_opacity, custom_collate_fn
+from utils import set_seed, draw_layout_opacity, custom_collate_fn, device_memory, host_memory, format_memory, oom_snapshot
 from visualize import create_collage
 from data_loaders.publaynet import PublaynetLayout
-from data_loaders.rico import RicoLayout
+from data_loaders.rico import RicoLayout, prepare_rico
 from data_loaders.canva import CanvaLayout
+from data_loaders.feature_codec import build_feature_codec, load_feature_codec
 
 import safetensors.torch as safetensors
 from safetensors.torch import load_model, save_model
 
-from models.CAL import CAL_4, CAL_6
+from models.CAL import CAL_4, CAL_6, build_model
 from accelerate import Accelerator
 
 from evaluation.iou import transform, print_results, get_iou, get_mean_iou
+from evaluation.sharding import shard_dataset, sample_generators, gather_in_order
+from diffusers.utils.torch_utils import randn_tensor
 
 FLAGS = flags.FLAGS
 config_flags.DEFINE_config_file("config", "Training configuration.",
                                 lock_config=False)
 flags.DEFINE_string("workdir", default='test2', help="Work unit directory.")
 flags.DEFINE_string("epoch", default='1699', help="Epoch to load from checkpoint.")
+flags.DEFINE_string("checkpoint", default=None, help="Checkpoint directory, overrides --epoch.")
 flags.DEFINE_string("cond_type", default='all', help="Condition type to sample from.")
 flags.DEFINE_bool("save", default=False, help="Save samples.")
+flags.DEFINE_integer("seed", default=None, help="Noise of layout i is seeded with seed + i (default: config.seed).")
+flags.DEFINE_bool("oom_snapshot", default=False, help="Dump the CUDA allocator snapshot to the log dir on out of memory.")
+flags.DEFINE_bool("cpu", default=False, help="Run on the CPU, e.g. several gloo processes under accelerate launch --cpu.")
 flags.mark_flags_as_required(["config"])
 
-def sample_from_model(batch, model, device, diffusion, geometry_scale, diffusion_mode):
+def sample_from_model(batch, model, device, diffusion, geometry_scale, diffusion_mode, generator=None):
+    """`generator`: optional list of one torch.Generator per layout, drawing all of its noise."""
     shape = batch['geometry'].shape
     model.eval()
     # generate initial noise
     noisy_batch = {
-        'geometry': torch.randn(*shape, dtype=torch.float32, device=device)*geometry_scale.view(1, 1, 6).to(device)* batch['padding_mask'],
+        'geometry': randn_tensor(shape, generator=generator, device=torch.device(device), dtype=torch.float32)*geometry_scale.view(1, 1, 6).to(device)* batch['padding_mask'],
         "image_features": batch['image_features']
     }
 
@@ -56,12 +64,14 @@ def sample_from_model(batch, model, device, diffusion, geometry_scale, diffusion
                 x0_pred = model(batch, noisy_batch, timesteps=t)
                 geometry_pred = diffusion.inference_step(x0_pred,
                                                          timestep=torch.tensor([i], device=device),
-                                                         sample=noisy_batch['geometry'])
+                                                         sample=noisy_batch['geometry'],
+                                                         generator=generator)
             elif diffusion_mode == "epsilon":
                 epsilon_pred = model(batch, noisy_batch, timesteps=t)
                 geometry_pred = diffusion.inference_step(epsilon_pred,
                                                          timestep=torch.tensor([i], device=device),
-                                                         sample=noisy_batch['geometry'])                
+                                                         sample=noisy_batch['geometry'],
+                                                         generator=generator)
             
             noisy_batch['geometry'] = geometry_pred.prev_sample * batch['padding_mask']
             
@@ -70,15 +80,24 @@ def sample_from_model(batch, model, device, diffusion, geometry_scale, diffusion
 def main(*args, **kwargs):
     config = init_job()
     config.optimizer.batch_size = 64
+    # the validation set is sharded over the processes, results are gathered on the main one
+    accelerator = Accelerator(cpu=FLAGS.cpu)
+    config.device = str(accelerator.device)
+    seed = config.seed if FLAGS.seed is None else FLAGS.seed
     LOG.info("Loading data.")
     if config.dataset == 'publaynet':
         val_data = PublaynetLayout(config.val_json, 9, config.cond_type)
     elif config.dataset == 'rico':
+        prepare_rico(config.dataset_path, 9, accelerator)
         val_data = RicoLayout(config.dataset_path, 'test', 9, config.cond_type)
     elif config.dataset == 'magazine':
         val_data = MagazineLayout(config.val_json, 16, config.cond_type)
     elif config.dataset == 'canva':
-        val_data = CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size,z_scaling_size=config.z_scaling_size,mean_0=config.mean_0)
+        # the training run stores its (fitted) feature codec next to the checkpoints
+        codec_path = config.log_dir / 'feature_codec.npz'
+        feature_codec = load_feature_codec(codec_path) if codec_path.exists() else build_feature_codec(config.get('feature_codec'))
+        val_data = CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size,z_scaling_size=config.z_scaling_size,mean_0=config.mean_0,
+                               feature_codec=feature_codec, cache_dir=config.get('cache_dir'), seed=config.seed)
     else:    
         raise NotImplementedError
     #assert config.categories_num == val_data.categories_num
@@ -91,29 +110,27 @@ def main(*args, **kwargs):
     #             activation='gelu', cond_emb_size=config.cond_emb_size,
     #             cat_emb_size=config.cls_emb_size)
     
-    if config.rz_ox == True:
-        model = CAL_6()
-    else:
-        model = CAL_4()
-    
-
+    # the architecture comes from config.json when the checkpoint has one (e.g. pruned models)
+    checkpoint = FLAGS.checkpoint or config.optimizer.ckpt_dir / f'checkpoint-{config.epoch}'
+    model = build_model(config.rz_ox, checkpoint, **config.get('model_kwargs', {}))
     
     #model = DLT.from_pretrained(config.optimizer.ckpt_dir / f'checkpoint-{config.epoch}', strict=True)
-    load_model(model, config.optimizer.ckpt_dir / f'checkpoint-{config.epoch}' / "model.safetensors", strict=True)
     #model = torch.load(config.optimizer.ckpt_dir / f'checkpoint-{config.epoch}' / "model.pth")
 
 
     model.to(config.device)
         
-    wandb.init(
-        # set the wandb project where this run will be logged
-        project="CAL_val",
-        name=f"epoch_{config.epoch}",
-        # track hyperparameters and run metadata
-        config={
-            "epochs": config.epoch,
-        }
-    )
+    if accelerator.is_main_process:
+        wandb.init(
+            # set the wandb project where this run will be logged
+            project="CAL_val",
+            name=f"epoch_{config.epoch}",
+            # track hyperparameters and run metadata
+            config={
+                "epochs": config.epoch,
+                "num_processes": accelerator.num_processes,
+            }
+        )
     noise_scheduler = GeometryDiffusionScheduler(seq_max_length=config.max_num_comp,
                                               device=config.device,
                                               num_train_timesteps=config.num_cont_timesteps,
@@ -121,7 +138,8 @@ def main(*args, **kwargs):
                                               prediction_type='epsilon',
                                               clip_sample=False, )
 
-    val_loader = DataLoader(val_data, batch_size=config.optimizer.batch_size,
+    val_shard, shard_indices = shard_dataset(val_data, accelerator)
+    val_loader = DataLoader(val_shard, batch_size=config.optimizer.batch_size,
                             shuffle=False, collate_fn = custom_collate_fn,num_workers=config.optimizer.num_workers)
     model.eval()
 
@@ -131,110 +149,110 @@ def main(*args, **kwargs):
             'predicted_val': [],
             'iou':[]
         }
-    #i = 0
-    id_data = []
-    real_data = []
-    pred_data = []
-    iou_data  = []
+    # (dataset index, per layout results) of this shard
+    records = []
     
     geometry_scale = torch.tensor([config.scaling_size, config.scaling_size, config.scaling_size, config.scaling_size, 1, config.z_scaling_size]) # scale에 따라 noise 부여
     
-    for batch, ids in tqdm(val_loader):
-        batch = {k: v.to(config.device) for k, v in batch.items()}
-        with torch.no_grad():
-            pred_geometry = sample_from_model(batch, model, config.device, noise_scheduler, geometry_scale, config.diffusion_mode)*batch["padding_mask"]
+    offset = 0
+    snapshot_path = config.log_dir / f'oom_snapshot_sampling_rank{accelerator.process_index}.pickle'
+    with oom_snapshot(snapshot_path, FLAGS.oom_snapshot):
+        for batch, ids in tqdm(val_loader, disable=not accelerator.is_local_main_process):
+            # int32 element ids -> "ppt_name/image_file_name" per layout
+            ids = val_data.lookup_ids(ids)
+            batch_indices = shard_indices[offset:offset + len(ids)]
+            offset += len(ids)
+            batch = {k: v.to(config.device) for k, v in batch.items()}
+            if hasattr(val_data, 'feature_codec'):
+                batch['image_features'] = val_data.feature_codec.decode(batch)
+            with torch.no_grad():
+                pred_geometry = sample_from_model(batch, model, config.device, noise_scheduler, geometry_scale, config.diffusion_mode,
+                                                  generator=sample_generators(batch_indices, seed))*batch["padding_mask"]
             
            
         
-        real_geometry = batch["geometry"]
-        real_box, pred_box = transform(real_geometry, pred_geometry, config.scaling_size,batch["padding_mask"],config.mean_0)
-        
-        slide_mean_iou = get_mean_iou(real_box, pred_box)
-
-        wandb.log({"mean_iou": slide_mean_iou})
-        # visualize(ids, batch)
+            real_geometry = batch["geometry"]
+            real_box, pred_box = transform(real_geometry, pred_geometry, config.scaling_size,batch["padding_mask"],config.mean_0)
+            # element IoUs of the valid elements, split per layout
+            num_valid = (batch["padding_mask"][:, :, :4].sum(dim=-1) != 0).sum(dim=1).tolist()
+            layout_ious = torch.split(get_iou(real_box, pred_box).cpu(), num_valid)
+            # visualize(ids, batch)
         
-        # 각 하위 리스트를 하나의 리스트로 합치기
-        valid_ids = [item for sublist in ids for item in sublist]
-        valid_ids = valid_ids[0] if len(valid_ids) == 1 else valid_ids
+            for i, index in enumerate(batch_indices):
+                records.append((index, {"ids": ids[i], "dataset_val": real_geometry[i].cpu(),
+                                        "predicted_val": pred_geometry[i].cpu(), "iou": layout_ious[i]}))
         
-        # print("ids: ", valid_ids)
-        # print("ids 길이: ", len(valid_ids))
-        # print("###############################################################")
+            # 캔버스 크기 예시
+            canvas_size = (1920, 1080)
+            base_path = "val_picture"
+            save_path = 'output_result2'
         
-        # 각 하위 리스트를 하나의 리스트로 합치기
-        valid_ids = [item for sublist in ids for item in sublist]
-        valid_ids = valid_ids[0] if len(valid_ids) == 1 else valid_ids
-        
-        id_data.append(valid_ids)
-        real_data.append(real_geometry)
-        pred_data.append(pred_geometry)
-        iou_data.append(get_iou(real_box, pred_box))
-        
-        # 캔버스 크기 예시
-        canvas_size = (1920, 1080)
-        base_path = "val_picture"
-        save_path = 'output_result2'
-        
-        # 이미지 합치기 실행
-        # for id, geometry  in zip(ids, batch["geometry"]):
-        for id, geometry  in zip(ids, pred_geometry):
-            collage = create_collage(batch['geometry'].squeeze(), id, geometry, canvas_size, base_path, config.scaling_size, config.mean_0)
-            # collage.show()
-            # 역 슬래시를 언더스코어로 변경
-            ppt_name = id[0].split('/')[0]
-            slide_name = id[0].split('/')[1]
+            # 이미지 합치기 실행
+            # for id, geometry  in zip(ids, batch["geometry"]):
+            for id, geometry  in zip(ids, pred_geometry):
+                collage = create_collage(batch['geometry'].squeeze(), id, geometry, canvas_size, base_path, config.scaling_size, config.mean_0)
+                # collage.show()
+                # 역 슬래시를 언더스코어로 변경
+                ppt_name = id[0].split('/')[0]
+                slide_name = id[0].split('/')[1]
 
-            # '_Shape' 이전까지의 문자열을 얻기 위해 '_Shape'을 기준으로 분리하고 첫 번째 부분을 선택
-            slide_name = slide_name.split('_Shape')[0]
+                # '_Shape' 이전까지의 문자열을 얻기 위해 '_Shape'을 기준으로 분리하고 첫 번째 부분을 선택
+                slide_name = slide_name.split('_Shape')[0]
 
-            # 확장자를 다시 추가 (.png는 예시입니다. 실제 확장자에 따라 변경해야 할 수 있습니다.)
-            save_file_name = slide_name + '.png'
-            save_file_name = os.path.join(save_path, ppt_name, save_file_name)
-            os.makedirs(os.path.dirname(save_file_name), exist_ok=True)
-            collage.save(save_file_name)
+                # 확장자를 다시 추가 (.png는 예시입니다. 실제 확장자에 따라 변경해야 할 수 있습니다.)
+                save_file_name = slide_name + '.png'
+                save_file_name = os.path.join(save_path, ppt_name, save_file_name)
+                os.makedirs(os.path.dirname(save_file_name), exist_ok=True)
+                collage.save(save_file_name)
 
-        # 결과 보기 또는 저장
-        # # save samples
-        # box = batch['mask_box'] * bbox_pred + (1 - batch['mask_box']) * batch['box_cond']
-        # cat = batch['mask_cat'] * cat_pred + (1 - batch['mask_cat']) * batch['cat']
-        # box = box.cpu().numpy()
-        # cat = cat.cpu().numpy()
+            # 결과 보기 또는 저장
+            # # save samples
+            # box = batch['mask_box'] * bbox_pred + (1 - batch['mask_box']) * batch['box_cond']
+            # cat = batch['mask_cat'] * cat_pred + (1 - batch['mask_cat']) * batch['cat']
+            # box = box.cpu().numpy()
+            # cat = cat.cpu().numpy()
 
-        # all_results['dataset_val'].append(
-        #     np.concatenate([batch['box_cond'].cpu().numpy(),
-        #                     np.expand_dims(batch['cat'].cpu().numpy(), -1)], axis=-1))
-        # all_results['predicted_val'].append(
-        #     np.concatenate([box, np.expand_dims(cat, -1)], axis=-1))
-        # if config.save:
-        #     for b in range(box.shape[0]):
-        #         tmp_box = box[b]
-        #         tmp_cat = cat[b]
-        #         tmp_box = tmp_box[~(tmp_box == 0.).all(1)]
-        #         tmp_cat = tmp_cat[~(tmp_cat == 0)]
-        #         tmp_box = (tmp_box / 2 + 1) / 2
-        #         canvas = draw_layout_opacity(tmp_box, tmp_cat, None, val_data.idx2color_map, height=512)
-        #         Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{str(i)}_{str(b)}.jpg')
-        #         tmp_box = batch['box_cond'][b].cpu().numpy()
-        #         tmp_cat = batch['cat'][b].cpu().numpy()
-        #         tmp_box = tmp_box[~(tmp_box == 0.).all(1)]
-        #         tmp_cat = tmp_cat[~(tmp_cat == 0)]
-        #         tmp_box = (tmp_box / 2 + 1) / 2
-        #         canvas = draw_layout_opacity(tmp_box, tmp_cat, None, val_data.idx2color_map, height=512)
-        #         Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{str(i)}_{str(b)}_gt.jpg')
-        #i += 1
-    # pickle results
-    # with open(config.optimizer.samples_dir / f'results_{config.cond_type}.pkl', 'wb') as f:
-    #     pickle.dump(all_results, f)
-    all_results["ids"] = id_data
-    all_results["dataset_val"] = real_data
-    all_results["predicted_val"] = pred_data
-    all_results["iou"] = iou_data
+            # all_results['dataset_val'].append(
+            #     np.concatenate([batch['box_cond'].cpu().numpy(),
+            #                     np.expand_dims(batch['cat'].cpu().numpy(), -1)], axis=-1))
+            # all_results['predicted_val'].append(
+            #     np.concatenate([box, np.expand_dims(cat, -1)], axis=-1))
+            # if config.save:
+            #     for b in range(box.shape[0]):
+            #         tmp_box = box[b]
+            #         tmp_cat = cat[b]
+            #         tmp_box = tmp_box[~(tmp_box == 0.).all(1)]
+            #         tmp_cat = tmp_cat[~(tmp_cat == 0)]
+            #         tmp_box = (tmp_box / 2 + 1) / 2
+            #         canvas = draw_layout_opacity(tmp_box, tmp_cat, None, val_data.idx2color_map, height=512)
+            #         Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{str(i)}_{str(b)}.jpg')
+            #         tmp_box = batch['box_cond'][b].cpu().numpy()
+            #         tmp_cat = batch['cat'][b].cpu().numpy()
+            #         tmp_box = tmp_box[~(tmp_box == 0.).all(1)]
+            #         tmp_cat = tmp_cat[~(tmp_cat == 0)]
+            #         tmp_box = (tmp_box / 2 + 1) / 2
+            #         canvas = draw_layout_opacity(tmp_box, tmp_cat, None, val_data.idx2color_map, height=512)
+            #         Image.fromarray(canvas).save(config.optimizer.samples_dir / f'{str(i)}_{str(b)}_gt.jpg')
+            #i += 1
+        # pickle results
+        # with open(config.optimizer.samples_dir / f'results_{config.cond_type}.pkl', 'wb') as f:
+        #     pickle.dump(all_results, f)
+    # peak device memory of the sampling loop and host RSS of this process and its DataLoader workers
+    memory = {**device_memory(accelerator.device), **host_memory()}
+    LOG.info(f"Process {accelerator.process_index} memory: {format_memory(memory)}")
+    # per layout lists in dataset order, the same for any number of processes
+    results = gather_in_order(accelerator, records)
+    if accelerator.is_main_process:
+        for key in all_results:
+            all_results[key] = [result[key] for result in results]
+        mean_iou = torch.cat(all_results["iou"]).mean().item()
+        LOG.info(f"{len(results)} layouts, mean IoU {mean_iou:.4f}")
+        wandb.log({"mean_iou": mean_iou, **{f"mem_{k}_mb": v for k, v in memory.items()}})
 
-    with open(config.dataset_path / f'inference_canva.pkl', 'wb') as f:
-        pickle.dump(all_results, f)
-        
-    wandb.finish()
+        with open(config.dataset_path / f'inference_canva.pkl', 'wb') as f:
+            pickle.dump(all_results, f)
+            
+        wandb.finish()
 
 
 def init_job():
@@ -1,4 +1,5 @@
 import os
+import time
 import torch
 from logger_set import LOG
 from absl import flags, app
@@ -7,14 +8,17 @@ from accelerate import Accelerator
 import wandb
 from ml_collections import config_flags
 from models.dlt import DLT
-from models.CAL import CAL_6, CAL_4
+from models.CAL import CAL_6, CAL_4, build_model
 from trainers.dlt_trainer import TrainLoopDLT
 from trainers.cal_trainer import TrainLoopCAL
-from utils import set_seed
+from utils import set_seed, process_memory, format_memory
 from data_loaders.publaynet import PublaynetLayout
-from data_loaders.rico import RicoLayout
+from data_loaders.rico import RicoLayout, prepare_rico
 from data_loaders.magazine import MagazineLayout
 from data_loaders.canva import CanvaLayout
+from data_loaders.canva_stream import CanvaLayoutStream
+from data_loaders.feature_codec import build_feature_codec
+from data_loaders.shared_memory import node_shared
 
 
 FLAGS = flags.FLAGS
@@ -27,33 +31,56 @@ flags.mark_flags_as_required(["config"])
 
 def main(*args, **kwargs):
     config = init_job()
+    accelerator = Accelerator(
+        split_batches=config.optimizer.split_batches, #큰 배치를 더 작은 배치로 나누는 역할 
+        gradient_accumulation_steps=config.optimizer.gradient_accumulation_steps, #여러 배치에 걸쳐 그래디언트를 누적한 다음 업데이트를 수행
+        mixed_precision=config.optimizer.mixed_precision, #혼합 정밀도 훈련은 계산 효율성을 높이기 위해 부동 소수점 연산에 다른 정밀도(예: float16과 float32)를 혼합 사용
+        project_dir=config.log_dir, #logs폴더가 project dir가 되고 workdir가 test라 logs/test가 working directory가 되는것!
+    )
+    LOG.info(accelerator.state)
+
     LOG.info("Loading data.")
+    start = time.time()
+
+    def shared(build, name):
+        # built once per node by the local main process, the other local ranks map it read only
+        return node_shared(build, name, accelerator) if config.get('shared_dataset', False) else build()
 
     if config.dataset == 'publaynet':
         train_data = PublaynetLayout(config.train_json, max_num_com=config.max_num_comp)
         val_data = PublaynetLayout(config.val_json, train_data.max_num_comp)
     elif config.dataset == 'rico':
-        train_data = RicoLayout(config.dataset_path, 'train', max_num_comp=config.max_num_comp)
-        val_data = RicoLayout(config.dataset_path, 'val', train_data.max_num_comp)
+        prepare_rico(config.dataset_path, config.max_num_comp, accelerator)
+        train_data = shared(lambda: RicoLayout(config.dataset_path, 'train', max_num_comp=config.max_num_comp),
+                            'rico-train')
+        val_data = shared(lambda: RicoLayout(config.dataset_path, 'val', train_data.max_num_comp), 'rico-val')
     elif config.dataset == 'magazine':
         train_data = MagazineLayout(config.train_json, max_num_com=config.max_num_comp)
         val_data = MagazineLayout(config.val_json, train_data.max_num_comp)
     elif config.dataset == 'canva':
-        train_data = CanvaLayout(config.train_json, config.train_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0)
-        val_data = CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0)
+        # clip features are kept compressed in memory (config.feature_codec), fitted on the training set
+        if config.get('stream', False):
+            # the training export is streamed instead of loaded (see CanvaLayoutStream)
+            train_data = CanvaLayoutStream(config.train_json, config.train_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0,
+                                           feature_codec=build_feature_codec(config.get('feature_codec')),
+                                           shuffle_buffer=config.stream_shuffle_buffer, num_slides=config.stream_num_slides, seed=config.seed)
+            if not train_data.feature_codec.fitted:
+                train_data.fit_feature_codec()
+        else:
+            train_data = shared(lambda: CanvaLayout(config.train_json, config.train_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0,
+                                                    feature_codec=build_feature_codec(config.get('feature_codec')), cache_dir=config.get('cache_dir'), seed=config.seed), 'canva-train')
+        val_data = shared(lambda: CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0,
+                                              feature_codec=train_data.feature_codec, cache_dir=config.get('cache_dir'), seed=config.seed), 'canva-val')
+        if accelerator.is_main_process:
+            train_data.feature_codec.save(config.log_dir / 'feature_codec.npz')
     else:
         raise NotImplementedError
+    LOG.info(f"Process {accelerator.process_index}: datasets ready in {time.time() - start:.1f}s, "
+             f"{format_memory(process_memory())}")
     # print("#############################################")
     # print("train_data: ", train_data)
     # print("#############################################")
     #assert config.categories_num == train_data.categories_num
-    accelerator = Accelerator(
-        split_batches=config.optimizer.split_batches, #큰 배치를 더 작은 배치로 나누는 역할 
-        gradient_accumulation_steps=config.optimizer.gradient_accumulation_steps, #여러 배치에 걸쳐 그래디언트를 누적한 다음 업데이트를 수행
-        mixed_precision=config.optimizer.mixed_precision, #혼합 정밀도 훈련은 계산 효율성을 높이기 위해 부동 소수점 연산에 다른 정밀도(예: float16과 float32)를 혼합 사용
-        project_dir=config.log_dir, #logs폴더가 project dir가 되고 workdir가 test라 logs/test가 working directory가 되는것!
-    )
-    LOG.info(accelerator.state)
 
     LOG.info("Creating model and diffusion process...")
     # model = DLT(categories_num=config.categories_num, latent_dim=config.latent_dim,
@@ -61,10 +88,9 @@ def main(*args, **kwargs):
     #             activation='gelu', cond_emb_size=config.cond_emb_size,
     #             cat_emb_size=config.cls_emb_size).to(accelerator.device)
     
-    if config.rz_ox == True:
-        model = CAL_6().to(accelerator.device)
-    else:
-        model = CAL_4().to(accelerator.device)    
+    # init_checkpoint: start from given weights/architecture, e.g. fine-tuning a pruned model
+    model = build_model(config.rz_ox, config.get('init_checkpoint'),
+                        **config.get('model_kwargs', {})).to(accelerator.device)
     
     noise_scheduler = GeometryDiffusionScheduler(seq_max_length=config.max_num_comp,
                                               device=accelerator.device,
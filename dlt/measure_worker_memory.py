@@ -0,0 +1,84 @@
+import json
+import os
+
+import psutil
+from absl import flags, app
+from ml_collections import config_flags
+from torch.utils.data import DataLoader
+
+from data_loaders.canva import CanvaLayout
+from logger_set import LOG
+from utils import set_seed, custom_collate_fn, process_memory, format_memory
+
+FLAGS = flags.FLAGS
+config_flags.DEFINE_config_file("config", "Training configuration.",
+                                lock_config=False)
+flags.DEFINE_string("workdir", default='test', help="Work unit directory.")
+flags.DEFINE_enum("split", default='train', enum_values=['train', 'val'], help="Dataset split to iterate.")
+flags.DEFINE_integer("num_workers", default=None, help="DataLoader workers, defaults to config.optimizer.num_workers.")
+flags.DEFINE_integer("interval", default=50, help="Batches between two memory samples.")
+flags.DEFINE_integer("max_batches", default=0, help="Stop after this many batches (0: one full epoch).")
+flags.mark_flags_as_required(["config"])
+
+
+def sample_memory(step):
+    """Memory of the main process and of every DataLoader worker (the children of this process)."""
+    workers = {}
+    for child in psutil.Process().children():
+        try:
+            workers[child.pid] = process_memory(child.pid)
+        except psutil.NoSuchProcess:
+            pass
+    return {"batch": step, "main": process_memory(), "workers": workers}
+
+
+def main(*args, **kwargs):
+    """
+    Iterate an epoch of the training DataLoader without a model and track the memory of every worker.
+    Copy-on-read shows as uss (memory private to the worker) growing over the epoch while pss stays flat.
+    """
+    config = init_job()
+    LOG.info("Loading data.")
+    json_path, clip_json_path = (config.train_json, config.train_clip_json) if FLAGS.split == 'train' else \
+        (config.val_json, config.val_clip_json)
+    data = CanvaLayout(json_path, clip_json_path, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+    num_workers = config.optimizer.num_workers if FLAGS.num_workers is None else FLAGS.num_workers
+    loader = DataLoader(data, batch_size=config.optimizer.batch_size, shuffle=True, collate_fn=custom_collate_fn,
+                        num_workers=num_workers)
+    LOG.info(f"{len(data)} samples, {num_workers} workers, main process: {format_memory(process_memory())}")
+
+    samples = []
+    for step, _ in enumerate(loader):
+        if step % FLAGS.interval == 0:
+            samples.append(sample_memory(step))
+            LOG.info(f"batch {step}: main {format_memory(samples[-1]['main'])}; " + "; ".join(
+                f"worker {pid} {format_memory(memory)}" for pid, memory in samples[-1]['workers'].items()))
+        if FLAGS.max_batches and step + 1 >= FLAGS.max_batches:
+            break
+    samples.append(sample_memory(step))
+
+    # growth of every worker between its first and last sample
+    first, last = {}, {}
+    for sample in samples:
+        for pid, memory in sample['workers'].items():
+            first.setdefault(pid, memory)
+            last[pid] = memory
+    summary = {pid: {f"{k}_growth": last[pid][k] - first[pid][k] for k in first[pid]} for pid in first}
+    for pid, growth in summary.items():
+        LOG.info(f"worker {pid}: " + ", ".join(f"{k} {v:+.0f} MiB" for k, v in growth.items()))
+
+    with open(config.log_dir / 'worker_memory.json', 'w') as f:
+        json.dump({"num_workers": num_workers, "samples": samples, "growth": summary}, f, indent=2)
+    LOG.info(f"Saved measurements to {config.log_dir / 'worker_memory.json'}")
+
+
+def init_job():
+    config = FLAGS.config
+    config.log_dir = config.log_dir / FLAGS.workdir
+    os.makedirs(config.log_dir, exist_ok=True)
+    set_seed(config.seed)
+    return config
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -3,14 +3,16 @@ import torch.nn as nn
 from diffusers import ModelMixin, ConfigMixin
 from diffusers.configuration_utils import register_to_config
 from einops import rearrange
+from path import Path
+from safetensors.torch import load_model
 
-from models.utils import PositionalEncoding, TimestepEmbedder
+from models.utils import PositionalEncoding, TimestepEmbedder, PrunedSelfAttention
 
 
 class CAL_6(ModelMixin, ConfigMixin):
     @register_to_config
     def __init__(self, latent_dim=512, num_layers=4, num_heads=8, dropout_r=0., activation="gelu",
-                 geometry_dim=256):
+                 geometry_dim=256, layer_heads=None):
         super().__init__()
         self.latent_dim = latent_dim
         self.dropout_r = dropout_r
@@ -25,6 +27,7 @@ class CAL_6(ModelMixin, ConfigMixin):
         self.seqTransEncoder = nn.TransformerEncoder(seqTransEncoderLayer,
                                                      num_layers=num_layers,
                                                      )
+        set_layer_heads(self.seqTransEncoder, layer_heads, self.latent_dim // num_heads)
 
         self.embed_timestep = TimestepEmbedder(self.latent_dim, self.seq_pos_enc)
 
@@ -101,7 +104,7 @@ class CAL_6(ModelMixin, ConfigMixin):
         
         padding_mask = (sample["padding_mask"] == 0)
         key_padding_mask = padding_mask.any(dim=2)
-        additional_column = torch.zeros(key_padding_mask.shape[0], 1, dtype=torch.bool).cuda()
+        additional_column = torch.zeros(key_padding_mask.shape[0], 1, dtype=torch.bool, device=key_padding_mask.device)
         key_padding_mask = torch.cat([additional_column, key_padding_mask], dim=1)
         
 
@@ -150,13 +153,13 @@ from diffusers import ModelMixin, ConfigMixin
 from diffusers.configuration_utils import register_to_config
 from einops import rearrange
 
-from models.utils import PositionalEncoding, TimestepEmbedder
+from models.utils import PositionalEncoding, TimestepEmbedder, PrunedSelfAttention
 
 
 class CAL_4(ModelMixin, ConfigMixin):
     @register_to_config
     def __init__(self, latent_dim=576, num_layers=16, num_heads=16, dropout_r=0., activation="gelu",
-                 geometry_dim=256, is_cond=False):
+                 geometry_dim=256, is_cond=False, layer_heads=None):
         super().__init__()
         self.latent_dim = latent_dim
         self.dropout_r = dropout_r
@@ -171,6 +174,7 @@ class CAL_4(ModelMixin, ConfigMixin):
         self.seqTransEncoder = nn.TransformerEncoder(seqTransEncoderLayer,
                                                      num_layers=num_layers,
                                                      )
+        set_layer_heads(self.seqTransEncoder, layer_heads, self.latent_dim // num_heads)
 
         self.embed_timestep = TimestepEmbedder(self.latent_dim, self.seq_pos_enc)
 
@@ -238,7 +242,7 @@ class CAL_4(ModelMixin, ConfigMixin):
         
         padding_mask = (sample["padding_mask"] == 0)
         key_padding_mask = padding_mask.any(dim=2)
-        additional_column = torch.zeros(key_padding_mask.shape[0], 1, dtype=torch.bool).cuda()
+        additional_column = torch.zeros(key_padding_mask.shape[0], 1, dtype=torch.bool, device=key_padding_mask.device)
         key_padding_mask = torch.cat([additional_column, key_padding_mask], dim=1)
         # print("#############################################################################")
         # print("padding_mask: ", key_padding_mask, key_padding_mask.shape)
@@ -279,3 +283,30 @@ class CAL_4(ModelMixin, ConfigMixin):
 
 
 
+
+
+def set_layer_heads(encoder, layer_heads, head_dim):
+    """Shrink the self-attention of each encoder layer to `layer_heads[i]` heads (pruned checkpoints)."""
+    if layer_heads is None:
+        return
+    assert len(layer_heads) == len(encoder.layers), "one head count per encoder layer"
+    for layer, num_heads in zip(encoder.layers, layer_heads):
+        if num_heads != layer.self_attn.num_heads:
+            layer.self_attn = PrunedSelfAttention(layer.self_attn.embed_dim, num_heads, head_dim,
+                                                  layer.self_attn.dropout)
+
+
+def build_model(rz_ox, checkpoint_dir=None, **model_kwargs):
+    """
+    Create CAL_6 (rz_ox) or CAL_4.
+    If `checkpoint_dir` holds a config.json the architecture is taken from it, and
+    model.safetensors in it is loaded when present.
+    """
+    model_cls = CAL_6 if rz_ox else CAL_4
+    if checkpoint_dir is not None and (Path(checkpoint_dir) / "config.json").exists():
+        model = model_cls.from_config(model_cls.load_config(checkpoint_dir))
+    else:
+        model = model_cls(**model_kwargs)
+    if checkpoint_dir is not None and (Path(checkpoint_dir) / "model.safetensors").exists():
+        load_model(model, Path(checkpoint_dir) / "model.safetensors", strict=True)
+    return model
@@ -1,27 +1,110 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
 import torch
 import clip
-from einops import rearrange
+
+from data_loaders.feature_store import FeatureStore
+
 
 class CLIPModule(torch.nn.Module):
-    def __init__(self, device='cpu'):
+    """
+    CLIP ViT-B/32 image encoder for padded element batches.
+    Identical images are encoded once: features are keyed by content hash in a bounded in-memory LRU and,
+    if `cache_dir` is given, an on-disk FeatureStore shared across runs.
+    """
+    feature_dim = 512
+
+    def __init__(self, device='cpu', cache_size=4096, cache_dir=None):
         super(CLIPModule, self).__init__()
         # CLIP 모델 로드
-        self.clip_model, _ = clip.load("ViT-B/32", device=device)
+        self.clip_model, self.preprocess = clip.load("ViT-B/32", device=device)
         self.device = device
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # hash -> float16 cpu tensor
+        self.disk_cache = FeatureStore(cache_dir, dim=self.feature_dim, mode='a') if cache_dir else None
+        self.stats = {"hits": 0, "encoded": 0}
 
-    def forward(self, sample):
-        # sample에서 이미지 데이터 추출
-        # 이미지 데이터는 [batch, element, 3, 224, 224] 형태를 가정
-        images = sample['image'].to(self.device)
+    @staticmethod
+    def content_hash(image):
+        """sha1 of raw file bytes or of a preprocessed image tensor."""
+        if not isinstance(image, (bytes, bytearray)):
+            image = image.detach().cpu().contiguous().numpy().tobytes()
+        return hashlib.sha1(image).hexdigest()
+
+    def _remember(self, key, feature):
+        self.cache[key] = feature
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
 
-        # 이미지 데이터를 CLIP에 맞게 재배열: [batch * element, 3, 224, 224]
-        images_flat = rearrange(images, 'b e c h w -> (b e) c h w')
+    def _lookup(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if self.disk_cache is not None and key in self.disk_cache:
+            feature = torch.from_numpy(np.array(self.disk_cache.get(key)))
+            self._remember(key, feature)
+            return feature
+        return None
 
-        # CLIP 모델을 사용하여 이미지 인코딩
-        with torch.no_grad():
-            image_features = self.clip_model.encode_image(images_flat)
+    def flush_cache(self):
+        if self.disk_cache is not None:
+            self.disk_cache.commit()
+
+    def encode_images(self, images, hashes=None):
+        """
+        Encode a flat batch of preprocessed images [N, 3, 224, 224] into [N, 512] float32 features.
+        :param hashes: optional content hash per image (e.g. of the image file), computed from the tensors otherwise.
+        """
+        if hashes is None:
+            hashes = [self.content_hash(image) for image in images]
+        features = [self._lookup(key) for key in hashes]
+
+        # one forward per distinct missing image
+        missing = OrderedDict()
+        for i, (key, feature) in enumerate(zip(hashes, features)):
+            if feature is None:
+                missing.setdefault(key, []).append(i)
+        self.stats["hits"] += len(hashes) - sum(len(idx) for idx in missing.values())
+        if missing:
+            first = torch.tensor([idx[0] for idx in missing.values()], device=images.device)
+            with torch.no_grad():
+                encoded = self.clip_model.encode_image(images[first].to(self.device)).cpu().half()
+            for (key, idx), feature in zip(missing.items(), encoded):
+                self._remember(key, feature)
+                for i in idx:
+                    features[i] = feature
+            if self.disk_cache is not None:
+                self.disk_cache.add(list(missing.keys()), encoded.numpy())
+            self.stats["encoded"] += len(missing)
+
+        if not features:
+            return torch.zeros(0, self.feature_dim, device=self.device)
+        return torch.stack(features).to(self.device, torch.float32)
+
+    def forward(self, sample):
+        """
+        :param sample: dict with 'image' [batch, element, 3, 224, 224], optional 'padding_mask' ([batch, element] or
+                       the datasets' [batch, element, 6]) and optional 'image_hash' (nested lists, [batch][element]).
+        :return: [batch, element, 512] features, zero at padded elements.
+        """
+        images = sample['image']
+        b, e = images.shape[:2]
+        padding_mask = sample.get('padding_mask')
+        if padding_mask is None:
+            valid = torch.ones(b, e, dtype=torch.bool, device=images.device)
+        else:
+            valid = padding_mask != 0
+            valid = valid.any(dim=-1) if valid.dim() == 3 else valid
+            valid = valid.to(images.device)
 
-        # 인코딩된 이미지 특성의 차원을 [batch, element, feature_dim]으로 재배열
-        image_features = rearrange(image_features, '(b e) c -> b e c', b = 1) #sample['box'].shape[0])
+        hashes = None
+        if 'image_hash' in sample:
+            hashes = [key for row, row_valid in zip(sample['image_hash'], valid.tolist())
+                      for key, keep in zip(row, row_valid) if keep]
 
+        image_features = torch.zeros(b, e, self.feature_dim, device=self.device)
+        image_features[valid.to(self.device)] = self.encode_images(images[valid], hashes)
         return image_features
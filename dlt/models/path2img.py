@@ -1,19 +1,126 @@
-import cv2
-import os
-import glob
-from PIL import Image
+"""
+Offline CLIP feature extraction into a FeatureStore (float16 memmap + id -> row index).
+
+Walks <image_dir>/<ppt_name>/<image_file_name>, decodes/preprocesses the images in DataLoader workers and
+encodes them with CLIPModule in large batches. Ids are "ppt_name/image_file_name", the keys CanvaLayout uses.
+Already encoded ids are skipped, so an interrupted run resumes from the last commit.
+
+    python -m models.path2img --image_dir slide_image --out dataset/train_clip
+    python -m models.path2img --from_json dataset/train_clip.json --out dataset/train_clip
+"""
+import io
+import json
+import time
+
+import numpy as np
 import torch
-from models.clip_encoder import CLIPModule
+from absl import flags, app
 from PIL import Image
+from path import Path
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from data_loaders.feature_store import FeatureStore
+from logger_set import LOG
+from models.clip_encoder import CLIPModule
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("image_dir", default=None, help="Slide image directory (<ppt_name>/<image_file_name>).")
+flags.DEFINE_string("from_json", default=None, help="Convert an existing clip json instead of encoding images.")
+flags.DEFINE_string("out", default=None, help="Feature store directory.")
+flags.DEFINE_integer("batch_size", default=512, help="Images per CLIP forward.")
+flags.DEFINE_integer("num_workers", default=8, help="Image decoding workers.")
+flags.DEFINE_integer("commit_every", default=20, help="Batches between index commits.")
+flags.DEFINE_string("cache_dir", default=None, help="On-disk CLIP embedding cache keyed by file content hash.")
+flags.DEFINE_string("device", default='cuda' if torch.cuda.is_available() else 'cpu', help="CLIP device.")
+flags.mark_flags_as_required(["out"])
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+
+def list_images(image_dir):
+    """Ids of all element images below `image_dir` (slide backgrounds are skipped)."""
+    image_dir = Path(image_dir)
+    ids = []
+    for ppt_dir in sorted(image_dir.dirs()):
+        for file in sorted(ppt_dir.files()):
+            if file.ext.lower() in IMAGE_EXTENSIONS and not file.name.endswith('_backgorund.png'):
+                ids.append(f"{ppt_dir.name}/{file.name}")
+    return ids
+
+
+class ImageFiles(Dataset):
+    def __init__(self, image_dir, ids, preprocess):
+        self.image_dir = Path(image_dir)
+        self.ids = ids
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        try:
+            with open(self.image_dir / self.ids[idx], 'rb') as f:
+                content = f.read()
+            image = Image.open(io.BytesIO(content)).convert('RGB')
+        except OSError:
+            # unreadable file, dropped by the main loop
+            return torch.zeros(3, 224, 224), -1, ''
+        # file hash lets CLIPModule encode assets repeated across presentations only once
+        return self.preprocess(image), idx, CLIPModule.content_hash(content)
+
 
-image_path = 'slide_image'  # 폴더 경로 설정
-slide_images = {}  # 슬라이드 번호별 이미지 저장을 위한 딕셔너리
+def convert_clip_json(json_path, store):
+    with open(json_path, 'r') as f:
+        clip_data = json.load(f)
+    keys, features = [], []
+    for ppt_name, images in clip_data.items():
+        for image_file_name, feature in images.items():
+            key = f"{ppt_name}/{image_file_name}"
+            if key not in store:
+                keys.append(key)
+                features.append(np.asarray(feature, dtype=np.float32).reshape(-1))
+    if keys:
+        store.add(keys, np.stack(features))
+    store.commit()
+    LOG.info(f"Converted {len(keys)} features from {json_path}.")
 
-clipmodule = CLIPModule()
-image_path = "slide_image/"
 
+def encode_images(image_dir, store):
+    ids = [key for key in list_images(image_dir) if key not in store]
+    LOG.info(f"{len(store)} images already encoded, {len(ids)} to encode.")
+    if not ids:
+        return
+    store.reserve(len(store) + len(ids))
 
+    clip_module = CLIPModule(device=FLAGS.device, cache_dir=FLAGS.cache_dir)
+    loader = DataLoader(ImageFiles(image_dir, ids, clip_module.preprocess), batch_size=FLAGS.batch_size,
+                        shuffle=False, num_workers=FLAGS.num_workers, pin_memory=FLAGS.device != 'cpu')
+    start = time.time()
+    for step, (images, idx, hashes) in enumerate(tqdm(loader)):
+        valid = idx >= 0
+        if valid.any():
+            hashes = [key for key, keep in zip(hashes, valid.tolist()) if keep]
+            features = clip_module.encode_images(images[valid], hashes).cpu().numpy()
+            store.add([ids[i] for i in idx[valid].tolist()], features)
+        if step % FLAGS.commit_every == FLAGS.commit_every - 1:
+            store.commit()
+            clip_module.flush_cache()
+    store.commit()
+    clip_module.flush_cache()
+    elapsed = time.time() - start
+    LOG.info(f"Encoded {len(ids)} images in {elapsed:.1f}s ({len(ids) / max(elapsed, 1e-9):.1f} images/s), "
+             f"{clip_module.stats['encoded']} CLIP forwards, {clip_module.stats['hits']} cache hits.")
 
 
+def main(*args, **kwargs):
+    store = FeatureStore(FLAGS.out, dim=512, mode='a')
+    if FLAGS.from_json:
+        convert_clip_json(FLAGS.from_json, store)
+    else:
+        assert FLAGS.image_dir, "--image_dir or --from_json is required"
+        encode_images(FLAGS.image_dir, store)
 
 
+if __name__ == '__main__':
+    app.run(main)
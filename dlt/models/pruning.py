@@ -0,0 +1,145 @@
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+from evaluation.iou import transform, get_mean_iou
+from models.utils import PrunedSelfAttention
+
+
+def fixed_eval_batches(data_loader, num_batches, device, diffusion, geometry_scale, seed=0, feature_codec=None):
+    """First `num_batches` batches with fixed timesteps and noise, so every pruning candidate is scored on the same inputs."""
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for step, (batch, ids) in enumerate(data_loader):
+        if step >= num_batches:
+            break
+        shape = batch['geometry'].shape
+        batch['t'] = torch.randint(0, diffusion.num_cont_steps, (shape[0],), generator=generator)
+        batch['noise'] = torch.randn(shape, generator=generator) * geometry_scale.view(1, 1, 6)
+        batch = {k: v.to(device) for k, v in batch.items()}
+        if feature_codec is not None:
+            batch['image_features'] = feature_codec.decode(batch)
+        batches.append(batch)
+    return batches
+
+
+@torch.no_grad()
+def denoising_iou(model, batches, diffusion, scaling_size, mean_0):
+    """Mean IoU of the one-step x_0 reconstruction over `batches` (see fixed_eval_batches)."""
+    model.eval()
+    ious = []
+    for batch in batches:
+        noisy_geometry = diffusion.add_noise_Geometry(batch['geometry'], batch['t'], batch['noise']) * batch['padding_mask']
+        noisy_batch = {"geometry": noisy_geometry, "image_features": batch['image_features']}
+        model_output = model(batch, noisy_batch, batch['t'])
+        pred_geometry = diffusion.predict_original(model_output, batch['t'], noisy_geometry) * batch['padding_mask']
+        true_box, pred_box = transform(batch['geometry'], pred_geometry, scaling_size, batch['padding_mask'], mean_0)
+        ious.append(get_mean_iou(true_box, pred_box))
+    return sum(ious) / len(ious)
+
+
+@torch.no_grad()
+def forward_latency(model, batches, repeats=5):
+    """Average seconds per model forward over `batches`."""
+    model.eval()
+    device = batches[0]['geometry'].device
+    timings = []
+    for r in range(repeats + 1):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for batch in batches:
+            model(batch, {"geometry": batch['noise'], "image_features": batch['image_features']}, batch['t'])
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if r > 0:  # first pass is warm up
+            timings.append((time.perf_counter() - start) / len(batches))
+    return sum(timings) / len(timings)
+
+
+def _head_columns(attn, head):
+    return slice(head * attn.head_dim, (head + 1) * attn.head_dim)
+
+
+def score_layers(model, eval_fn):
+    """Importance of every encoder layer: IoU lost when the layer is skipped."""
+    encoder = model.seqTransEncoder
+    layers = encoder.layers
+    baseline = eval_fn(model)
+    scores = []
+    for i in range(len(layers)):
+        encoder.layers = nn.ModuleList([layer for j, layer in enumerate(layers) if j != i])
+        scores.append(baseline - eval_fn(model))
+    encoder.layers = layers
+    return scores
+
+
+def score_heads(model, eval_fn, method='ablation'):
+    """
+    Importance of every attention head, as a list (per layer) of lists (per head).
+    ablation: IoU lost when the head output is zeroed.
+    weight_norm: data free proxy, ||W_v[head]|| * ||W_out[:, head]||.
+    """
+    baseline = eval_fn(model) if method == 'ablation' else None
+    scores = []
+    for layer in model.seqTransEncoder.layers:
+        attn = layer.self_attn
+        inner_dim = attn.num_heads * attn.head_dim
+        layer_scores = []
+        for head in range(attn.num_heads):
+            columns = _head_columns(attn, head)
+            if method == 'ablation':
+                saved = attn.out_proj.weight.data[:, columns].clone()
+                attn.out_proj.weight.data[:, columns] = 0
+                layer_scores.append(baseline - eval_fn(model))
+                attn.out_proj.weight.data[:, columns] = saved
+            elif method == 'weight_norm':
+                w_v = attn.in_proj_weight.data[2 * inner_dim:][columns]
+                layer_scores.append((w_v.norm() * attn.out_proj.weight.data[:, columns].norm()).item())
+            else:
+                raise NotImplementedError(method)
+        scores.append(layer_scores)
+    return scores
+
+
+def prune_layers(model, drop_layers):
+    """Copy of `model` without the encoder layers in `drop_layers`; the model config is updated accordingly."""
+    model = copy.deepcopy(model)
+    encoder = model.seqTransEncoder
+    encoder.layers = nn.ModuleList([layer for i, layer in enumerate(encoder.layers) if i not in drop_layers])
+    encoder.num_layers = len(encoder.layers)
+    layer_heads = [layer.self_attn.num_heads for layer in encoder.layers]
+    model.register_to_config(num_layers=encoder.num_layers, layer_heads=layer_heads)
+    return model
+
+
+def prune_heads(model, drop_heads):
+    """Copy of `model` without the (layer, head) pairs in `drop_heads`; every layer keeps at least one head."""
+    model = copy.deepcopy(model)
+    layer_heads = []
+    for i, layer in enumerate(model.seqTransEncoder.layers):
+        attn = layer.self_attn
+        keep = [h for h in range(attn.num_heads) if (i, h) not in drop_heads]
+        assert len(keep) > 0, f"all heads of layer {i} would be removed"
+        if len(keep) < attn.num_heads:
+            layer.self_attn = PrunedSelfAttention.from_attention(attn, keep)
+        layer_heads.append(len(keep))
+    model.register_to_config(num_layers=len(layer_heads), layer_heads=layer_heads)
+    return model
+
+
+def lowest_heads(head_scores, num_heads):
+    """The `num_heads` lowest scoring (layer, head) pairs, never taking the last head of a layer."""
+    candidates = sorted((score, i, h) for i, layer_scores in enumerate(head_scores)
+                        for h, score in enumerate(layer_scores))
+    remaining = [len(layer_scores) for layer_scores in head_scores]
+    drop = set()
+    for score, i, h in candidates:
+        if len(drop) == num_heads:
+            break
+        if remaining[i] > 1:
+            drop.add((i, h))
+            remaining[i] -= 1
+    return drop
@@ -1,6 +1,9 @@
+import math
+
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class PositionalEncoding(nn.Module):
@@ -39,3 +42,62 @@ class TimestepEmbedder(nn.Module):
     
     #self.seq_pos_ence.pe[timesteps]
 
+
+class PrunedSelfAttention(nn.Module):
+    """
+    Drop-in replacement for the nn.MultiheadAttention self-attention of a (sequence first) nn.TransformerEncoderLayer
+    with an arbitrary number of heads of fixed size, so heads can be removed from a trained layer.
+    Parameter names match nn.MultiheadAttention.
+    """
+    def __init__(self, embed_dim, num_heads, head_dim, dropout=0.):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.dropout = dropout
+        # read by the nn.TransformerEncoder(Layer) fast path checks
+        self.batch_first = False
+        self._qkv_same_embed_dim = True
+
+        inner_dim = num_heads * head_dim
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * inner_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * inner_dim))
+        self.out_proj = nn.Linear(inner_dim, embed_dim)
+        nn.init.xavier_uniform_(self.in_proj_weight)
+
+    @classmethod
+    def from_attention(cls, attn, keep_heads):
+        """Copy of `attn` (nn.MultiheadAttention or PrunedSelfAttention) keeping only `keep_heads`."""
+        head_dim = attn.head_dim
+        inner_dim = attn.num_heads * head_dim
+        rows = torch.cat([torch.arange(h * head_dim, (h + 1) * head_dim) for h in keep_heads])
+        qkv_rows = torch.cat([rows + j * inner_dim for j in range(3)])
+
+        pruned = cls(attn.embed_dim, len(keep_heads), head_dim, attn.dropout)
+        pruned.in_proj_weight.data.copy_(attn.in_proj_weight.data[qkv_rows])
+        pruned.in_proj_bias.data.copy_(attn.in_proj_bias.data[qkv_rows])
+        pruned.out_proj.weight.data.copy_(attn.out_proj.weight.data[:, rows])
+        pruned.out_proj.bias.data.copy_(attn.out_proj.bias.data)
+        return pruned.to(attn.out_proj.weight.device)
+
+    @staticmethod
+    def _apply_mask(scores, mask):
+        if mask.dtype == torch.bool:
+            return scores.masked_fill(mask, float('-inf'))
+        return scores + mask
+
+    def forward(self, query, key, value, key_padding_mask=None, need_weights=False, attn_mask=None, **kwargs):
+        L, N, _ = query.shape
+        q, k, v = F.linear(query, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        # [L, N, H * D] -> [N, H, L, D]
+        q, k, v = (x.reshape(L, N, self.num_heads, self.head_dim).permute(1, 2, 0, 3) for x in (q, k, v))
+
+        scores = q @ k.transpose(-2, -1) / math.sqrt(self.head_dim)
+        if attn_mask is not None:
+            scores = self._apply_mask(scores, attn_mask)
+        if key_padding_mask is not None:
+            scores = self._apply_mask(scores, key_padding_mask[:, None, None, :])
+        attn = F.dropout(scores.softmax(dim=-1), p=self.dropout, training=self.training)
+
+        output = (attn @ v).permute(2, 0, 1, 3).reshape(L, N, self.num_heads * self.head_dim)
+        return self.out_proj(output), None
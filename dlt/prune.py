@@ -0,0 +1,128 @@
+import json
+import os
+
+import torch
+import wandb
+from absl import flags, app
+from accelerate import Accelerator
+from ml_collections import config_flags
+from path import Path
+from torch.utils.data import DataLoader
+
+from data_loaders.canva import CanvaLayout
+from diffusion import GeometryDiffusionScheduler
+from logger_set import LOG
+from models.CAL import build_model
+from models.pruning import fixed_eval_batches, denoising_iou, forward_latency, score_layers, score_heads, \
+    prune_layers, prune_heads, lowest_heads
+from trainers.cal_trainer import TrainLoopCAL
+from utils import set_seed, custom_collate_fn
+
+from safetensors.torch import save_model
+
+FLAGS = flags.FLAGS
+config_flags.DEFINE_config_file("config", "Training configuration.",
+                                lock_config=False)
+flags.DEFINE_string("workdir", default='test', help="Work unit directory.")
+flags.DEFINE_string("checkpoint", default=None, help="Checkpoint directory of the model to prune.")
+flags.DEFINE_string("out", default=None, help="Output directory, defaults to <checkpoint>-pruned.")
+flags.DEFINE_integer("prune_layers", default=4, help="Number of encoder layers to remove.")
+flags.DEFINE_integer("prune_heads", default=0, help="Number of attention heads to remove (after layer pruning).")
+flags.DEFINE_enum("head_score", default='ablation', enum_values=['ablation', 'weight_norm'],
+                  help="How attention heads are scored.")
+flags.DEFINE_integer("eval_batches", default=8, help="Validation batches used for scoring and reporting.")
+flags.DEFINE_integer("finetune_epochs", default=0, help="Epochs of TrainLoopCAL fine-tuning after pruning.")
+flags.mark_flags_as_required(["config", "checkpoint"])
+
+
+def main(*args, **kwargs):
+    config = init_job()
+    device = config.device
+    LOG.info("Loading data.")
+    val_data = CanvaLayout(config.val_json, config.val_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+    val_loader = DataLoader(val_data, batch_size=config.optimizer.batch_size,
+                            shuffle=False, collate_fn=custom_collate_fn, num_workers=config.optimizer.num_workers)
+
+    model = build_model(config.rz_ox, FLAGS.checkpoint, **config.get('model_kwargs', {})).to(device)
+    noise_scheduler = GeometryDiffusionScheduler(seq_max_length=config.max_num_comp,
+                                                 device=device,
+                                                 num_train_timesteps=config.num_cont_timesteps,
+                                                 beta_schedule=config.beta_schedule,
+                                                 prediction_type=config.diffusion_mode,
+                                                 clip_sample=False, )
+    geometry_scale = torch.tensor([config.scaling_size, config.scaling_size, config.scaling_size, config.scaling_size, 1, config.z_scaling_size])
+    batches = fixed_eval_batches(val_loader, FLAGS.eval_batches, device, noise_scheduler, geometry_scale, config.seed,
+                                 val_data.feature_codec)
+    eval_fn = lambda m: denoising_iou(m, batches, noise_scheduler, config.scaling_size, config.mean_0)
+
+    report = {"original": {"iou": eval_fn(model), "latency": forward_latency(model, batches),
+                           "params": sum(p.numel() for p in model.parameters())}}
+    LOG.info(f"original: {report['original']}")
+
+    if FLAGS.prune_layers > 0:
+        layer_scores = score_layers(model, eval_fn)
+        drop_layers = sorted(range(len(layer_scores)), key=lambda i: layer_scores[i])[:FLAGS.prune_layers]
+        report["layer_scores"] = layer_scores
+        report["dropped_layers"] = sorted(drop_layers)
+        LOG.info(f"layer scores: {layer_scores}, dropping {sorted(drop_layers)}")
+        model = prune_layers(model, drop_layers)
+
+    if FLAGS.prune_heads > 0:
+        head_scores = score_heads(model, eval_fn, FLAGS.head_score)
+        drop_heads = lowest_heads(head_scores, FLAGS.prune_heads)
+        report["head_scores"] = head_scores
+        report["dropped_heads"] = sorted(drop_heads)
+        LOG.info(f"dropping heads (layer, head): {sorted(drop_heads)}")
+        model = prune_heads(model, drop_heads)
+
+    report["pruned"] = {"iou": eval_fn(model), "latency": forward_latency(model, batches),
+                        "params": sum(p.numel() for p in model.parameters())}
+    LOG.info(f"pruned: {report['pruned']}")
+
+    if FLAGS.finetune_epochs > 0:
+        train_data = CanvaLayout(config.train_json, config.train_clip_json, max_num_com=config.max_num_comp, scaling_size=config.scaling_size, z_scaling_size = config.z_scaling_size, mean_0 = config.mean_0, cache_dir=config.get('cache_dir'), seed=config.seed)
+        accelerator = Accelerator(
+            split_batches=config.optimizer.split_batches,
+            gradient_accumulation_steps=config.optimizer.gradient_accumulation_steps,
+            mixed_precision=config.optimizer.mixed_precision,
+            project_dir=config.log_dir,
+        )
+        config.optimizer.num_epochs = FLAGS.finetune_epochs
+        loop = TrainLoopCAL(accelerator=accelerator, model=model, diffusion=noise_scheduler,
+                            train_data=train_data, val_data=val_data, opt_conf=config.optimizer,
+                            log_interval=config.log_interval, save_interval=config.save_interval,
+                            device=accelerator.device, diffusion_mode=config.diffusion_mode,
+                            scaling_size=config.scaling_size, z_scaling_size=config.z_scaling_size,
+                            mean_0=config.mean_0, loss_weight=config.loss_weight, is_cond=config.is_cond)
+        loop.train()
+        model = accelerator.unwrap_model(loop.model).to(device)
+        report["finetuned"] = {"iou": eval_fn(model), "latency": forward_latency(model, batches),
+                               "params": sum(p.numel() for p in model.parameters())}
+        LOG.info(f"finetuned: {report['finetuned']}")
+
+    out = Path(FLAGS.out or FLAGS.checkpoint.rstrip('/') + '-pruned')
+    out.makedirs_p()
+    save_model(model, out / "model.safetensors")
+    model.save_config(out)
+    with open(out / "prune_report.json", 'w') as f:
+        json.dump(report, f, indent=2)
+    final = report.get("finetuned", report["pruned"])
+    LOG.info(f"Saved pruned model to {out}: speedup x{report['original']['latency'] / final['latency']:.2f}, "
+             f"IoU {report['original']['iou']:.4f} -> {final['iou']:.4f}")
+
+
+def init_job():
+    config = FLAGS.config
+    config.log_dir = config.log_dir / FLAGS.workdir
+    config.optimizer.ckpt_dir = config.log_dir / 'checkpoints'
+    config.optimizer.samples_dir = config.log_dir / 'samples'
+    os.makedirs(config.optimizer.ckpt_dir, exist_ok=True)
+    set_seed(config.seed)
+    wandb.init(project='TEST' if FLAGS.workdir == 'test' else 'CAL_prune', name=FLAGS.workdir,
+               mode='disabled' if FLAGS.workdir == 'test' else 'online',
+               config={k: v for k, v in config.items() if k != 'optimizer'})
+    return config
+
+
+if __name__ == '__main__':
+    app.run(main)
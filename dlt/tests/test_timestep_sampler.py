@@ -0,0 +1,59 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from trainers.timestep_sampler import LossAwareTimestepSampler
+
+
+def trained_sampler(uniform_prob=0.01):
+    torch.manual_seed(0)
+    sampler = LossAwareTimestepSampler(1000, 'cpu', num_buckets=10, uniform_prob=uniform_prob, warmup=4)
+    for _ in range(20):
+        t = torch.randint(0, 1000, (64,))
+        # loss growing with t, so the buckets get clearly different probabilities
+        sampler.update(t, 0.1 + t.float() / 1000)
+    return sampler
+
+
+def expected_weight(sampler):
+    """E[w(t)] under the sampling distribution: sum over buckets of p(bucket) * w(bucket)."""
+    probs = sampler.bucket_probs()
+    weights = sampler.bucket_size.float() / (sampler.num_timesteps * probs)
+    return (probs * weights).sum().item(), probs
+
+
+@pytest.mark.parametrize("stratified", [True, False])
+def test_weights_average_to_one(stratified):
+    sampler = trained_sampler()
+    sampler.stratified = stratified
+    mean, probs = expected_weight(sampler)
+    assert mean == pytest.approx(1.0, rel=1e-5)
+    assert probs.max() > 2 * probs.min()
+
+    t, weights = sampler.sample(200_000)
+    assert t.min() >= 0 and t.max() < sampler.num_timesteps
+    assert weights.mean().item() == pytest.approx(1.0, rel=0.02)
+
+
+def test_zero_history_without_uniform_mixing():
+    sampler = LossAwareTimestepSampler(1000, 'cpu', num_buckets=10, uniform_prob=0., warmup=4)
+    # a resumed state with zeroed loss buffers
+    sampler.load_state_dict({"loss_sq": [0.] * 10, "seen": [100.] * 10})
+    t, weights = sampler.sample(4096)
+    assert torch.isfinite(weights).all()
+    assert expected_weight(sampler)[0] == pytest.approx(1.0, rel=1e-5)
+
+
+def test_state_round_trip():
+    sampler = trained_sampler()
+    restored = LossAwareTimestepSampler(1000, 'cpu', num_buckets=10, uniform_prob=0.01, warmup=4)
+    restored.load_state_dict(sampler.state_dict())
+    assert torch.equal(restored.loss_sq, sampler.loss_sq)
+    assert torch.equal(restored.seen, sampler.seen)
+    assert torch.allclose(restored.bucket_probs(), sampler.bucket_probs())
+
+    torch.manual_seed(1)
+    expected = sampler.sample(256)
+    torch.manual_seed(1)
+    actual = restored.sample(256)
+    assert torch.equal(actual[0], expected[0]) and torch.allclose(actual[1], expected[1])
@@ -1,7 +1,7 @@
 import math
 import os
 import random
-import shutil
+import time
 
 import numpy as np
 import torch
@@ -12,16 +12,23 @@ from accelerate import Accelerator
 from diffusers import get_scheduler
 
 from einops import repeat
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset
 from tqdm import tqdm
 
+from data_loaders.device_loader import DeviceLayoutLoader
+from data_loaders.samplers import EpochSampler
+from data_loaders.prefetcher import BatchPrefetcher
+from trainers.eval_service import EvalService
+from trainers.timestep_sampler import build_timestep_sampler
+from trainers.checkpoint import CheckpointManager, load_checkpoint, load_trainer_state, latest_checkpoint, epoch_position
 from data_loaders.data_utils import mask_loc, mask_size, mask_whole_box, mask_random_box_and_cat, mask_all
 from diffusion import JointDiffusionScheduler, GeometryDiffusionScheduler
 
-from evaluation.iou import transform, print_results, get_iou, get_mean_iou
+from evaluation.iou import transform, print_results, get_iou, get_mean_iou, masked_iou_sum
 
 from logger_set import LOG
-from utils import masked_l2, masked_l2_rz,masked_cross_entropy, masked_acc, plot_sample, custom_collate_fn
+from utils import masked_l2, masked_l2_rz,masked_cross_entropy, masked_acc, plot_sample, custom_collate_fn, RunningMean, \
+    PhaseTimer, training_profiler, device_memory, host_memory, oom_snapshot
 
 import safetensors.torch as safetensors
 from safetensors.torch import load_model, save_model
@@ -61,6 +68,25 @@ def sample_from_model(batch, model, device, diffusion, geometry_scale, diffusion
     return geometry_pred.pred_original_sample
 
 
+def sample_from_model_ddim(batch, model, device, diffusion, geometry_scale, timesteps):
+    """Deterministic DDIM sampling over `timesteps`, an ascending subset of the training timesteps."""
+    shape = batch['geometry'].shape
+    model.eval()
+    noisy_batch = {
+        'geometry': torch.randn(*shape, dtype=torch.float32, device=device)*geometry_scale.view(1, 1, 6).to(device)* batch['padding_mask'],
+        "image_features": batch['image_features']
+    }
+    prev_timesteps = [-1] + list(timesteps[:-1])
+    for i, i_prev in zip(timesteps[::-1], prev_timesteps[::-1]):
+        t = torch.full((shape[0],), i, dtype=torch.long, device=device)
+        t_prev = torch.full_like(t, i_prev)
+        with torch.no_grad():
+            model_output = model(batch, noisy_batch, timesteps=t)
+            geometry, pred_original = diffusion.ddim_step(model_output, t, t_prev, noisy_batch['geometry'])
+        noisy_batch['geometry'] = geometry * batch['padding_mask']
+    return pred_original
+
+
 class TrainLoopCAL:
     def __init__(self, accelerator: Accelerator, model, diffusion: GeometryDiffusionScheduler, train_data,
                  val_data, opt_conf,
@@ -89,24 +115,75 @@ class TrainLoopCAL:
         self.mean_0 = mean_0
         self.loss_weight = loss_weight
         self.is_cond = is_cond
+        self.feature_codec = getattr(train_data, 'feature_codec', None)
+        # training IoU every train_metric_every steps (0: never) on the first train_metric_fraction of the batch,
+        # optionally queued on a side CUDA stream
+        self.train_metric_every = opt_conf.get('train_metric_every', 1)
+        self.train_metric_fraction = opt_conf.get('train_metric_fraction', 1.0)
+        self.metric_stream = torch.cuda.Stream(accelerator.device) \
+            if opt_conf.get('train_metric_stream', False) and accelerator.device.type == 'cuda' else None
+        # uniform or loss-aware importance sampling of the training timesteps (trainers/timestep_sampler.py)
+        self.timestep_sampler = build_timestep_sampler(opt_conf, diffusion.num_cont_steps, accelerator.device)
+        # first epoch whose val_iou reaches target_val_iou, to compare timestep samplers
+        self.target_val_iou = opt_conf.get('target_val_iou', None)
+        self.epochs_to_target_iou = None
+        # torch.profiler over a window of steps (config.optimizer.profile), traces in <log dir>/profiler
+        self.profiler = training_profiler(opt_conf, opt_conf.ckpt_dir.parent, accelerator.process_index)
+        # device / host memory and per-phase device peaks every epoch, the maxima of the run at the end
+        self.track_memory = opt_conf.get('memory_telemetry', True)
+        self.memory_maxima = {}
+        # allocator history recorded, dumped to <log dir>/oom_snapshot_rank<i>.pickle on a CUDA OOM
+        self.oom_snapshot = opt_conf.get('oom_snapshot', False)
         
         optimizer = torch.optim.AdamW(model.parameters(), lr=opt_conf.lr, betas=opt_conf.betas,
                                       weight_decay=opt_conf.weight_decay, eps=opt_conf.epsilon)
-        train_loader = DataLoader(train_data, batch_size=opt_conf.batch_size,
-                                  shuffle=True, collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers)
+        # streaming datasets (CanvaLayoutStream) and the device resident loader shuffle and shard across processes themselves
+        streaming = isinstance(train_data, IterableDataset)
+        device_resident = opt_conf.get('device_resident', False)
+        # host batches are pinned and copied to the device while the previous step runs (BatchPrefetcher)
+        prefetch = opt_conf.get('prefetch', False)
+        if device_resident:
+            train_loader = DeviceLayoutLoader(train_data, opt_conf.batch_size, accelerator.device,
+                                              seed=torch.initial_seed(), rank=accelerator.process_index,
+                                              world_size=accelerator.num_processes)
+            LOG.info(f"Training set on {accelerator.device}: {train_loader.nbytes() / 2 ** 20:.1f} MiB")
+            self.train_sampler = train_loader  # draws its own (seed, epoch) permutation
+        else:
+            # the order of an epoch only depends on (seed, epoch), so a resumed run can seek into it
+            self.train_sampler = None if streaming else EpochSampler(train_data, seed=torch.initial_seed())
+            train_loader = DataLoader(train_data, batch_size=opt_conf.batch_size, sampler=self.train_sampler,
+                                      collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers,
+                                      pin_memory=prefetch)
         val_loader = DataLoader(val_data, batch_size=opt_conf.batch_size,
-                                shuffle=False, collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers)
+                                shuffle=False, collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers,
+                                pin_memory=prefetch)
+        # the prepared scheduler steps num_processes times per optimizer step; the streaming and device resident
+        # loaders are not prepared and their length is already per process, so their schedule is scaled back to the
+        # global batch count
+        schedule_scale = accelerator.num_processes if streaming or device_resident else 1
         lr_scheduler = get_scheduler(opt_conf.lr_scheduler,
                                      optimizer,
-                                     num_warmup_steps=opt_conf.num_warmup_steps * opt_conf.gradient_accumulation_steps,
-                                     num_training_steps=(len(train_loader) * opt_conf.num_epochs))
-        self.model, self.optimizer, self.train_dataloader, self.val_dataloader, self.lr_scheduler = accelerator.prepare(
-            model, optimizer, train_loader, val_loader, lr_scheduler
-        )
+                                     num_warmup_steps=opt_conf.num_warmup_steps * opt_conf.gradient_accumulation_steps * schedule_scale,
+                                     num_training_steps=(len(train_loader) * opt_conf.num_epochs * schedule_scale))
+        self.model, self.optimizer, self.lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
+        # with prefetch the prepared loaders leave the batches on the host, BatchPrefetcher moves them. The train
+        # batches always stay on the host in the loader, so their copy is timed as the h2d phase (sample2dev, or the
+        # wait for BatchPrefetcher's copy) instead of hiding in the data wait
+        device_placement = False if prefetch else None
+        if streaming or device_resident:
+            self.train_dataloader = train_loader
+        else:
+            self.train_dataloader = accelerator.prepare_data_loader(train_loader, device_placement=False)
+        self.val_dataloader = accelerator.prepare_data_loader(val_loader, device_placement=device_placement)
+        if prefetch:
+            if not device_resident:
+                self.train_dataloader = BatchPrefetcher(self.train_dataloader, accelerator.device, defer_wait=True)
+            self.val_dataloader = BatchPrefetcher(self.val_dataloader, accelerator.device)
         LOG.info((model.device, self.device))
 
         self.total_batch_size = opt_conf.batch_size * accelerator.num_processes * opt_conf.gradient_accumulation_steps
         self.num_update_steps_per_epoch = math.ceil(len(train_loader) / opt_conf.gradient_accumulation_steps)
+        self.num_batches_per_epoch = len(self.train_dataloader)  # per process, what the loop steps over
         self.max_train_steps = opt_conf.num_epochs * self.num_update_steps_per_epoch
 
         LOG.info("***** Running training *****")
@@ -119,14 +196,26 @@ class TrainLoopCAL:
         
         self.global_step = 0
         self.first_epoch = 0
+        self.resume_step = 0
+        # optimizer steps between mid-epoch checkpoints (0: only the end of epoch ones)
+        self.checkpoint_every_steps = opt_conf.get('checkpoint_every_steps', 0)
+        if resume_from_checkpoint == 'latest':
+            resume_from_checkpoint = latest_checkpoint(opt_conf.ckpt_dir, self.num_update_steps_per_epoch)
         self.resume_from_checkpoint = resume_from_checkpoint
         if resume_from_checkpoint:
-            LOG.print(f"Resuming from checkpoint {resume_from_checkpoint}")
-            accelerator.load_state(resume_from_checkpoint)
-            last_epoch = int(resume_from_checkpoint.split("-")[1])
-            self.global_step = last_epoch * self.num_update_steps_per_epoch
-            self.first_epoch = last_epoch
-            self.resume_step = 0
+            LOG.info(f"Resuming from checkpoint {resume_from_checkpoint}")
+            load_checkpoint(accelerator, self.model, resume_from_checkpoint)
+            state = load_trainer_state(resume_from_checkpoint, self.num_update_steps_per_epoch, self.num_batches_per_epoch)
+            self.first_epoch, self.resume_step, self.global_step = state['epoch'], state['step'], state['global_step']
+            self.timestep_sampler.load_state_dict(state.get('timestep_sampler', {}))
+            self.epochs_to_target_iou = state.get('epochs_to_target_iou')
+        # host snapshot + background write, retention over all checkpoints in ckpt_dir
+        self.checkpoints = CheckpointManager(accelerator, self.model, self.optimizer, self.lr_scheduler,
+                                             opt_conf.ckpt_dir, self.num_update_steps_per_epoch,
+                                             keep_last=opt_conf.get('keep_last_checkpoints', 20),
+                                             keep_every=opt_conf.get('keep_every_checkpoints', 0),
+                                             keep_best=opt_conf.get('keep_best_checkpoint', False),
+                                             asynchronous=opt_conf.get('async_checkpoint', True))
             
         # start a new wandb run to track this script
         wandb.init(
@@ -135,17 +224,130 @@ class TrainLoopCAL:
             # track hyperparameters and run metadata
             config={
             "epochs": 1000,
-            "normalize interval": (-1,1)
+            "normalize interval": (-1,1),
+            "timestep_sampler": opt_conf.get('timestep_sampler', 'uniform')
             }
         )
-        
+
+        # full-trajectory sampling IoU every eval_every epochs, inline or in a background EvalService (main process)
+        self.eval_every = opt_conf.get('eval_every', 30)
+        self.background_eval = opt_conf.get('eval_service', False)
+        self.eval_service = None
+        if self.background_eval and accelerator.is_main_process:
+            val_batches = []
+            # the plain loader, a prepared one would synchronize with the other processes
+            for val_batch, _ in val_loader:
+                if len(val_batches) == opt_conf.get('eval_batches', 4):
+                    break
+                self.sample2dev(val_batch)
+                val_batches.append(val_batch)
+            self.eval_service = EvalService(accelerator.unwrap_model(self.model), diffusion, val_batches,
+                                            opt_conf.ckpt_dir.parent / 'eval_metrics.jsonl',
+                                            device=opt_conf.get('eval_device', 'cpu'),
+                                            sampler=opt_conf.get('eval_sampler', 'ddpm'),
+                                            num_steps=opt_conf.get('eval_steps', diffusion.num_cont_steps),
+                                            diffusion_mode=diffusion_mode, scaling_size=scaling_size,
+                                            z_scaling_size=z_scaling_size, mean_0=mean_0, seed=torch.initial_seed())
+            # results arrive late, keyed by the epoch of their snapshot
+            wandb.define_metric("eval_epoch")
+            wandb.define_metric("iou_val_1000", step_metric="eval_epoch")
+            wandb.define_metric("iou_train_1000", step_metric="eval_epoch")
+
 
     def train(self):
-        for epoch in range(self.first_epoch, self.opt_conf.num_epochs):
-            if self.diffusion_mode == "sample":
-                self.CAL_train_sample(epoch)
-            elif self.diffusion_mode == "epsilon":
-                self.CAL_train_epsilon(epoch)
+        if self.profiler is not None:
+            self.profiler.start()
+        snapshot_path = self.opt_conf.ckpt_dir.parent / f'oom_snapshot_rank{self.accelerator.process_index}.pickle'
+        with oom_snapshot(snapshot_path, self.oom_snapshot):
+            for epoch in range(self.first_epoch, self.opt_conf.num_epochs):
+                if hasattr(self.train_data, 'set_epoch'):
+                    self.train_data.set_epoch(epoch)
+                if self.train_sampler is not None:
+                    self.train_sampler.set_epoch(epoch)
+                if self.diffusion_mode == "sample":
+                    self.CAL_train_sample(epoch)
+                elif self.diffusion_mode == "epsilon":
+                    self.CAL_train_epsilon(epoch)
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.eval_service is not None:
+            self.log_eval_results(self.eval_service.close())
+        self.checkpoints.close()
+        if self.memory_maxima:
+            LOG.info(f"Process {self.accelerator.process_index} memory maxima: "
+                     + ", ".join(f"{k} {v:.0f}" for k, v in self.memory_maxima.items()))
+            wandb.run.summary.update({f"max_{k}": v for k, v in self.memory_maxima.items()})
+
+    def memory_telemetry(self, timer):
+        """
+        Memory metrics of the epoch in MiB: current / peak device memory, the peak of every training phase and of
+        what ran after the last one (validation, evaluation), host RSS of this process and its workers.
+        """
+        if not self.track_memory:
+            return {}
+        device = device_memory(self.accelerator.device)
+        metrics = {}
+        if device:
+            peaks = dict(timer.memory_peaks, validation=device['peak_allocated'])
+            metrics = {"mem_allocated_mb": device['allocated'], "mem_reserved_mb": device['reserved'],
+                       "mem_peak_allocated_mb": max(peaks.values()),
+                       "mem_peak_reserved_mb": max(timer.reserved_peak, device['peak_reserved']),
+                       **{f"mem_peak_{name}_mb": peak for name, peak in peaks.items()}}
+        host = host_memory()
+        metrics.update({"host_rss_mb": host['rss'], "host_workers_rss_mb": host['workers_rss'],
+                        "host_max_worker_rss_mb": host['max_worker_rss']})
+        for k, v in metrics.items():
+            self.memory_maxima[k] = max(self.memory_maxima.get(k, 0.), v)
+        return metrics
+
+    def epoch_loader(self, start_step):
+        """The train loader, starting at batch `start_step` of the epoch without loading the batches before it."""
+        loader = self.train_dataloader
+        if not start_step:
+            return loader
+        prefetcher = isinstance(loader, BatchPrefetcher)
+        if prefetcher:
+            loader = loader.loader
+        if isinstance(loader, DeviceLayoutLoader):
+            loader.start_batch = start_step
+        else:
+            # batch indices are skipped in the sampler; a streaming dataset has to be read up to start_step
+            loader = self.accelerator.skip_first_batches(loader, start_step)
+        return BatchPrefetcher(loader, self.accelerator.device, defer_wait=True) if prefetcher else loader
+
+    def save_checkpoint(self, name, epoch, step, metrics=None):
+        """Checkpoint resuming at batch `step` of `epoch`, written in the background (CheckpointManager)."""
+        # taken after the last batch of an epoch: resume at the start of the next one, not on an empty loader
+        epoch, step = epoch_position(epoch, step, self.num_batches_per_epoch)
+        self.checkpoints.save(name, epoch, step, self.global_step, metrics=metrics, seed=torch.initial_seed(),
+                              timestep_sampler=self.timestep_sampler.state_dict(),
+                              epochs_to_target_iou=self.epochs_to_target_iou)
+
+    def track_target_iou(self, epoch, val_iou):
+        """Record the first epoch at which val_iou reaches target_val_iou (epochs_to_target_iou in the wandb summary)."""
+        if self.target_val_iou is None or self.epochs_to_target_iou is not None or val_iou < self.target_val_iou:
+            return
+        self.epochs_to_target_iou = epoch + 1
+        LOG.info(f"val_iou {val_iou:.4f} reached the target {self.target_val_iou} after {epoch + 1} epochs "
+                 f"({self.opt_conf.get('timestep_sampler', 'uniform')} timestep sampling)")
+        wandb.log({"epochs_to_target_iou": epoch + 1}, step=epoch)
+        wandb.run.summary["epochs_to_target_iou"] = epoch + 1
+
+    def log_eval_results(self, results):
+        for result in results:
+            if 'error' in result:
+                LOG.error(f"Epoch {result['eval_epoch']}, sampling IoU failed: {result['error']}")
+                continue
+            LOG.info(f"Epoch {result['eval_epoch']}, sampling IoU: val {result['iou_val_1000']:.4f}, train {result['iou_train_1000']:.4f}")
+            wandb.log(result)
+
+    def background_eval_step(self, epoch, batch):
+        # hand the snapshot of this epoch to the evaluation worker and log whatever it finished meanwhile
+        if self.eval_service is None:
+            return
+        if epoch % self.eval_every == 0:
+            self.eval_service.submit(epoch, self.accelerator.unwrap_model(self.model), batch)
+        self.log_eval_results(self.eval_service.poll())
             
 
     def sample2dev(self, sample): # sample to device
@@ -155,6 +357,33 @@ class TrainLoopCAL:
                     sample[k][k1] = v1.to(self.device)
             else:
                 sample[k] = v.to(self.device)
+        if self.feature_codec is not None:
+            # features are stored compressed (fp16/int8/pca) and decoded on device
+            sample['image_features'] = self.feature_codec.decode(sample)
+
+    def track_train_iou(self, step, iou_mean, geometry_fn, *tensors):
+        """
+        Add the training IoU of this step to `iou_mean` when it is due (train_metric_every). `geometry_fn` maps the
+        detached `tensors`, cut to the first train_metric_fraction of the layouts, to (true geometry, predicted
+        geometry, padding mask), so the metric only work is skipped entirely on the other steps.
+        With a metric stream the work is queued on it and the next optimizer step does not wait for it.
+        """
+        if not self.train_metric_every or step % self.train_metric_every:
+            return
+        rows = max(1, math.ceil(self.train_metric_fraction * tensors[0].shape[0]))
+        tensors = [tensor.detach()[:rows] for tensor in tensors]
+        if self.metric_stream is not None:
+            self.metric_stream.wait_stream(torch.cuda.current_stream(self.metric_stream.device))
+            for tensor in tensors:
+                # keep the allocator from handing the memory to the next step before the metric stream used it
+                tensor.record_stream(self.metric_stream)
+        with torch.no_grad(), torch.cuda.stream(self.metric_stream):
+            true_geometry, pred_geometry, padding_mask = geometry_fn(*tensors)
+            iou_mean.update(*masked_iou_sum(true_geometry, pred_geometry, self.scaling_size, padding_mask, self.mean_0))
+
+    def wait_metric_stream(self):
+        if self.metric_stream is not None:
+            torch.cuda.current_stream(self.metric_stream.device).wait_stream(self.metric_stream)
 
     ############################################# Content-Aware Layout Generation part ######################################################
 
@@ -164,26 +393,36 @@ class TrainLoopCAL:
         device = self.model.device
         progress_bar = tqdm(total=self.num_update_steps_per_epoch, disable=not self.accelerator.is_local_main_process)
         progress_bar.set_description(f"Epoch {epoch}")
-        train_losses = []
-        train_mean_ious = []
-        for step, (batch, ids) in enumerate(self.train_dataloader):
+        # on-device running means, read back only at log boundaries
+        train_loss_mean, train_iou_mean = RunningMean(device), RunningMean(device)
+        epoch_start = time.perf_counter()
+        num_samples = 0
+        # host time from the end of a step until the next batch arrives, then the phases of the step
+        data_wait, step_end = 0., epoch_start
+        timer = PhaseTimer(device, annotate=self.profiler is not None, track_memory=self.track_memory)
+        # non-padded elements
+        num_tokens = torch.zeros((), dtype=torch.long, device=device)
+        # a resumed epoch continues right after the checkpointed batch
+        start_step = self.resume_step if epoch == self.first_epoch else 0
+        progress_bar.update(start_step // self.opt_conf.gradient_accumulation_steps)
+        loader = self.epoch_loader(start_step)
+        for step, (batch, ids) in enumerate(loader, start=start_step):
             self.epoch_step = 0
-
-            # Skip steps until we reach the resumed step
-            if self.resume_from_checkpoint and epoch == self.first_epoch and step < self.resume_step:
-                if step % self.opt_conf.gradient_accumulation_steps == 0:
-                    progress_bar.update(1)
-                continue
+            data_wait += time.perf_counter() - step_end
+            timer.begin('h2d')
+            if isinstance(loader, BatchPrefetcher):
+                loader.wait()
             self.sample2dev(batch)
+            timer.begin('forward')
 
             # Sample noise that we'll add to the boxes
             geometry_scale = torch.tensor([self.scaling_size, self.scaling_size, self.scaling_size, self.scaling_size, 1, self.z_scaling_size]) # scale에 따라 noise 부여
             noise = torch.randn(batch['geometry'].shape).to(device) * geometry_scale.view(1, 1, 6).to(device)  #[batch, 20, 6]
             bsz = batch['geometry'].shape[0] #batch_size
+            num_samples += bsz
+            num_tokens += (batch['padding_mask'][..., 0] != 0).sum()
             # Sample a random timestep for each layout
-            t = torch.randint(
-                0, self.diffusion.num_cont_steps, (bsz,), device=device
-            ).long()
+            t, t_weights = self.timestep_sampler.sample(bsz)
 
             noisy_geometry = self.diffusion.add_noise_Geometry(batch['geometry'], t, noise)
             # rewrite box with noised version, original box is still in batch['box_cond']
@@ -204,49 +443,72 @@ class TrainLoopCAL:
             with self.accelerator.accumulate(self.model):
                 geometry_predict = self.model(uncond_batch, noisy_batch, t)
                 train_main_loss = masked_l2(batch['geometry'], geometry_predict, batch['padding_mask']) #masked_12를 사용하여 xywh만 loss 계산 가능, masked_l2_r는 r,z, r의 normalize loss를 포함
-                train_main_loss = train_main_loss.mean()
+                self.timestep_sampler.update(t, train_main_loss)
+                # importance weights keep the estimate of the uniform-t loss unbiased
+                train_main_loss = (train_main_loss * t_weights).mean()
                 train_loss = train_main_loss
 
-                train_losses.append(train_main_loss.item())
-                
-                
-                pred_geometry = geometry_predict*batch['padding_mask']
+                train_loss_mean.update(train_main_loss)
 
+                timer.begin('backward')
                 self.accelerator.backward(train_loss)
                 
-                true_geometry = batch["geometry"] 
-                true_box, pred_box = transform(true_geometry, pred_geometry, self.scaling_size,batch['padding_mask'], self.mean_0)
-                batch_mean_iou = get_mean_iou(true_box, pred_box)
-                
-                # print(f"batch_mean_iou", batch_mean_iou)
-                train_mean_ious.append(batch_mean_iou)
-
-                
+                timer.begin('optimizer')
                 if self.accelerator.sync_gradients:
                     self.accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
                 self.optimizer.step()
                 self.lr_scheduler.step()
                 self.optimizer.zero_grad()
 
+            # training IoU at its own cadence, outside the autograd region (see track_train_iou)
+            timer.begin('metric')
+            self.track_train_iou(step, train_iou_mean,
+                                 lambda geometry, predict, mask: (geometry, predict * mask, mask),
+                                 batch['geometry'], geometry_predict, batch['padding_mask'])
+            timer.end()
+
             if self.accelerator.sync_gradients:
                 progress_bar.update(1)
                 self.epoch_step+=1
                 self.global_step += 1
-                logs = {"loss": train_loss.detach().item(), "lr": self.lr_scheduler.get_last_lr()[0],
-                        "step": self.global_step}
-                progress_bar.set_postfix(**logs)
+                if self.global_step % self.log_interval == 0:
+                    # the only host sync of the training step, once every log_interval optimizer steps
+                    logs = {"loss": train_loss_mean.compute(), "lr": self.lr_scheduler.get_last_lr()[0],
+                            "step": self.global_step}
+                    progress_bar.set_postfix(**logs)
+                    timer.collect()
+                if self.checkpoint_every_steps and self.global_step % self.checkpoint_every_steps == 0:
+                    self.save_checkpoint(f"checkpoint-{epoch}-{step + 1}", epoch, step + 1)
+            if self.profiler is not None:
+                self.profiler.step()
+            step_end = time.perf_counter()
 
         
         # Validation loop
         # self.model.eval()
 
+        # reduced over processes once per epoch; this waits for the queued steps, so the timings below include them
+        avg_train_loss = train_loss_mean.compute(self.accelerator)
+        self.wait_metric_stream()
+        avg_train_mean_iou = train_iou_mean.compute(self.accelerator)
+        epoch_time = time.perf_counter() - epoch_start
+        train_throughput = num_samples / epoch_time
+        step_ms = 1000 * epoch_time / (step + 1 - start_step)
+        data_wait_ms = 1000 * data_wait / (step + 1 - start_step)
+        tokens_throughput = num_tokens.item() / epoch_time
+        phase_ms = timer.summary()
+        LOG.info(f"Epoch {epoch}, {train_throughput:.1f} train samples/s, {tokens_throughput:.0f} elements/s, "
+                 f"{step_ms:.1f} ms per step, {data_wait_ms:.2f} ms data wait per step, "
+                 + ", ".join(f"{name} {ms:.2f} ms" for name, ms in phase_ms.items()))
+
         val_losses = []
         val_mean_ious = []
         val_mean_ious_1000=[]
         train_ious_1000 = []
 
         with torch.no_grad():
-            if epoch % 30 == 0:
+            inline_eval = epoch % self.eval_every == 0 and not self.background_eval
+            if inline_eval:
                 train_pred_geometry_1000 = sample_from_model(batch, self.model, device, self.diffusion, geometry_scale, self.diffusion_mode)
                 train_pred_geometry_1000 = train_pred_geometry_1000*batch['padding_mask']
                 
@@ -278,7 +540,7 @@ class TrainLoopCAL:
                       
                 val_mean_ious.append(val_mean_iou)
                              
-                if epoch % 30 == 0:
+                if inline_eval:
                     val_pred_geometry_1000 = sample_from_model(val_batch, self.model, device, self.diffusion, geometry_scale, self.diffusion_mode)
                     
                     # Calculate and log mean_iou
@@ -292,9 +554,11 @@ class TrainLoopCAL:
         
         
         
+        memory = self.memory_telemetry(timer)
+        if memory:
+            LOG.info(f"Epoch {epoch}, memory (MiB): " + ", ".join(f"{k[:-3]} {v:.0f}" for k, v in memory.items()))
+
         ## wandb 로그 찍기
-        avg_train_loss = sum(train_losses)/len(train_losses)
-        avg_train_mean_iou = sum(train_mean_ious) / len(train_mean_ious)
         avg_val_loss = sum(val_losses) / len(val_losses) 
         avg_val_mean_iou = sum(val_mean_ious) / len(val_mean_ious)
         
@@ -303,15 +567,22 @@ class TrainLoopCAL:
             "train_iou": avg_train_mean_iou,
             "val_loss": avg_val_loss, 
             "val_iou": avg_val_mean_iou,
-            "lr": self.lr_scheduler.get_last_lr()[0]
+            "lr": self.lr_scheduler.get_last_lr()[0],
+            "train_samples_per_sec": train_throughput,
+            "train_tokens_per_sec": tokens_throughput,
+            "train_step_ms": step_ms,
+            "train_data_wait_ms": data_wait_ms,
+            **{f"train_{name}_ms": ms for name, ms in phase_ms.items()},
+            **memory
         }, step=epoch)
         
-        if epoch % 30 == 0:
+        if inline_eval:
             avg_val_mean_iou_1000 = sum(val_mean_ious_1000) / len(val_mean_ious_1000)
             avg_train_iou_1000 = sum(train_ious_1000) / len(train_ious_1000)
             wandb.log({"iou_val_1000": avg_val_mean_iou_1000, "iou_train_1000":avg_train_iou_1000}, step=epoch)
         
         LOG.info(f"Epoch {epoch}, Avg Validation Loss: {avg_val_loss}, Avg Mean IoU: {val_mean_iou}")        
+        self.track_target_iou(epoch, avg_val_mean_iou)
         
         
         # print("############################################")
@@ -320,34 +591,14 @@ class TrainLoopCAL:
         #     print(x, self.model.state_dict()[x].shape)
         # print("############################################")
 
+        self.background_eval_step(epoch, batch)
+
         progress_bar.close()
         self.accelerator.wait_for_everyone()
         
         # Save the model at the end of each epoch
         if(epoch % 100 == 99):
-            save_path = self.opt_conf.ckpt_dir / f"checkpoint-{epoch}/"
-
-            # delete folder if we have already 5 checkpoints
-            if self.opt_conf.ckpt_dir.exists():
-                ckpts = list(self.opt_conf.ckpt_dir.glob("checkpoint-*"))
-                # sort by epoch
-                ckpts = sorted(ckpts, key=lambda x: int(x.name.split("-")[1]))
-                if len(ckpts) > 20:
-                    LOG.info(f"Deleting checkpoint {ckpts[0]}")
-                    shutil.rmtree(ckpts[0])
-            
-            # print("############################################")
-            # print(type(self.model.state_dict().items()))
-            # for x in self.model.state_dict():
-            #     print(x, self.model.state_dict()[x].shape)
-            # print("############################################")
-            
-            self.accelerator.save_state(save_path)
-            
-            # self.model.save_pretrained(save_path)
-            safetensors.save_model(self.model, save_path / "model.pth")
-
-            LOG.info(f"Saving checkpoint to {save_path}")
+            self.save_checkpoint(f"checkpoint-{epoch}", epoch + 1, 0, metrics={"val_iou": avg_val_mean_iou})
 
 
 
@@ -360,29 +611,37 @@ class TrainLoopCAL:
         device = self.model.device
         progress_bar = tqdm(total=self.num_update_steps_per_epoch, disable=not self.accelerator.is_local_main_process)
         progress_bar.set_description(f"Epoch {epoch}")
-        train_losses = []
-        train_mean_ious = []
-        train_losses_bbox =[]
-        train_losses_r =[]     
-        train_losses_z =[]  
-        for step, (batch, ids) in enumerate(self.train_dataloader):
+        # on-device running means, read back only at log boundaries
+        train_loss_mean, train_iou_mean = RunningMean(device), RunningMean(device)
+        bbox_loss_mean, r_loss_mean, z_loss_mean = RunningMean(device), RunningMean(device), RunningMean(device)
+        epoch_start = time.perf_counter()
+        num_samples = 0
+        # host time from the end of a step until the next batch arrives, then the phases of the step
+        data_wait, step_end = 0., epoch_start
+        timer = PhaseTimer(device, annotate=self.profiler is not None, track_memory=self.track_memory)
+        # non-padded elements
+        num_tokens = torch.zeros((), dtype=torch.long, device=device)
+        # a resumed epoch continues right after the checkpointed batch
+        start_step = self.resume_step if epoch == self.first_epoch else 0
+        progress_bar.update(start_step // self.opt_conf.gradient_accumulation_steps)
+        loader = self.epoch_loader(start_step)
+        for step, (batch, ids) in enumerate(loader, start=start_step):
             self.epoch_step = 0
-
-            # Skip steps until we reach the resumed step
-            if self.resume_from_checkpoint and epoch == self.first_epoch and step < self.resume_step:
-                if step % self.opt_conf.gradient_accumulation_steps == 0:
-                    progress_bar.update(1)
-                continue
+            data_wait += time.perf_counter() - step_end
+            timer.begin('h2d')
+            if isinstance(loader, BatchPrefetcher):
+                loader.wait()
             self.sample2dev(batch)
+            timer.begin('forward')
 
             # Sample noise that we'll add to the boxes
             geometry_scale = torch.tensor([self.scaling_size, self.scaling_size, self.scaling_size, self.scaling_size, 1, self.z_scaling_size]) # scale에 따라 noise 부여
             noise = torch.randn(batch['geometry'].shape).to(device) * geometry_scale.view(1, 1, 6).to(device)  #[batch, 20, 6]
             bsz = batch['geometry'].shape[0] #batch_size
+            num_samples += bsz
+            num_tokens += (batch['padding_mask'][..., 0] != 0).sum()
             # Sample a random timestep for each layout
-            t = torch.randint(
-                0, self.diffusion.num_cont_steps, (bsz,), device=device
-            ).long()
+            t, t_weights = self.timestep_sampler.sample(bsz)
 
             noisy_geometry = self.diffusion.add_noise_Geometry(batch['geometry'], t, noise)
             # rewrite box with noised version, original box is still in batch['box_cond']
@@ -404,54 +663,80 @@ class TrainLoopCAL:
                 epsilon_predict = self.model(batch, noisy_batch, t)
                 bbox_loss, r_loss, z_loss = masked_l2_rz(noise, epsilon_predict, batch['padding_mask']) #masked_12를 사용하여 xywh만 loss 계산 가능, masked_l2_r는 r,z, r의 normalize loss를 포함
                 train_loss = bbox_loss*self.loss_weight[0] + r_loss*self.loss_weight[1] + z_loss*self.loss_weight[2]
-                train_loss = train_loss.mean()
-
-                train_losses.append(train_loss.item())
-                train_losses_bbox.append(bbox_loss.mean()*self.loss_weight[0])
-                train_losses_r.append(r_loss.mean()*self.loss_weight[1])
-                train_losses_z.append(z_loss.mean()*self.loss_weight[2])
+                self.timestep_sampler.update(t, train_loss)
+                # importance weights keep the estimate of the uniform-t loss unbiased
+                train_loss = (train_loss * t_weights).mean()
+
+                train_loss_mean.update(train_loss)
+                bbox_loss_mean.update(bbox_loss.mean()*self.loss_weight[0])
+                r_loss_mean.update(r_loss.mean()*self.loss_weight[1])
+                z_loss_mean.update(z_loss.mean()*self.loss_weight[2])
                 # train_main_loss = masked_l2(noise, epsilon_predict, batch['padding_mask']) #masked_12를 사용하여 xywh만 loss 계산 가능, masked_l2_r는 r,z, r의 normalize loss를 포함
                 # train_main_loss = train_main_loss.mean()
                 # train_loss = train_main_loss
 
                 # train_losses.append(train_main_loss.item())
 
+                timer.begin('backward')
                 self.accelerator.backward(train_loss)
                 
-                true_geometry = noisy_geometry*batch['padding_mask']
-                pred_geometry = self.diffusion.add_noise_Geometry(batch['geometry'], t, epsilon_predict)*batch['padding_mask'] 
-                true_box, pred_box = transform(true_geometry, pred_geometry, self.scaling_size, batch['padding_mask'], self.mean_0)
-                batch_mean_iou = get_mean_iou(true_box, pred_box)
-                
-                # print(f"batch_mean_iou", batch_mean_iou)
-                train_mean_ious.append(batch_mean_iou)
-
-                
+                timer.begin('optimizer')
                 if self.accelerator.sync_gradients:
                     self.accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
                 self.optimizer.step()
                 self.lr_scheduler.step()
                 self.optimizer.zero_grad()
 
+            # training IoU at its own cadence, outside the autograd region (see track_train_iou)
+            timer.begin('metric')
+            self.track_train_iou(step, train_iou_mean,
+                                 lambda geometry, noisy, epsilon, t, mask: (
+                                     noisy * mask, self.diffusion.add_noise_Geometry(geometry, t, epsilon) * mask, mask),
+                                 batch['geometry'], noisy_geometry, epsilon_predict, t, batch['padding_mask'])
+            timer.end()
+
             if self.accelerator.sync_gradients:
                 progress_bar.update(1)
                 self.epoch_step+=1
                 self.global_step += 1
-                logs = {"loss": train_loss.detach().item(), "lr": self.lr_scheduler.get_last_lr()[0],
-                        "step": self.global_step}
-                progress_bar.set_postfix(**logs)
+                if self.global_step % self.log_interval == 0:
+                    # the only host sync of the training step, once every log_interval optimizer steps
+                    logs = {"loss": train_loss_mean.compute(), "lr": self.lr_scheduler.get_last_lr()[0],
+                            "step": self.global_step}
+                    progress_bar.set_postfix(**logs)
+                    timer.collect()
+                if self.checkpoint_every_steps and self.global_step % self.checkpoint_every_steps == 0:
+                    self.save_checkpoint(f"checkpoint-{epoch}-{step + 1}", epoch, step + 1)
+            if self.profiler is not None:
+                self.profiler.step()
+            step_end = time.perf_counter()
 
         
         # Validation loop
         # self.model.eval()
 
+        # reduced over processes once per epoch; this waits for the queued steps, so the timings below include them
+        avg_train_loss = train_loss_mean.compute(self.accelerator)
+        self.wait_metric_stream()
+        avg_train_mean_iou = train_iou_mean.compute(self.accelerator)
+        epoch_time = time.perf_counter() - epoch_start
+        train_throughput = num_samples / epoch_time
+        step_ms = 1000 * epoch_time / (step + 1 - start_step)
+        data_wait_ms = 1000 * data_wait / (step + 1 - start_step)
+        tokens_throughput = num_tokens.item() / epoch_time
+        phase_ms = timer.summary()
+        LOG.info(f"Epoch {epoch}, {train_throughput:.1f} train samples/s, {tokens_throughput:.0f} elements/s, "
+                 f"{step_ms:.1f} ms per step, {data_wait_ms:.2f} ms data wait per step, "
+                 + ", ".join(f"{name} {ms:.2f} ms" for name, ms in phase_ms.items()))
+
         val_losses = []
         val_mean_ious = []
         val_mean_ious_1000=[]
         train_ious_1000 = []
 
         with torch.no_grad():
-            if epoch % 30 == 0:
+            inline_eval = epoch % self.eval_every == 0 and not self.background_eval
+            if inline_eval:
                 train_pred_geometry_1000 = sample_from_model(batch, self.model, device, self.diffusion, geometry_scale, self.diffusion_mode)
                 train_pred_geometry_1000 = train_pred_geometry_1000*batch['padding_mask']
                 
@@ -492,7 +777,7 @@ class TrainLoopCAL:
                       
                 val_mean_ious.append(val_mean_iou)
                              
-                if epoch % 30 == 0:
+                if inline_eval:
                     val_pred_geometry_1000 = sample_from_model(val_batch, self.model, device, self.diffusion, geometry_scale, self.diffusion_mode)
                     
                     # Calculate and log mean_iou
@@ -506,12 +791,14 @@ class TrainLoopCAL:
         
         
         
+        memory = self.memory_telemetry(timer)
+        if memory:
+            LOG.info(f"Epoch {epoch}, memory (MiB): " + ", ".join(f"{k[:-3]} {v:.0f}" for k, v in memory.items()))
+
         ## wandb 로그 찍기
-        avg_train_loss = sum(train_losses)/len(train_losses)
-        avg_bbox_loss = sum(train_losses_bbox)/len(train_losses_bbox)
-        avg_r_loss = sum(train_losses_r)/len(train_losses_r)
-        avg_z_loss = sum(train_losses_z)/len(train_losses_z)
-        avg_train_mean_iou = sum(train_mean_ious) / len(train_mean_ious)
+        avg_bbox_loss = bbox_loss_mean.compute(self.accelerator)
+        avg_r_loss = r_loss_mean.compute(self.accelerator)
+        avg_z_loss = z_loss_mean.compute(self.accelerator)
         avg_val_loss = sum(val_losses) / len(val_losses) 
         avg_val_mean_iou = sum(val_mean_ious) / len(val_mean_ious)
         
@@ -523,7 +810,13 @@ class TrainLoopCAL:
             "bbox": avg_bbox_loss,
             "rotation":avg_r_loss,
             "z":avg_z_loss,
-            "lr": self.lr_scheduler.get_last_lr()[0]
+            "lr": self.lr_scheduler.get_last_lr()[0],
+            "train_samples_per_sec": train_throughput,
+            "train_tokens_per_sec": tokens_throughput,
+            "train_step_ms": step_ms,
+            "train_data_wait_ms": data_wait_ms,
+            **{f"train_{name}_ms": ms for name, ms in phase_ms.items()},
+            **memory
         }, step=epoch)
         # avg_train_loss = sum(train_losses)/len(train_losses)
         # avg_train_mean_iou = sum(train_mean_ious) / len(train_mean_ious)
@@ -538,12 +831,13 @@ class TrainLoopCAL:
         #     "lr": self.lr_scheduler.get_last_lr()[0]
         # }, step=epoch)
         
-        if epoch % 30 == 0:
+        if inline_eval:
             avg_val_mean_iou_1000 = sum(val_mean_ious_1000) / len(val_mean_ious_1000)
             avg_train_iou_1000 = sum(train_ious_1000) / len(train_ious_1000)
             wandb.log({"iou_val_1000": avg_val_mean_iou_1000, "iou_train_1000":avg_train_iou_1000}, step=epoch)
         
         LOG.info(f"Epoch {epoch}, Avg Validation Loss: {avg_val_loss}, Avg Mean IoU: {val_mean_iou}")        
+        self.track_target_iou(epoch, avg_val_mean_iou)
         
         
         # print("############################################")
@@ -552,33 +846,13 @@ class TrainLoopCAL:
         #     print(x, self.model.state_dict()[x].shape)
         # print("############################################")
 
+        self.background_eval_step(epoch, batch)
+
         progress_bar.close()
         self.accelerator.wait_for_everyone()
         
         # Save the model at the end of each epoch
         if(epoch % 100 == 99):
-            save_path = self.opt_conf.ckpt_dir / f"checkpoint-{epoch}/"
-
-            # delete folder if we have already 5 checkpoints
-            if self.opt_conf.ckpt_dir.exists():
-                ckpts = list(self.opt_conf.ckpt_dir.glob("checkpoint-*"))
-                # sort by epoch
-                ckpts = sorted(ckpts, key=lambda x: int(x.name.split("-")[1]))
-                if len(ckpts) > 20:
-                    LOG.info(f"Deleting checkpoint {ckpts[0]}")
-                    shutil.rmtree(ckpts[0])
-            
-            # print("############################################")
-            # print(type(self.model.state_dict().items()))
-            # for x in self.model.state_dict():
-            #     print(x, self.model.state_dict()[x].shape)
-            # print("############################################")
-            
-            self.accelerator.save_state(save_path)
-            
-            # self.model.save_pretrained(save_path)
-            safetensors.save_model(self.model, save_path / "model.pth")
-
-            LOG.info(f"Saving checkpoint to {save_path}")
+            self.save_checkpoint(f"checkpoint-{epoch}", epoch + 1, 0, metrics={"val_iou": avg_val_mean_iou})
         
         
\ No newline at end of file
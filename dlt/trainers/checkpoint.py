@@ -0,0 +1,230 @@
+import copy
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+import safetensors.torch as safetensors
+from accelerate.utils import gather_object, clean_state_dict_for_safetensors
+from path import Path
+
+from logger_set import LOG
+
+TRAINER_STATE = 'trainer_state.json'
+
+
+def save_trainer_state(checkpoint_dir, epoch, step, global_step, **extra):
+    """
+    Position to resume from, next to the accelerate state: `step` batches of `epoch` are done (0 at an epoch
+    boundary, then `epoch` is the next one).
+    """
+    with open(Path(checkpoint_dir) / TRAINER_STATE, 'w') as f:
+        json.dump({"epoch": epoch, "step": step, "global_step": global_step, **extra}, f, indent=2)
+
+
+def epoch_position(epoch, step, num_batches):
+    """(epoch, step) with the end of an epoch (step == num_batches, its last batch done) as the start of the next."""
+    if num_batches is not None and step >= num_batches:
+        return epoch + 1, 0
+    return epoch, step
+
+
+def load_trainer_state(checkpoint_dir, num_update_steps_per_epoch, num_batches=None):
+    """
+    Resume position of a checkpoint, normalized by epoch_position when the batches per epoch are given. Checkpoints
+    written before trainer_state.json existed restart the epoch in their name (checkpoint-<epoch>) from its first batch.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    if (checkpoint_dir / TRAINER_STATE).exists():
+        with open(checkpoint_dir / TRAINER_STATE, 'r') as f:
+            state = json.load(f)
+        state['epoch'], state['step'] = epoch_position(state['epoch'], state['step'], num_batches)
+        return state
+    epoch = int(checkpoint_dir.name.split("-")[1])
+    return {"epoch": epoch, "step": 0, "global_step": epoch * num_update_steps_per_epoch}
+
+
+def sorted_checkpoints(ckpt_dir, num_update_steps_per_epoch):
+    """checkpoint-* directories of `ckpt_dir`, oldest first."""
+    ckpt_dir = Path(ckpt_dir)
+    if not ckpt_dir.exists():
+        return []
+    return sorted(ckpt_dir.dirs("checkpoint-*"), key=lambda d: load_trainer_state(d, num_update_steps_per_epoch)['global_step'])
+
+
+def latest_checkpoint(ckpt_dir, num_update_steps_per_epoch):
+    checkpoints = sorted_checkpoints(ckpt_dir, num_update_steps_per_epoch)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(accelerator, model, checkpoint_dir):
+    """
+    Restore a checkpoint into the prepared model, optimizer, scheduler and RNGs. accelerator.load_state loads the
+    weights with a plain strict load_state_dict, which misses the aliases the checkpoint does not store, so they are
+    loaded (strictly) with safetensors.load_model instead.
+    """
+    accelerator.load_state(checkpoint_dir, strict=False)
+    safetensors.load_model(accelerator.unwrap_model(model), Path(checkpoint_dir) / "model.safetensors", strict=True)
+
+
+def verify_checkpoint(checkpoint_dir, model):
+    """Build a fresh model from `checkpoint_dir` like the tools do (build_model, strict load), raise if it fails."""
+    from models.CAL import CAL_6, build_model
+    build_model(isinstance(model, CAL_6), checkpoint_dir)
+
+
+def _to_host(value):
+    """Copy of a (nested) state dict with every tensor cloned to host memory."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {k: _to_host(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_host(v) for v in value)
+    return copy.deepcopy(value)
+
+
+def _rng_state():
+    # the layout of accelerate's random_states_<process>.pkl
+    state = {"random_state": random.getstate(), "numpy_random_seed": np.random.get_state(),
+             "torch_manual_seed": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+class CheckpointManager:
+    """
+    Checkpoints that do not block the training loop. save() copies the model, optimizer, scheduler (and grad scaler)
+    state and the RNG states of every process to host memory and returns; a writer thread on the main process lays
+    them out like accelerator.save_state (unwrapped model weights without aliased tensors, read them back with
+    load_checkpoint) plus model.pth, config.json and trainer_state.json in a hidden .<name>.tmp directory, which is renamed to <name> once
+    it loads back through build_model.
+    After each write the retention policy runs over all checkpoint-* directories: the last `keep_last`, every
+    `keep_every`-th epoch boundary and, with `keep_best`, the one with the highest `best_metric` are kept.
+    With `asynchronous=False` save() writes before returning.
+    """
+    def __init__(self, accelerator, model, optimizer, lr_scheduler, ckpt_dir, num_update_steps_per_epoch,
+                 keep_last=20, keep_every=0, keep_best=False, best_metric='val_iou', asynchronous=True):
+        self.accelerator = accelerator
+        self.model, self.optimizer, self.lr_scheduler = model, optimizer, lr_scheduler
+        self.ckpt_dir = Path(ckpt_dir)
+        self.num_update_steps_per_epoch = num_update_steps_per_epoch
+        self.keep_last, self.keep_every = keep_last, keep_every
+        self.keep_best, self.best_metric = keep_best, best_metric
+        self.jobs = None
+        if asynchronous and accelerator.is_main_process:
+            # one pending snapshot at most: host memory holds two copies of the state at worst
+            self.jobs = queue.Queue(maxsize=1)
+            self.writer = threading.Thread(target=self._writer, name='checkpoint-writer', daemon=True)
+            self.writer.start()
+
+    def snapshot(self):
+        """Host copy of everything accelerator.save_state would write, RNG states gathered from every process."""
+        rng_states = gather_object([_rng_state()])
+        if not self.accelerator.is_main_process:
+            return None
+        # aliases of shared tensors (the positional encoding is also the timestep embedder's) are dropped before the
+        # copy separates them, like safetensors.save_model, so load_model(strict=True) accepts the file
+        model_state = clean_state_dict_for_safetensors(self.accelerator.get_state_dict(self.model))
+        snapshot = {"model": _to_host(model_state),
+                    "optimizer": _to_host(self.optimizer.state_dict()),
+                    "scheduler": _to_host(self.lr_scheduler.state_dict()),
+                    "random_states": rng_states}
+        if self.accelerator.scaler is not None:
+            snapshot["scaler"] = _to_host(self.accelerator.scaler.state_dict())
+        return snapshot
+
+    def save(self, name, epoch, step, global_step, metrics=None, **extra):
+        """
+        Checkpoint `name` resuming at batch `step` of `epoch`; `metrics` (e.g. {"val_iou": ...}) go into
+        trainer_state.json for keep_best. Called on every process, returns once the state is on the host.
+        """
+        start = time.time()
+        snapshot = self.snapshot()
+        if not self.accelerator.is_main_process:
+            return
+        state = {"epoch": epoch, "step": step, "global_step": global_step, **extra}
+        if metrics:
+            state["metrics"] = {k: float(v) for k, v in metrics.items()}
+        if self.jobs is None:
+            self.write(name, snapshot, state)
+        else:
+            # blocks only while the previous checkpoint is still queued
+            self.jobs.put((name, snapshot, state))
+        LOG.info(f"Checkpoint {name} snapshot in {time.time() - start:.2f}s")
+
+    def write(self, name, snapshot, state):
+        start = time.time()
+        save_path = self.ckpt_dir / name
+        tmp_path = self.ckpt_dir / f".{name}.tmp"
+        if tmp_path.exists():
+            tmp_path.rmtree()
+        tmp_path.makedirs_p()
+        safetensors.save_file(snapshot["model"], tmp_path / "model.safetensors", metadata={"format": "pt"})
+        safetensors.save_file(snapshot["model"], tmp_path / "model.pth", metadata={"format": "pt"})
+        # the architecture, so build_model does not depend on the model_kwargs of the config it is called with
+        self.accelerator.unwrap_model(self.model).save_config(tmp_path)
+        torch.save(snapshot["optimizer"], tmp_path / "optimizer.bin")
+        torch.save(snapshot["scheduler"], tmp_path / "scheduler.bin")
+        if "scaler" in snapshot:
+            torch.save(snapshot["scaler"], tmp_path / "scaler.pt")
+        for i, rng_state in enumerate(snapshot["random_states"]):
+            torch.save(rng_state, tmp_path / f"random_states_{i}.pkl")
+        save_trainer_state(tmp_path, **state)
+        verify_checkpoint(tmp_path, self.accelerator.unwrap_model(self.model))
+        if save_path.exists():
+            save_path.rmtree()
+        os.rename(tmp_path, save_path)
+        LOG.info(f"Saved checkpoint {save_path} in {time.time() - start:.2f}s")
+        self.apply_retention()
+
+    def _writer(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    break
+                self.write(*job)
+            except Exception:
+                LOG.exception(f"Writing checkpoint {job[0]} failed")
+            finally:
+                self.jobs.task_done()
+
+    def retained(self, checkpoints):
+        """The subset of `checkpoints` (oldest first) the retention policy keeps."""
+        states = [load_trainer_state(c, self.num_update_steps_per_epoch) for c in checkpoints]
+        # the newest one is always kept, it is what a resumed run starts from
+        keep = set(checkpoints[-max(self.keep_last, 1):])
+        if self.keep_every > 0:
+            keep.update(c for c, s in zip(checkpoints, states) if s['step'] == 0 and s['epoch'] % self.keep_every == 0)
+        if self.keep_best:
+            scored = [(s['metrics'][self.best_metric], c) for c, s in zip(checkpoints, states)
+                      if self.best_metric in s.get('metrics', {})]
+            if scored:
+                keep.add(max(scored)[1])
+        return keep
+
+    def apply_retention(self):
+        checkpoints = sorted_checkpoints(self.ckpt_dir, self.num_update_steps_per_epoch)
+        keep = self.retained(checkpoints)
+        for checkpoint in checkpoints:
+            if checkpoint not in keep:
+                LOG.info(f"Deleting checkpoint {checkpoint}")
+                checkpoint.rmtree()
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        if self.jobs is not None:
+            self.jobs.join()
+
+    def close(self):
+        if self.jobs is not None:
+            self.wait()
+            self.jobs.put(None)
+            self.writer.join()
+            self.jobs = None
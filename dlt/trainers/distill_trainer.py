@@ -0,0 +1,187 @@
+import copy
+import json
+import warnings
+
+import torch
+import wandb
+from accelerate import Accelerator
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from diffusion import GeometryDiffusionScheduler
+from evaluation.iou import transform, get_mean_iou
+from logger_set import LOG
+from trainers.cal_trainer import sample_from_model_ddim
+from utils import masked_l2, custom_collate_fn
+
+from safetensors.torch import save_model
+warnings.filterwarnings("ignore")
+
+
+class TrainLoopDistill:
+    """
+    Progressive distillation (Salimans & Ho) of a trained CAL teacher.
+    Every stage trains a student, initialised from the current teacher, so that one deterministic DDIM step
+    of the student matches two DDIM steps of the teacher. The number of sampling steps is halved each stage
+    (1000 -> 500 -> ... -> min_steps) and each student is evaluated with get_mean_iou.
+    """
+    def __init__(self, accelerator: Accelerator, teacher, diffusion: GeometryDiffusionScheduler, train_data,
+                 val_data, opt_conf, distill_conf,
+                 device: str = 'cpu',
+                 scaling_size=5,
+                 z_scaling_size=0.01,
+                 mean_0=True):
+
+        self.accelerator = accelerator
+        self.teacher = teacher
+        self.diffusion = diffusion
+        self.opt_conf = opt_conf
+        self.distill_conf = distill_conf
+        self.device = device
+        self.scaling_size = scaling_size
+        self.z_scaling_size = z_scaling_size
+        self.mean_0 = mean_0
+        self.geometry_scale = torch.tensor([scaling_size, scaling_size, scaling_size, scaling_size, 1, z_scaling_size])
+        self.feature_codec = getattr(train_data, 'feature_codec', None)
+
+        train_loader = DataLoader(train_data, batch_size=opt_conf.batch_size,
+                                  shuffle=True, collate_fn=custom_collate_fn, num_workers=opt_conf.num_workers)
+        val_loader = DataLoader(val_data, batch_size=opt_conf.batch_size,
+                                shuffle=False, collate_fn=custom_collate_fn, num_workers=opt_conf.num_workers)
+        self.train_dataloader, self.val_dataloader = accelerator.prepare(train_loader, val_loader)
+
+        LOG.info("***** Running progressive distillation *****")
+        LOG.info(f"  Num examples = {len(train_data)}")
+        LOG.info(f"  Teacher steps = {diffusion.num_cont_steps}, min student steps = {distill_conf.min_steps}")
+        LOG.info(f"  Optimization steps per stage = {distill_conf.steps_per_stage}")
+
+    def sample2dev(self, sample):  # sample to device
+        for k, v in sample.items():
+            if isinstance(v, dict):
+                for k1, v1 in v.items():
+                    sample[k][k1] = v1.to(self.device)
+            else:
+                sample[k] = v.to(self.device)
+        if self.feature_codec is not None:
+            # features are stored compressed (fp16/int8/pca) and decoded on device
+            sample['image_features'] = self.feature_codec.decode(sample)
+
+    def train(self):
+        grid = list(range(self.diffusion.num_cont_steps))
+        teacher = self.teacher.to(self.device)
+        results = {len(grid): self.evaluate(teacher, grid)}
+        while len(grid) > self.distill_conf.min_steps:
+            # keep every other timestep, always including the first sampling step (the largest t)
+            student_grid = grid[len(grid) - 1::-2][::-1]
+            student = self.distill_stage(teacher, grid, student_grid)
+            grid = student_grid
+            results[len(grid)] = self.evaluate(student, grid)
+            self.save_stage(student, grid)
+            teacher = student
+
+        LOG.info("steps -> val mean IoU: " + ", ".join(f"{k}: {v:.4f}" for k, v in results.items()))
+        return results
+
+    def stage_timesteps(self, teacher_grid, student_grid):
+        """For every student timestep: the teacher's intermediate timestep and the student's next timestep."""
+        position = {t: i for i, t in enumerate(teacher_grid)}
+        t_mid, t_prev = [], []
+        for t in student_grid:
+            i = position[t]
+            t_mid.append(teacher_grid[i - 1] if i >= 1 else -1)
+            t_prev.append(teacher_grid[i - 2] if i >= 2 else -1)
+        as_tensor = lambda x: torch.tensor(x, dtype=torch.long, device=self.device)
+        return as_tensor(student_grid), as_tensor(t_mid), as_tensor(t_prev)
+
+    def distill_stage(self, teacher, teacher_grid, student_grid):
+        teacher.eval()
+        teacher.requires_grad_(False)
+        student = copy.deepcopy(teacher)
+        student.requires_grad_(True)
+        optimizer = torch.optim.AdamW(student.parameters(), lr=self.distill_conf.lr, betas=self.opt_conf.betas,
+                                      weight_decay=self.opt_conf.weight_decay, eps=self.opt_conf.epsilon)
+        student, optimizer = self.accelerator.prepare(student, optimizer)
+        student.train()
+
+        t_grid, t_mid_grid, t_prev_grid = self.stage_timesteps(teacher_grid, student_grid)
+        geometry_scale = self.geometry_scale.view(1, 1, 6).to(self.device)
+        progress_bar = tqdm(total=self.distill_conf.steps_per_stage,
+                            disable=not self.accelerator.is_local_main_process)
+        progress_bar.set_description(f"Distill {len(teacher_grid)} -> {len(student_grid)}")
+        step = 0
+        while step < self.distill_conf.steps_per_stage:
+            for batch, ids in self.train_dataloader:
+                if step >= self.distill_conf.steps_per_stage:
+                    break
+                self.sample2dev(batch)
+                mask = batch['padding_mask']
+                bsz = batch['geometry'].shape[0]
+
+                idx = torch.randint(0, len(student_grid), (bsz,), device=self.device)
+                t, t_mid, t_prev = t_grid[idx], t_mid_grid[idx], t_prev_grid[idx]
+                noise = torch.randn(batch['geometry'].shape, device=self.device) * geometry_scale
+                z_t = self.diffusion.add_noise_Geometry(batch['geometry'], t, noise) * mask
+
+                # two teacher steps t -> t_mid -> t_prev (one step when there is no intermediate timestep)
+                with torch.no_grad():
+                    teacher_out = teacher(batch, {"geometry": z_t, "image_features": batch['image_features']}, t)
+                    z_mid, _ = self.diffusion.ddim_step(teacher_out, t, t_mid, z_t)
+                    z_mid = z_mid * mask
+                    teacher_out = teacher(batch, {"geometry": z_mid, "image_features": batch['image_features']},
+                                          t_mid.clamp(min=0))
+                    z_prev, _ = self.diffusion.ddim_step(teacher_out, t_mid.clamp(min=0), t_prev, z_mid)
+                    has_mid = (t_mid >= 0).view(-1, 1, 1)
+                    z_prev = torch.where(has_mid, z_prev, z_mid) * mask
+
+                    # x_0 target for which a single DDIM step t -> t_prev lands on z_prev
+                    alpha, sigma = self.diffusion._alpha_sigma(t, z_t.dim())
+                    alpha_prev, sigma_prev = self.diffusion._alpha_sigma(t_prev, z_t.dim())
+                    ratio = sigma_prev / sigma
+                    target = (z_prev - ratio * z_t) / (alpha_prev - ratio * alpha)
+                    if self.diffusion.config.prediction_type == "epsilon":
+                        target = (z_t - alpha * target) / sigma
+                    target = target * mask
+
+                student_out = student(batch, {"geometry": z_t, "image_features": batch['image_features']}, t)
+                loss = masked_l2(target, student_out, mask).mean()
+                self.accelerator.backward(loss)
+                self.accelerator.clip_grad_norm_(student.parameters(), 1.0)
+                optimizer.step()
+                optimizer.zero_grad()
+
+                step += 1
+                progress_bar.update(1)
+                progress_bar.set_postfix(loss=loss.detach().item())
+                if step % 100 == 0:
+                    wandb.log({f"distill_loss_{len(student_grid)}": loss.detach().item()})
+        progress_bar.close()
+        return self.accelerator.unwrap_model(student)
+
+    def evaluate(self, model, grid):
+        model.eval()
+        ious = []
+        for val_step, (val_batch, val_ids) in enumerate(self.val_dataloader):
+            if val_step >= self.distill_conf.eval_batches:
+                break
+            self.sample2dev(val_batch)
+            pred_geometry = sample_from_model_ddim(val_batch, model, self.device, self.diffusion,
+                                                   self.geometry_scale, grid) * val_batch['padding_mask']
+            true_box, pred_box = transform(val_batch['geometry'], pred_geometry, self.scaling_size,
+                                           val_batch['padding_mask'], self.mean_0)
+            ious.append(get_mean_iou(true_box, pred_box))
+        mean_iou = sum(ious) / len(ious)
+        wandb.log({"distill_steps": len(grid), "distill_val_iou": mean_iou})
+        LOG.info(f"{len(grid)} sampling steps, val mean IoU: {mean_iou}")
+        return mean_iou
+
+    def save_stage(self, model, grid):
+        self.accelerator.wait_for_everyone()
+        if not self.accelerator.is_main_process:
+            return
+        save_path = self.opt_conf.ckpt_dir / f"distill-{len(grid)}"
+        save_path.makedirs_p()
+        save_model(model, save_path / "model.safetensors")
+        model.save_config(save_path)
+        with open(save_path / "timesteps.json", 'w') as f:
+            json.dump({"timesteps": grid}, f)
+        LOG.info(f"Saving student checkpoint to {save_path}")
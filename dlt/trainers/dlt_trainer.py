@@ -14,11 +14,16 @@ from einops import repeat
 from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 
+from data_loaders.prefetcher import BatchPrefetcher
+from data_loaders.samplers import EpochSampler
+from trainers.timestep_sampler import build_timestep_sampler
+from trainers.checkpoint import save_trainer_state, load_trainer_state, sorted_checkpoints, latest_checkpoint
 from data_loaders.data_utils import mask_loc, mask_size, mask_whole_box, mask_random_box_and_cat, mask_all
 from diffusion import JointDiffusionScheduler, GeometryDiffusionScheduler
 
 from logger_set import LOG
-from utils import masked_l2, masked_cross_entropy, masked_acc, plot_sample, custom_collate_fn
+from utils import masked_l2, masked_cross_entropy, masked_acc, plot_sample, custom_collate_fn, device_memory, \
+    host_memory, format_memory
 
 import safetensors.torch as safetensors
 from safetensors.torch import load_model, save_model
@@ -46,20 +51,33 @@ class TrainLoopDLT:
         self.opt_conf = opt_conf
         self.log_interval = log_interval
         self.device = device
+        # uniform or loss-aware importance sampling of the training timesteps (trainers/timestep_sampler.py)
+        self.timestep_sampler = build_timestep_sampler(opt_conf, diffusion.num_cont_steps, accelerator.device)
 
         optimizer = torch.optim.AdamW(model.parameters(), lr=opt_conf.lr, betas=opt_conf.betas,
                                       weight_decay=opt_conf.weight_decay, eps=opt_conf.epsilon)
-        train_loader = DataLoader(train_data, batch_size=opt_conf.batch_size,
-                                  shuffle=True, collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers)
+        # host batches are pinned and copied to the device while the previous step runs (BatchPrefetcher)
+        prefetch = opt_conf.get('prefetch', False)
+        # the order of an epoch only depends on (seed, epoch), so a resumed run can seek into it
+        self.train_sampler = EpochSampler(train_data, seed=torch.initial_seed())
+        train_loader = DataLoader(train_data, batch_size=opt_conf.batch_size, sampler=self.train_sampler,
+                                  collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers,
+                                  pin_memory=prefetch)
         val_loader = DataLoader(val_data, batch_size=opt_conf.batch_size,
-                                shuffle=False, collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers)
+                                shuffle=False, collate_fn = custom_collate_fn, num_workers=opt_conf.num_workers,
+                                pin_memory=prefetch)
         lr_scheduler = get_scheduler(opt_conf.lr_scheduler,
                                      optimizer,
                                      num_warmup_steps=opt_conf.num_warmup_steps * opt_conf.gradient_accumulation_steps,
                                      num_training_steps=(len(train_loader) * opt_conf.num_epochs))
-        self.model, self.optimizer, self.train_dataloader, self.val_dataloader, self.lr_scheduler = accelerator.prepare(
-            model, optimizer, train_loader, val_loader, lr_scheduler
-        )
+        self.model, self.optimizer, self.lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
+        # with prefetch the prepared loaders leave the batches on the host, BatchPrefetcher moves them
+        device_placement = False if prefetch else None
+        self.train_dataloader = accelerator.prepare_data_loader(train_loader, device_placement=device_placement)
+        self.val_dataloader = accelerator.prepare_data_loader(val_loader, device_placement=device_placement)
+        if prefetch:
+            self.train_dataloader = BatchPrefetcher(self.train_dataloader, accelerator.device)
+            self.val_dataloader = BatchPrefetcher(self.val_dataloader, accelerator.device)
         LOG.info((model.device, self.device))
 
         self.total_batch_size = opt_conf.batch_size * accelerator.num_processes * opt_conf.gradient_accumulation_steps
@@ -75,18 +93,22 @@ class TrainLoopDLT:
         LOG.info(f"  Total optimization steps = {self.max_train_steps}")
         self.global_step = 0
         self.first_epoch = 0
+        self.resume_step = 0
+        if resume_from_checkpoint == 'latest':
+            resume_from_checkpoint = latest_checkpoint(opt_conf.ckpt_dir, self.num_update_steps_per_epoch)
         self.resume_from_checkpoint = resume_from_checkpoint
         if resume_from_checkpoint:
-            LOG.print(f"Resuming from checkpoint {resume_from_checkpoint}")
+            LOG.info(f"Resuming from checkpoint {resume_from_checkpoint}")
             accelerator.load_state(resume_from_checkpoint)
-            last_epoch = int(resume_from_checkpoint.split("-")[1])
-            self.global_step = last_epoch * self.num_update_steps_per_epoch
-            self.first_epoch = last_epoch
-            self.resume_step = 0
+            state = load_trainer_state(resume_from_checkpoint, self.num_update_steps_per_epoch, len(self.train_dataloader))
+            self.first_epoch, self.resume_step, self.global_step = state['epoch'], state['step'], state['global_step']
+            self.timestep_sampler.load_state_dict(state.get('timestep_sampler', {}))
 
     def train(self):
         for epoch in range(self.first_epoch, self.opt_conf.num_epochs):
+            self.train_sampler.set_epoch(epoch)
             self.train_epoch_CAL(epoch)
+            self.log_memory(epoch)
             # orig, pred = self.generate_images()
             # wandb.log({
             #     "pred": [wandb.Image(pil, caption=f'pred_{self.global_step}_{i:02d}.jpg')
@@ -94,6 +116,14 @@ class TrainLoopDLT:
             #     "orig": [wandb.Image(pil, caption=f'orig_{self.global_step}.jpg')
             #              for i, pil in orig]}, step=self.global_step)
 
+    def log_memory(self, epoch):
+        """Device memory (peak over the epoch) and host RSS of this process and its DataLoader workers."""
+        memory = {**device_memory(self.accelerator.device), **host_memory()}
+        LOG.info(f"Epoch {epoch}, process {self.accelerator.process_index} memory: {format_memory(memory)}")
+        wandb.log({f"mem_{k}_mb": v for k, v in memory.items()}, step=self.global_step)
+        if self.accelerator.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.accelerator.device)
+
     def sample2dev(self, sample):
         for k, v in sample.items():
             if isinstance(v, dict):
@@ -102,6 +132,15 @@ class TrainLoopDLT:
             else:
                 sample[k] = v.to(self.device)
 
+    def epoch_loader(self, start_step):
+        """The train loader, starting at batch `start_step` of the epoch without loading the batches before it."""
+        loader = self.train_dataloader
+        if not start_step:
+            return loader
+        if isinstance(loader, BatchPrefetcher):
+            return BatchPrefetcher(self.accelerator.skip_first_batches(loader.loader, start_step), self.accelerator.device)
+        return self.accelerator.skip_first_batches(loader, start_step)
+
     def train_epoch(self, epoch):
         self.model.train()
         warnings.filterwarnings("ignore")
@@ -109,7 +148,10 @@ class TrainLoopDLT:
         progress_bar = tqdm(total=self.num_update_steps_per_epoch, disable=not self.accelerator.is_local_main_process)
         progress_bar.set_description(f"Epoch {epoch}")
         losses = {}
-        for step, batch in enumerate(self.train_dataloader):
+        # a resumed epoch continues right after the checkpointed batch
+        start_step = self.resume_step if epoch == self.first_epoch else 0
+        progress_bar.update(start_step // self.opt_conf.gradient_accumulation_steps)
+        for step, (batch, ids) in enumerate(self.epoch_loader(start_step), start=start_step):
             
             # print("###################################################################")
             # print("batch[box].shape: ", batch['box'].shape)
@@ -118,20 +160,13 @@ class TrainLoopDLT:
             # print("batch[mask_box].shape: ", batch['mask_box'].shape)
             # print("batch[mask_cat].shape: ", batch['mask_cat'].shape)
             # print("###################################################################")
-            # Skip steps until we reach the resumed step
-            if self.resume_from_checkpoint and epoch == self.first_epoch and step < self.resume_step:
-                if step % self.opt_conf.gradient_accumulation_steps == 0:
-                    progress_bar.update(1)
-                continue
             self.sample2dev(batch)
 
             # Sample noise that we'll add to the boxes
             noise = torch.randn(batch['box'].shape).to(device)
             bsz = batch['box'].shape[0]
             # Sample a random timestep for each layout
-            t = torch.randint(
-                0, self.diffusion.num_cont_steps, (bsz,), device=device
-            ).long()
+            t, t_weights = self.timestep_sampler.sample(bsz)
 
             cont_vec, noisy_batch = self.diffusion.add_noise_jointly(batch['box'], batch, t, noise)
             # rewrite box with noised version, original box is still in batch['box_cond']
@@ -146,7 +181,10 @@ class TrainLoopDLT:
                 loss_mse = masked_l2(batch['box_cond'], boxes_predict, batch['mask_box'])
                 loss_cls = masked_cross_entropy(cls_predict, batch['cat'], batch['mask_cat'])
 
-                loss = (self.opt_conf.lmb * loss_mse + loss_cls).mean()
+                loss = self.opt_conf.lmb * loss_mse + loss_cls
+                self.timestep_sampler.update(t, loss)
+                # importance weights keep the estimate of the uniform-t loss unbiased
+                loss = (loss * t_weights).mean()
 
                 self.accelerator.backward(loss)
 
@@ -180,13 +218,14 @@ class TrainLoopDLT:
         save_path = self.opt_conf.ckpt_dir / f"checkpoint-{epoch}/"
         # delete folder if we have already 5 checkpoints
         if self.opt_conf.ckpt_dir.exists():
-            ckpts = list(self.opt_conf.ckpt_dir.glob("checkpoint-*"))
-            # sort by epoch
-            ckpts = sorted(ckpts, key=lambda x: int(x.name.split("-")[1]))
+            ckpts = sorted_checkpoints(self.opt_conf.ckpt_dir, self.num_update_steps_per_epoch)
             if len(ckpts) > 10:
                 LOG.info(f"Deleting checkpoint {ckpts[0]}")
                 shutil.rmtree(ckpts[0])
         self.accelerator.save_state(save_path)
+        if self.accelerator.is_main_process:
+            save_trainer_state(save_path, epoch + 1, 0, self.global_step, seed=torch.initial_seed(),
+                               timestep_sampler=self.timestep_sampler.state_dict())
         print("############################################")
         #print(type(self.model.state_dict().items()))
         for x in self.model.state_dict():
@@ -296,7 +335,10 @@ class TrainLoopDLT:
         progress_bar = tqdm(total=self.num_update_steps_per_epoch, disable=not self.accelerator.is_local_main_process)
         progress_bar.set_description(f"Epoch {epoch}")
         losses = {}
-        for step, (batch, ids) in enumerate(self.train_dataloader):
+        # a resumed epoch continues right after the checkpointed batch
+        start_step = self.resume_step if epoch == self.first_epoch else 0
+        progress_bar.update(start_step // self.opt_conf.gradient_accumulation_steps)
+        for step, (batch, ids) in enumerate(self.epoch_loader(start_step), start=start_step):
             
             # input = torch.randn([16,20,6])
             # Geometry1 = torch.ones_like(input)
@@ -314,20 +356,13 @@ class TrainLoopDLT:
             # print("#############################################################")
 
             
-            # Skip steps until we reach the resumed step
-            if self.resume_from_checkpoint and epoch == self.first_epoch and step < self.resume_step:
-                if step % self.opt_conf.gradient_accumulation_steps == 0:
-                    progress_bar.update(1)
-                continue
             self.sample2dev(batch)
 
             # Sample noise that we'll add to the boxes
             noise = torch.randn(batch['geometry'].shape).to(device)  #[batch, 20, 6]
             bsz = batch['geometry'].shape[0] #batch_size
             # Sample a random timestep for each layout
-            t = torch.randint(
-                0, self.diffusion.num_cont_steps, (bsz,), device=device
-            ).long()
+            t, t_weights = self.timestep_sampler.sample(bsz)
 
             noisy_geometry = self.diffusion.add_noise_Geometry(batch['geometry'], t, noise)
             # rewrite box with noised version, original box is still in batch['box_cond']
@@ -342,7 +377,8 @@ class TrainLoopDLT:
                 print("###############################################################################")
                 print("batch[geometry].shape: ", batch["geometry"].shape)
                 print("Geometry_predict.shape: ", geometry_predict.shape)
-                loss = loss.mean()
+                self.timestep_sampler.update(t, loss)
+                loss = (loss * t_weights).mean()
                 print("loss: ", loss.item())
                 print("###############################################################################")
                 #loss_cls = masked_cross_entropy(cls_predict, batch['cat'], batch['mask_cat'])
@@ -381,13 +417,14 @@ class TrainLoopDLT:
         save_path = self.opt_conf.ckpt_dir / f"checkpoint-{epoch}/"
         # delete folder if we have already 5 checkpoints
         if self.opt_conf.ckpt_dir.exists():
-            ckpts = list(self.opt_conf.ckpt_dir.glob("checkpoint-*"))
-            # sort by epoch
-            ckpts = sorted(ckpts, key=lambda x: int(x.name.split("-")[1]))
+            ckpts = sorted_checkpoints(self.opt_conf.ckpt_dir, self.num_update_steps_per_epoch)
             if len(ckpts) > 10:
                 LOG.info(f"Deleting checkpoint {ckpts[0]}")
                 shutil.rmtree(ckpts[0])
         self.accelerator.save_state(save_path)
+        if self.accelerator.is_main_process:
+            save_trainer_state(save_path, epoch + 1, 0, self.global_step, seed=torch.initial_seed(),
+                               timestep_sampler=self.timestep_sampler.state_dict())
         print("############################################")
         #print(type(self.model.state_dict().items()))
         for x in self.model.state_dict():
@@ -0,0 +1,137 @@
+import json
+import os
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from path import Path
+from safetensors.torch import load_model, save_model
+
+from logger_set import LOG
+
+
+def _to_cpu(batch):
+    return {k: _to_cpu(v) if isinstance(v, dict) else v.detach().cpu() for k, v in batch.items()}
+
+
+@torch.no_grad()
+def sampling_iou(model, batches, diffusion, options):
+    """Mean IoU of layouts sampled from noise (full DDPM trajectory or `num_steps` DDIM steps) against `batches`."""
+    from evaluation.iou import transform, get_mean_iou
+    from trainers.cal_trainer import sample_from_model, sample_from_model_ddim
+
+    device = torch.device(options['device'])
+    scaling_size, z_scaling_size = options['scaling_size'], options['z_scaling_size']
+    geometry_scale = torch.tensor([scaling_size, scaling_size, scaling_size, scaling_size, 1, z_scaling_size])
+    ious = []
+    for batch in batches:
+        batch = {k: v.to(device) for k, v in batch.items()}
+        if options['sampler'] == 'ddim':
+            timesteps = diffusion.spaced_timesteps(options['num_steps'])
+            pred_geometry = sample_from_model_ddim(batch, model, device, diffusion, geometry_scale, timesteps)
+        else:
+            pred_geometry = sample_from_model(batch, model, device, diffusion, geometry_scale, options['diffusion_mode'])
+        pred_geometry = pred_geometry * batch['padding_mask']
+        true_box, pred_box = transform(batch['geometry'], pred_geometry, scaling_size, batch['padding_mask'], options['mean_0'])
+        ious.append(get_mean_iou(true_box, pred_box))
+    return sum(ious) / len(ious)
+
+
+def _eval_worker(model_cls, model_config, diffusion, val_batches, options, jobs, results):
+    device = torch.device(options['device'])
+    if device.type == 'cpu' and options.get('num_threads'):
+        torch.set_num_threads(options['num_threads'])
+    model = model_cls.from_config(model_config)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        # every job hands back a result, a failed one its error, so the trainer never waits on a lost epoch
+        try:
+            load_model(model, job['snapshot'], strict=True)
+            model.to(device).eval()
+            # same noise for every evaluation, results of different epochs are comparable
+            torch.manual_seed(options['seed'])
+            metrics = {"eval_epoch": job['epoch'],
+                       "iou_val_1000": sampling_iou(model, val_batches, diffusion, options),
+                       "iou_train_1000": sampling_iou(model, [job['train_batch']], diffusion, options)}
+        except Exception as e:
+            metrics = {"eval_epoch": job['epoch'], "error": repr(e)}
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+        finally:
+            if os.path.exists(job['snapshot']):
+                os.remove(job['snapshot'])
+        with open(options['log_path'], 'a') as f:
+            f.write(json.dumps(metrics) + '\n')
+        results.put(metrics)
+
+
+class EvalService:
+    """
+    Full-trajectory sampling IoU (iou_val_1000 / iou_train_1000) in a separate process, so training does not stall.
+    submit() snapshots the weights to <log dir>/eval_snapshots and queues the epoch; the worker samples a fixed set of
+    validation batches (plus the given train batch) on `device` with the DDPM sampler (all training timesteps) or
+    DDIM with a budget of `num_steps`, appends the result to `log_path` (jsonl, keyed by eval_epoch) and hands it back
+    through poll(). At most `max_pending` snapshots wait for the worker, later epochs are skipped until it catches up.
+    A failed evaluation comes back as {"eval_epoch", "error"}; if the worker process dies, the pending epochs are
+    dropped (checked every `poll_timeout` seconds while waiting) and no further ones are submitted.
+    """
+    def __init__(self, model, diffusion, val_batches, log_path, device='cpu', sampler='ddpm', num_steps=1000,
+                 diffusion_mode='sample', scaling_size=5, z_scaling_size=0.01, mean_0=True, seed=0, max_pending=1,
+                 num_threads=None, poll_timeout=30):
+        self.log_path = Path(log_path)
+        self.snapshot_dir = self.log_path.parent / 'eval_snapshots'
+        self.snapshot_dir.makedirs_p()
+        self.max_pending = max_pending
+        self.pending = 0
+        self.poll_timeout = poll_timeout
+        options = {"device": str(device), "sampler": sampler, "num_steps": num_steps, "diffusion_mode": diffusion_mode,
+                   "scaling_size": scaling_size, "z_scaling_size": z_scaling_size, "mean_0": mean_0, "seed": seed,
+                   "log_path": str(self.log_path), "num_threads": num_threads}
+        context = mp.get_context('spawn')
+        self.jobs, self.results = context.Queue(), context.Queue()
+        self.process = context.Process(target=_eval_worker, daemon=True,
+                                       args=(type(model), dict(model.config), diffusion,
+                                             [_to_cpu(batch) for batch in val_batches], options, self.jobs, self.results))
+        self.process.start()
+        LOG.info(f"Evaluation worker {self.process.pid} on {device}: {sampler} sampling, {len(val_batches)} validation batches")
+
+    def submit(self, epoch, model, train_batch):
+        """Queue the evaluation of `model` (unwrapped) at `epoch`, False if the worker is still busy or gone."""
+        if not self.process.is_alive():
+            return False
+        if self.pending >= self.max_pending:
+            LOG.info(f"Evaluation worker busy, epoch {epoch} is not evaluated")
+            return False
+        snapshot = self.snapshot_dir / f'epoch-{epoch}.safetensors'
+        save_model(model, snapshot)
+        self.jobs.put({"epoch": epoch, "snapshot": str(snapshot), "train_batch": _to_cpu(train_batch)})
+        self.pending += 1
+        return True
+
+    def poll(self, block=False):
+        """Results finished since the last call (all pending ones with `block`)."""
+        results = []
+        while self.pending:
+            try:
+                results.append(self.results.get(block=block, timeout=self.poll_timeout if block else None))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    LOG.error(f"Evaluation worker {self.process.pid} died (exit code {self.process.exitcode}), "
+                              f"{self.pending} pending evaluations are lost")
+                    self.pending = 0
+                    break
+                if block:
+                    continue
+                break
+            self.pending -= 1
+        return results
+
+    def close(self):
+        """Wait for the pending evaluations, stop the worker and return their results."""
+        results = self.poll(block=True)
+        if self.process.is_alive():
+            self.jobs.put(None)
+        self.process.join()
+        return results
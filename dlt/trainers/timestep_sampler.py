@@ -0,0 +1,108 @@
+import torch
+
+
+class UniformTimestepSampler:
+    """t ~ U{0, ..., num_timesteps - 1}, every layout with weight 1 (the original torch.randint)."""
+    def __init__(self, num_timesteps, device):
+        self.num_timesteps = num_timesteps
+        self.device = device
+
+    def sample(self, batch_size):
+        """(timesteps [B] long, loss weights [B])."""
+        t = torch.randint(0, self.num_timesteps, (batch_size,), device=self.device).long()
+        return t, torch.ones(batch_size, device=self.device)
+
+    def update(self, t, losses):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+
+class LossAwareTimestepSampler(UniformTimestepSampler):
+    """
+    Importance sampling of the diffusion timesteps by their recent loss. The timesteps are split into `num_buckets`
+    equal ranges; every bucket keeps an exponential moving average (decay `history_decay`) of the squared per-layout
+    loss and is drawn with probability proportional to its root, mixed with `uniform_prob` of the uniform distribution
+    so no bucket starves. Within a bucket t is uniform. The returned weights 1 / (num_timesteps * p(t)) make the
+    weighted mean loss an unbiased estimate of the uniform-t objective. Until every bucket has seen `warmup` layouts
+    the sampling stays uniform. With `stratified` the batch takes one draw from each of B equal slices of the CDF,
+    so a batch covers the distribution instead of clumping on the heaviest buckets.
+    The loss history is clamped to `min_loss_sq`, so no bucket has probability 0 even with uniform_prob=0.
+    Everything stays on the device: sample() and update() do not synchronize with the host. Every process keeps its
+    own history (each one is unbiased on its own).
+    """
+    min_loss_sq = 1e-12
+
+    def __init__(self, num_timesteps, device, num_buckets=50, history_decay=0.99, uniform_prob=0.01, warmup=64,
+                 stratified=True):
+        super().__init__(num_timesteps, device)
+        self.num_buckets = min(num_buckets, num_timesteps)
+        self.history_decay = history_decay
+        self.uniform_prob = uniform_prob
+        self.warmup = warmup
+        self.stratified = stratified
+        bounds = torch.linspace(0, num_timesteps, self.num_buckets + 1, device=device).round().long()
+        self.bucket_start, self.bucket_size = bounds[:-1], bounds[1:] - bounds[:-1]
+        self.loss_sq = torch.zeros(self.num_buckets, device=device)
+        self.seen = torch.zeros(self.num_buckets, device=device)
+
+    def bucket_probs(self):
+        uniform = self.bucket_size.float() / self.num_timesteps
+        # an all-zero history (e.g. a zeroed state) would leave no bucket to draw without uniform_prob
+        weights = self.loss_sq.clamp_min(self.min_loss_sq).sqrt()
+        probs = weights / weights.sum().clamp_min(1e-12)
+        probs = (1 - self.uniform_prob) * probs + self.uniform_prob * uniform
+        return torch.where((self.seen >= self.warmup).all(), probs, uniform)
+
+    def sample(self, batch_size):
+        probs = self.bucket_probs()
+        if self.stratified:
+            u = (torch.randperm(batch_size, device=self.device) + torch.rand(batch_size, device=self.device)) / batch_size
+            cdf = probs.cumsum(0)
+            bucket = torch.searchsorted(cdf, u * cdf[-1], right=True).clamp(max=self.num_buckets - 1)
+        else:
+            bucket = torch.multinomial(probs, batch_size, replacement=True)
+        size = self.bucket_size[bucket]
+        t = self.bucket_start[bucket] + torch.minimum((torch.rand(batch_size, device=self.device) * size).long(), size - 1)
+        # p(t) = probs[bucket] / size
+        weights = size.float() / (self.num_timesteps * probs[bucket])
+        return t, weights
+
+    @torch.no_grad()
+    def update(self, t, losses):
+        """Fold the per-layout losses [B] of timesteps `t` [B] into the bucket history."""
+        bucket = torch.bucketize(t, self.bucket_start[1:], right=True)
+        count = torch.zeros_like(self.seen).index_add_(0, bucket, torch.ones_like(losses, dtype=self.seen.dtype))
+        loss_sq = torch.zeros_like(self.loss_sq).index_add_(0, bucket, losses.detach().float() ** 2)
+        batch_mean = loss_sq / count.clamp_min(1)
+        # the first layouts of a bucket replace the empty history instead of being decayed towards 0
+        decay = torch.where(self.seen > 0, torch.full_like(self.loss_sq, self.history_decay), torch.zeros_like(self.loss_sq))
+        self.loss_sq = torch.where(count > 0, decay * self.loss_sq + (1 - decay) * batch_mean, self.loss_sq)
+        self.seen += count
+
+    def state_dict(self):
+        return {"loss_sq": self.loss_sq.tolist(), "seen": self.seen.tolist()}
+
+    def load_state_dict(self, state):
+        if state.get("loss_sq") and len(state["loss_sq"]) == self.num_buckets:
+            self.loss_sq = torch.tensor(state["loss_sq"], device=self.device)
+            self.seen = torch.tensor(state["seen"], device=self.device)
+
+
+def build_timestep_sampler(opt_conf, num_timesteps, device):
+    """The timestep sampler selected by opt_conf.timestep_sampler ('uniform' or 'loss_aware')."""
+    kind = opt_conf.get('timestep_sampler', 'uniform')
+    if kind == 'uniform':
+        return UniformTimestepSampler(num_timesteps, device)
+    if kind == 'loss_aware':
+        return LossAwareTimestepSampler(num_timesteps, device,
+                                        num_buckets=opt_conf.get('timestep_buckets', 50),
+                                        history_decay=opt_conf.get('timestep_history_decay', 0.99),
+                                        uniform_prob=opt_conf.get('timestep_uniform_prob', 0.01),
+                                        warmup=opt_conf.get('timestep_warmup', 64),
+                                        stratified=opt_conf.get('timestep_stratified', True))
+    raise ValueError(f"Unknown timestep sampler {kind}")
@@ -1,16 +1,148 @@
 import colorsys
+import contextlib
+import pickle
 import random
+import time
 
 import cv2
 import numpy as np
 import torch
 import torch.nn.functional as F
 
+from logger_set import LOG
+
 def custom_collate_fn(batch):
+    # ids are int32 element ids (CanvaLayout.lookup_ids resolves them), None for samples without ids
+    if isinstance(batch, dict):
+        # already collated by the dataset's __getitems__ (e.g. CanvaLayout)
+        ids = batch.pop('ids', None)
+        return {k: torch.from_numpy(v) for k, v in batch.items()}, None if ids is None else torch.from_numpy(ids)
     batch_data = [{k: v for k, v in item.items() if k != 'ids'} for item in batch]
-    ids = [item['ids'] for item in batch]  # 'ids' 수집
+    ids = [item['ids'] for item in batch if 'ids' in item]  # 'ids' 수집
     batch_collated = torch.utils.data.dataloader.default_collate(batch_data)
-    return batch_collated, ids
+    return batch_collated, torch.utils.data.dataloader.default_collate(ids) if ids else None
+
+class RunningMean:
+    """
+    Mean of per-step metrics kept on the device. update() only adds to two device tensors, nothing reaches the
+    host until compute(), which with an accelerator also sums over processes (so all of them have to call it).
+    Every update is one micro-batch unless `count` says otherwise, gradient accumulation does not change the mean.
+    """
+    def __init__(self, device):
+        self.total = torch.zeros((), dtype=torch.float64, device=device)
+        self.count = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, total, count=1):
+        self.total += total.detach().double() if torch.is_tensor(total) else total
+        self.count += count.detach().double() if torch.is_tensor(count) else count
+
+    def compute(self, accelerator=None):
+        total, count = self.total, self.count
+        if accelerator is not None and accelerator.num_processes > 1:
+            total, count = accelerator.reduce(torch.stack([total, count]), reduction='sum')
+        return (total / count.clamp(min=1)).item()
+
+    def reset(self):
+        self.total.zero_()
+        self.count.zero_()
+
+
+class PhaseTimer:
+    """
+    Time per training phase. begin(name) ends the running phase and starts `name`, end() closes the step. On a CUDA
+    device the boundaries are events on the current stream, read back in collect() (call it where the host syncs
+    anyway), so the phases measure device time without synchronizing every step; elsewhere they are host times.
+    With `annotate` every phase is also a torch.profiler.record_function range, with `track_memory` (CUDA) the peak
+    allocated memory of every phase is kept in `memory_peaks` (MiB); this resets the allocator peak at every phase,
+    so max_memory_allocated() afterwards only covers the time since the last one.
+    """
+    def __init__(self, device, annotate=False, track_memory=False):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.device = torch.device(device)
+        self.annotate = annotate
+        self.track_memory = track_memory and self.cuda
+        self.memory_peaks = {}
+        self.reserved_peak = 0.
+        self.totals = {}
+        self.steps = 0
+        self.pending = []
+        self.current = None
+
+    def _marker(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _close(self, marker):
+        name, start, record = self.current
+        if record is not None:
+            record.__exit__(None, None, None)
+        if self.cuda:
+            self.pending.append((name, start, marker))
+        else:
+            self.add(name, 1000 * (marker - start))
+        if self.track_memory:
+            # allocator bookkeeping on the host, no device sync
+            peak = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+            self.memory_peaks[name] = max(self.memory_peaks.get(name, 0.), peak)
+            self.reserved_peak = max(self.reserved_peak, torch.cuda.max_memory_reserved(self.device) / 2 ** 20)
+        self.current = None
+
+    def begin(self, name):
+        marker = self._marker()
+        if self.current is not None:
+            self._close(marker)
+        if self.track_memory:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        record = None
+        if self.annotate:
+            record = torch.profiler.record_function(name)
+            record.__enter__()
+        self.current = (name, marker, record)
+
+    def end(self):
+        if self.current is not None:
+            self._close(self._marker())
+            if self.track_memory:
+                # the peak after the step belongs to whatever runs next (e.g. validation)
+                torch.cuda.reset_peak_memory_stats(self.device)
+        self.steps += 1
+
+    def add(self, name, ms):
+        self.totals[name] = self.totals.get(name, 0.) + ms
+
+    def collect(self):
+        if self.pending:
+            self.pending[-1][2].synchronize()
+            for name, start, stop in self.pending:
+                self.add(name, start.elapsed_time(stop))
+            self.pending = []
+
+    def summary(self):
+        """Mean ms per step of every phase."""
+        self.collect()
+        return {name: total / max(self.steps, 1) for name, total in self.totals.items()}
+
+
+def training_profiler(opt_conf, log_dir, process_index=0):
+    """
+    torch.profiler over the steps selected by opt_conf.profile_* (skip `profile_wait`, warm up `profile_warmup`,
+    record `profile_active`, `profile_repeat` times), traces to <log_dir>/profiler. None when opt_conf.profile is off.
+    Call step() after every training step.
+    """
+    if not opt_conf.get('profile', False):
+        return None
+    from torch.profiler import profile, schedule, tensorboard_trace_handler, ProfilerActivity
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+    trace_dir = log_dir / 'profiler'
+    return profile(activities=activities,
+                   schedule=schedule(wait=opt_conf.get('profile_wait', 50), warmup=opt_conf.get('profile_warmup', 5),
+                                     active=opt_conf.get('profile_active', 10), repeat=opt_conf.get('profile_repeat', 1)),
+                   on_trace_ready=tensorboard_trace_handler(str(trace_dir), worker_name=f'rank{process_index}'),
+                   record_shapes=True, profile_memory=opt_conf.get('profile_memory', False), with_stack=False)
+
 
 def HSVToRGB(h, s, v):
     (r, g, b) = colorsys.hsv_to_rgb(h, s, v)
@@ -40,6 +172,69 @@ def set_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def process_memory(pid=None):
+    """
+    Memory of a process (default this one) in MiB: rss, uss (pages only this process uses) and pss (shared pages
+    split between the processes mapping them), pss summed over ranks is the real footprint of the node.
+    """
+    import psutil
+    info = psutil.Process(pid).memory_full_info()
+    return {k: getattr(info, k) / 2 ** 20 for k in ('rss', 'uss', 'pss') if hasattr(info, k)}
+
+
+def format_memory(memory):
+    return ', '.join(f'{k} {v:.0f} MiB' for k, v in memory.items())
+
+
+def device_memory(device):
+    """Current and peak (since the last reset) allocated / reserved memory of a CUDA device in MiB, {} elsewhere."""
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return {}
+    return {"allocated": torch.cuda.memory_allocated(device) / 2 ** 20,
+            "reserved": torch.cuda.memory_reserved(device) / 2 ** 20,
+            "peak_allocated": torch.cuda.max_memory_allocated(device) / 2 ** 20,
+            "peak_reserved": torch.cuda.max_memory_reserved(device) / 2 ** 20}
+
+
+def host_memory():
+    """
+    RSS in MiB of this process and of its children (DataLoader workers, the evaluation worker): the sum over the
+    children and the largest one. Cheaper than process_memory, which reads uss / pss from smaps.
+    """
+    import psutil
+    children = []
+    for child in psutil.Process().children(recursive=True):
+        try:
+            children.append(child.memory_info().rss / 2 ** 20)
+        except psutil.NoSuchProcess:
+            pass
+    return {"rss": psutil.Process().memory_info().rss / 2 ** 20, "workers_rss": sum(children),
+            "max_worker_rss": max(children, default=0.)}
+
+
+@contextlib.contextmanager
+def oom_snapshot(path, enabled=True):
+    """
+    Record the CUDA allocator history inside the block; on an out of memory error pickle the allocator snapshot to
+    `path` (view it with torch/cuda/_memory_viz.py) before re-raising. Recording slows allocations down, so it is
+    opt-in.
+    """
+    if not enabled or not torch.cuda.is_available():
+        yield
+        return
+    torch.cuda.memory._record_memory_history(True)
+    try:
+        yield
+    except torch.cuda.OutOfMemoryError:
+        with open(path, 'wb') as f:
+            pickle.dump(torch.cuda.memory._snapshot(), f)
+        LOG.error(f"CUDA out of memory, allocator snapshot in {path}\n{torch.cuda.memory_summary()}")
+        raise
+    finally:
+        torch.cuda.memory._record_memory_history(False)
+
+
 def masked_cross_entropy(a, b, mask):
     b_c = torch.nn.functional.one_hot(b, num_classes=a.shape[-1])
     a_c = F.log_softmax(a, dim=2)